@@ -47,15 +47,19 @@ def read_complex_data(GDALfilename):
     return slc;
 
 
-def read_scalar_data(GDALfilename, band=1, flush_zeros=True):
+def read_scalar_data(GDALfilename, band=1, flush_zeros=True, window=None):
     # band = 1;  # this seems right for most applications 
     # For unwrapped files, band = 2
+    # window: (xoff, yoff, xsize, ysize) in pixels, to read only that part of the raster
     from osgeo import gdal  # GDAL support for reading virtual files
     print("Reading file %s " % GDALfilename);
     if ".unw" in GDALfilename and ".unw." not in GDALfilename and band == 1:
         print("WARNING: We usually read band=2 for snaphu unwrapped files. Are you sure you want band 1 ????");
     ds = gdal.Open(GDALfilename, gdal.GA_ReadOnly)
-    data = ds.GetRasterBand(band).ReadAsArray()
+    if window is None:
+        data = ds.GetRasterBand(band).ReadAsArray()
+    else:
+        data = ds.GetRasterBand(band).ReadAsArray(*[int(x) for x in window])
     transform = ds.GetGeoTransform()
     ds = None
 
@@ -81,6 +85,15 @@ def read_scalar_data(GDALfilename, band=1, flush_zeros=True):
     return data;
 
 
+def read_raster_shape(GDALfilename):
+    # (ny, nx) of a raster, without reading it
+    from osgeo import gdal
+    ds = gdal.Open(GDALfilename, gdal.GA_ReadOnly)
+    shape = (ds.RasterYSize, ds.RasterXSize)
+    ds = None
+    return shape;
+
+
 def read_phase_data(GDALfilename):
     # Start with a complex quantity, and return only the phase of that quantity. 
     slc = read_complex_data(GDALfilename);
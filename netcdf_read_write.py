@@ -103,6 +103,15 @@ def give_metrics_on_grd(filename):
 
 
 def read_3D_netcdf(filename):
+    # Switch between netcdf3 and netcdf4 automatically.
+    try:
+        [tdata, xdata, ydata, zdata] = read_3D_netcdf3(filename);
+    except TypeError:
+        [tdata, xdata, ydata, zdata] = read_3D_netcdf4(filename);
+    return [tdata, xdata, ydata, zdata];
+
+
+def read_3D_netcdf3(filename):
     tdata0 = netcdf.netcdf_file(filename, 'r').variables['t'][:];
     tdata = tdata0.copy();
     xdata0 = netcdf.netcdf_file(filename, 'r').variables['x'][:];
@@ -114,6 +123,18 @@ def read_3D_netcdf(filename):
     return [tdata, xdata, ydata, zdata];
 
 
+def read_3D_netcdf4(filename):
+    # Reading a (t, y, x) netCDF4 time series, such as one made by create_timeseries_netcdf4
+    rootgrp = Dataset(filename, "r");
+    rootgrp.set_auto_mask(False);  # nans stay nans
+    tdata = rootgrp.variables['t'][:];
+    xdata = rootgrp.variables['x'][:];
+    ydata = rootgrp.variables['y'][:];
+    zdata = rootgrp.variables['z'][:, :, :];
+    rootgrp.close();
+    return [tdata, xdata, ydata, zdata];
+
+
 # --------------- WRITING ------------------- # 
 
 
@@ -133,16 +154,17 @@ def write_netcdf4(xdata, ydata, zdata, netcdfname):
 
 def produce_output_netcdf(xdata, ydata, zdata, zunits, netcdfname, dtype=float):
     # # Write the netcdf velocity grid file.
+    # dtype is the precision of z (np.float32 halves the file); x and y are always double precision.
     print("Writing output netcdf to file %s " % netcdfname);
     f = netcdf.netcdf_file(netcdfname, 'w');
     f.history = 'Created for a test';
     f.createDimension('x', len(xdata));
     f.createDimension('y', len(ydata));
     print(np.shape(zdata));
-    x = f.createVariable('x', dtype, ('x',))
+    x = f.createVariable('x', float, ('x',))
     x[:] = xdata;
     x.units = 'range';
-    y = f.createVariable('y', dtype, ('y',))
+    y = f.createVariable('y', float, ('y',))
     y[:] = ydata;
     y.units = 'azimuth';
     z = f.createVariable('z', dtype, ('y', 'x',));
@@ -168,7 +190,7 @@ def flip_if_necessary(filename):
         data = read_grd(filename);
         # This is the key! Flip the x-axis when necessary.
         # xdata=np.flip(xdata,0);  # This is sometimes necessary and sometimes not!  Not sure why.
-        produce_output_netcdf(xdata, ydata, data, 'mm/yr', filename);
+        produce_output_netcdf(xdata, ydata, data, 'mm/yr', filename, dtype=data.dtype);
         xinc = subprocess.check_output('gmt grdinfo -M -C ' + filename + ' | awk \'{print $8}\'',
                                        shell=True);  # the x-increment
         xinc = float(xinc.split()[0]);
@@ -179,7 +201,7 @@ def flip_if_necessary(filename):
         data = read_grd(filename);
         # Flip the y-axis when necessary.
         # ydata=np.flip(ydata,0);
-        produce_output_netcdf(xdata, ydata, data, 'mm/yr', filename);
+        produce_output_netcdf(xdata, ydata, data, 'mm/yr', filename, dtype=data.dtype);
         yinc = subprocess.check_output('gmt grdinfo -M -C ' + filename + ' | awk \'{print $9}\'',
                                        shell=True);  # the x-increment
         yinc = float(yinc.split()[0]);
@@ -235,28 +257,35 @@ def produce_output_contourf(netcdfname, plottitle, plotname, cblabel):
     return;
 
 
-def produce_output_TS_grids(xdata, ydata, zdata, timearray, zunits, outdir):
+def produce_output_TS_grids(xdata, ydata, zdata, timearray, zunits, outdir, dtype=float):
+    # zdata is either a 3D array (t, y, x) or a 2D list where each element is [timeseries].
+    # dtype: precision of the grids, as in produce_output_netcdf
     print("Shape of zdata originally:", np.shape(zdata));
     for i in range(len(timearray)):
         filename = dt.datetime.strftime(timearray[i], "%Y%m%d") + ".grd";
-        zdata_slice = np.zeros([len(ydata), len(xdata)]);
-        for k in range(len(xdata)):
-            for j in range(len(ydata)):
-                temp_array = zdata[j][k][0];
-                zdata_slice[j][k] = temp_array[i];
-        produce_output_netcdf(xdata, ydata, zdata_slice, zunits, outdir + "/" + filename);
+        if np.shape(zdata) == (len(timearray), len(ydata), len(xdata)):
+            zdata_slice = zdata[i, :, :];
+        else:
+            zdata_slice = np.zeros([len(ydata), len(xdata)]);
+            for k in range(len(xdata)):
+                for j in range(len(ydata)):
+                    temp_array = zdata[j][k][0];
+                    zdata_slice[j][k] = temp_array[i];
+        produce_output_netcdf(xdata, ydata, zdata_slice, zunits, outdir + "/" + filename, dtype=dtype);
     return;
 
 
-def produce_output_timeseries(xdata, ydata, zdata, timearray, zunits, netcdfname):
+def produce_output_timeseries(xdata, ydata, zdata, timearray, zunits, netcdfname, dtype=float, tunits=None):
     # Ultimately we will need a function that writes a large 3D array.
     # Each 2D slice is the displacement at a particular time, associated with a time series.
     # zdata comes in as a 2D array where each element is a timeseries (1D array).
     # It must be re-packaged into a 3D array before we save it.
     # Broke during long SoCal experiment for some reason. f.close() didn't work.
+    # dtype: precision of z, e.g. np.float32.
+    # tunits: units of t, by default days since the first date of timearray.
 
     print("Shape of zdata originally:", np.shape(zdata));
-    zdata_repacked = np.zeros([len(timearray), len(ydata), len(xdata)]);
+    zdata_repacked = np.zeros([len(timearray), len(ydata), len(xdata)], dtype=dtype);
     print("Intended repackaged zdata of shape: ", np.shape(zdata_repacked));
     if np.shape(zdata) == np.shape(zdata_repacked):
         print("No repacking necessary");
@@ -283,7 +312,7 @@ def produce_output_timeseries(xdata, ydata, zdata, timearray, zunits, netcdfname
 
     t = f.createVariable('t', 'i4', ('t',))
     t[:] = days_array;
-    t.units = 'days';
+    t.units = 'days since ' + dt.datetime.strftime(timearray[0], "%Y-%m-%d") if tunits is None else tunits;
     x = f.createVariable('x', float, ('x',))
     x[:] = xdata;
     x.units = 'range';
@@ -291,9 +320,35 @@ def produce_output_timeseries(xdata, ydata, zdata, timearray, zunits, netcdfname
     y[:] = ydata;
     y.units = 'azimuth';
 
-    z = f.createVariable('z', float, ('t', 'y', 'x'));
+    z = f.createVariable('z', dtype, ('t', 'y', 'x'));
     z[:, :, :] = zdata_repacked;
     z.units = zunits;
     f.close();
     return;
 
+
+def create_timeseries_netcdf4(xdata, ydata, timearray, zunits, netcdfname, chunk_rows=100, zlib=False,
+                              dtype='f4'):
+    # Preallocate a (t, y, x) netCDF4 time series to be filled in one block of rows at a time.
+    # z is chunked as (1, chunk_rows, nx), so writing a block of rows or reading one epoch touches few chunks.
+    # Returns the open Dataset: write with rootgrp.variables['z'][:, rows, :] = block, then rootgrp.close().
+    print("Creating output netcdf4 time series %s " % netcdfname);
+    days_array = [(i - timearray[0]).days for i in timearray];
+    root_grp = Dataset(netcdfname, 'w', format="NETCDF4");
+    root_grp.history = 'Created for a test';
+    root_grp.createDimension('t', len(timearray));
+    root_grp.createDimension('y', len(ydata));
+    root_grp.createDimension('x', len(xdata));
+    t = root_grp.createVariable('t', 'i4', ('t',));
+    t[:] = days_array;
+    t.units = 'days since ' + dt.datetime.strftime(timearray[0], "%Y-%m-%d");
+    x = root_grp.createVariable('x', 'f8', ('x',));
+    x[:] = xdata;
+    x.units = 'range';
+    y = root_grp.createVariable('y', 'f8', ('y',));
+    y[:] = ydata;
+    y.units = 'azimuth';
+    z = root_grp.createVariable('z', dtype, ('t', 'y', 'x'), zlib=zlib, fill_value=np.nan,
+                                chunksizes=(1, max(min(chunk_rows, len(ydata)), 1), max(len(xdata), 1)));
+    z.units = zunits;
+    return root_grp;
@@ -1,13 +1,18 @@
 #!/usr/bin/python
 import numpy as np
 import netcdf_read_write as rwr
-import readmytupledata as rmd
+import stack_reference
+import stack_cache
 
 
-def drive_velocity_simple_stack(intfs, wavelength, rowref, colref, outdir):
+def drive_velocity_simple_stack(intfs, wavelength, rowref, colref, outdir, ref_window=0, ref_gps_velocity=None,
+                                cache_dir=None):
+    # ref_window, ref_gps_velocity: reference to a box around the reference pixel and/or a GPS station (stack_reference)
+    # cache_dir: read the interferograms through the stack cache there (see stack_cache)
     signal_spread_data = rwr.read_grd(outdir + "/signalspread.nc");
-    intf_tuple = rmd.reader(intfs);
-    velocities, x, y = velocity_simple_stack(intf_tuple, wavelength, rowref, colref, signal_spread_data, 25);
+    intf_tuple = stack_cache.read_stack(intfs, cache_dir);
+    intf_tuple = stack_reference.reference_stack(intf_tuple, rowref, colref, ref_window, ref_gps_velocity, wavelength);
+    velocities, x, y = velocity_simple_stack(intf_tuple, wavelength, None, None, signal_spread_data, 25);
     # last argument is signal threshold (< 100%).  lower signal threshold allows for more data into the stack.
     rwr.produce_output_netcdf(x, y, velocities, 'mm/yr', outdir + '/velo_simple_stack.grd')
     rwr.produce_output_plot(outdir + '/velo_simple_stack.grd', 'LOS Velocity ', outdir + '/velo_simple_stack.png',
@@ -31,20 +36,22 @@ def velocity_simple_stack(mytuple, wavelength, rowref, colref, signal_spread_dat
     """This function takes in a list of files that contain arrays of phases and times. 
     It will compute the velocity of each pixel using the satellite's  wavelength. It will return 2D array of velocities.
     The final argument should be a number between 0 and 100 inclusive that tells the function which pixels
-    to exclude based on this signal percentage."""
+    to exclude based on this signal percentage.
+    rowref, colref can be None if mytuple is already referenced (stack_reference)."""
     print('Number of files being stacked: ' + str(len(mytuple.zvalues)));
     velocities = np.zeros((len(mytuple.yvalues), len(mytuple.xvalues)));
-    ref_pixel_values = mytuple.zvalues[:, rowref, colref];
+    if rowref is not None:  # referencing the stack once, not once per pixel
+        mytuple = stack_reference.reference_stack(mytuple, rowref, colref, in_place=False);
     c = 0;
 
-    it = np.nditer(mytuple.zvalues[0, :, :], flags=['multi_index'], order='F');  # iterate through the 3D array of data
+    it = np.nditer(mytuple.zvalues[0, :, :], flags=['multi_index'], order='C');  # row by row through the data
     while not it.finished:
         i = it.multi_index[0];
         j = it.multi_index[1];
         signal_spread = signal_spread_data[i, j];
         if signal_spread > signal_threshold:  # if we want a calculation for that day...
-            pixel_value = np.subtract(mytuple.zvalues[:, i, j], ref_pixel_values);
-            velocities[i, j] = get_velocity_by_stacking_pixel(pixel_value, mytuple.date_deltas, wavelength);
+            velocities[i, j] = get_velocity_by_stacking_pixel(mytuple.zvalues[:, i, j], mytuple.date_deltas,
+                                                              wavelength);
         else:
             velocities[i, j] = np.nan;
         c = c + 1;
@@ -0,0 +1,205 @@
+# Benchmarking the stacking pipeline on synthetic stacks
+# Builds a GMTSAR-style stack of interferograms (YYYYDDD_YYYYDDD/unwrap.grd and corr.grd) of a given size,
+# network and nan rate, then times the reader, stack_corr, nsbas.Velocities, nsbas.Full_TS, and the writers.
+# Each run appends one JSON line to a results file (with the git commit), so engine changes can be compared
+# on exactly the same workload:
+#
+#   python benchmark_nsbas.py [results_file]     # runs the default workloads below
+#   compare_results('benchmark_results.jsonl')   # table of stage timings per workload and commit
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import datetime as dt
+import subprocess
+import platform
+import shutil
+import json
+import time
+import sys
+import os
+import sentinel_utilities
+import rose_baseline_plot
+import netcdf_read_write as rwr
+import readmytupledata as rmd
+import stack_corr
+import nsbas
+import stacking_profiler
+
+
+def make_acquisitions(n_dates, interval_days=12, start_date=dt.datetime(2016, 1, 5), seed=0):
+    # Sentinel-like acquisitions: stems, GMTSAR times (YYYYDDD with day 0 = January 1), and perpendicular baselines
+    rng = np.random.default_rng(seed);
+    dates = [start_date + dt.timedelta(days=interval_days * i) for i in range(n_dates)];
+    stems = ['S1_' + dt.datetime.strftime(x, "%Y%m%d") + '_ALL_F1' for x in dates];
+    times = np.array([float(dt.datetime.strftime(x, "%Y%j")) - 1 for x in dates]);
+    baselines = rng.normal(0, 40, n_dates);
+    return dates, stems, times, baselines;
+
+
+def make_network(stems, times, baselines, network='SBAS', tbaseline=50, xbaseline=200, annual_crit_days=30,
+                 annual_crit_baseline=100):
+    # Pairs chosen the way sentinel_main_functions.get_total_intf_all does, for network like 'SBAS', 'CHAIN+1YR'
+    intf_pairs = [];
+    if "SBAS" in network:
+        intf_pairs = intf_pairs + sentinel_utilities.get_small_baseline_subsets(stems, times, baselines, tbaseline,
+                                                                                xbaseline);
+    if "CHAIN" in network:
+        intf_pairs = intf_pairs + sentinel_utilities.get_chain_subsets(stems, times);
+    if "1YR" in network:
+        intf_pairs = intf_pairs + rose_baseline_plot.compute_new_pairs(stems, times, baselines, annual_crit_days,
+                                                                       annual_crit_baseline, 1);
+    if intf_pairs == []:
+        print("network %s is probably not a valid network [combinations of SBAS, CHAIN, 1YR]" % network);
+        sys.exit(1);
+    return sorted(set(intf_pairs));
+
+
+def make_synthetic_stack(outdir, n_dates=30, ny=200, nx=300, network='SBAS', nan_rate=0.1, seed=0,
+                         wavelength=56, rowref=0, colref=0, interval_days=12):
+    # Write unwrap.grd (radians) and corr.grd for each pair of the network into outdir/YYYYDDD_YYYYDDD/.
+    # The deformation is a velocity field plus a seasonal term and noise on each date. In each interferogram,
+    # a fraction nan_rate of the pixels is decorrelated: nan in unwrap.grd and low in corr.grd.
+    # The reference pixel (rowref, colref) is never nan.
+    # Returns the unwrap files, the corr files, and the true velocities (mm/yr).
+    rng = np.random.default_rng(seed);
+    dates, stems, times, baselines = make_acquisitions(n_dates, interval_days, seed=seed);
+    cwd = os.getcwd();
+    os.makedirs(outdir, exist_ok=True);
+    os.chdir(outdir);  # the 1YR selection saves a rose plot here
+    intf_pairs = make_network(stems, times, baselines, network);
+    os.chdir(cwd);
+
+    xdata = np.arange(nx, dtype=float);
+    ydata = np.arange(ny, dtype=float);
+    [X, Y] = np.meshgrid(xdata / max(nx, 1), ydata / max(ny, 1));
+    velocity = 20 * X - 10 * Y + 5 * np.sin(4 * X);  # mm/yr
+    velocity = velocity - velocity[rowref, colref];
+    years = np.array([(x - dates[0]).days / 365.24 for x in dates]);
+    disp = np.zeros((n_dates, ny, nx));
+    for i in range(n_dates):
+        disp[i] = velocity * years[i] + 3 * np.sin(2 * np.pi * years[i]) * Y + rng.normal(0, 2, (ny, nx));
+    phase = -4 * np.pi / wavelength * disp;  # radians, the sign convention of nsbas
+
+    intf_files, corr_files = [], [];
+    date_index = {stem[3:11]: i for i, stem in enumerate(stems)};
+    for pair in intf_pairs:
+        i, j = date_index[pair[3:11]], date_index[pair[22:30]];
+        folder = outdir + '/' + "%d_%d" % (times[i], times[j]);
+        os.makedirs(folder, exist_ok=True);
+        decorrelated = rng.random((ny, nx)) < nan_rate;
+        decorrelated[rowref, colref] = False;
+        unwrap = phase[j] - phase[i];
+        unwrap[decorrelated] = np.nan;
+        corr = rng.uniform(0.2, 0.9, (ny, nx));
+        corr[decorrelated] = rng.uniform(0.0, 0.1, np.sum(decorrelated));
+        rwr.write_netcdf4(xdata, ydata, unwrap, folder + '/unwrap.grd');
+        rwr.write_netcdf4(xdata, ydata, corr, folder + '/corr.grd');
+        intf_files.append(folder + '/unwrap.grd');
+        corr_files.append(folder + '/corr.grd');
+    print("Synthetic stack: %d interferograms from %d dates, %d x %d pixels, network %s, nan rate %.2f" % (
+        len(intf_files), n_dates, ny, nx, network, nan_rate));
+    return intf_files, corr_files, velocity;
+
+
+def get_git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)));
+        return commit.decode().strip();
+    except (subprocess.CalledProcessError, OSError):
+        return 'unknown';
+
+
+def timed(timings, stage_name, func, *args, **kwargs):
+    # Run func, store its wall time in timings[stage_name], and return its result
+    start = time.perf_counter();
+    retval = func(*args, **kwargs);
+    timings[stage_name] = time.perf_counter() - start;
+    print("BENCHMARK %s: %.3f s" % (stage_name, timings[stage_name]));
+    return retval;
+
+
+def run_benchmark(workdir, n_dates=30, ny=200, nx=300, network='SBAS', nan_rate=0.1, seed=0, nsbas_good_perc=50,
+                  smoothing=0, wavelength=56, workers=1, results_file=None, write_grds=True, keep_stack=False):
+    # Time each stage of the pipeline on one synthetic stack; returns the record, appended to results_file if given.
+    # write_grds also times the per-epoch grd writers, which need gmt; they are skipped if gmt isn't found.
+    rowref, colref = ny // 2, nx // 2;
+    stackdir = workdir + '/stack';
+    outdir = workdir + '/output';
+    os.makedirs(outdir, exist_ok=True);
+    timings = {};
+    intf_files, corr_files, velocity = timed(timings, 'make_stack', make_synthetic_stack, stackdir, n_dates, ny,
+                                             nx, network, nan_rate, seed, wavelength, rowref, colref);
+
+    intf_tuple = timed(timings, 'read_unwrap', rmd.reader, intf_files);
+    corr_tuple = timed(timings, 'read_corr', rmd.reader, corr_files);
+    signal_spread_data = timed(timings, 'stack_corr', stack_corr.stack_corr, corr_tuple, 0.1);
+
+    vel = timed(timings, 'velocities', nsbas.Velocities, intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref,
+                colref, signal_spread_data, workers=workers).vel;
+    profiler = stacking_profiler.Profiler('benchmark', interval=None, verbose=False);
+    TS = timed(timings, 'full_ts', nsbas.Full_TS, intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref,
+               signal_spread_data, workers=workers, profiler=profiler).TS;
+    timed(timings, 'full_ts_streamed', nsbas.Full_TS, intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref,
+          colref, signal_spread_data, workers=workers, output_file=outdir + '/TS.nc');
+
+    datestrs, x_dts, _ = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    timed(timings, 'write_timeseries', rwr.produce_output_timeseries, intf_tuple.xvalues, intf_tuple.yvalues, TS,
+          x_dts, 'mm', outdir + '/TS_netcdf3.nc');
+    if write_grds and shutil.which('gmt') is not None:
+        timed(timings, 'write_velocity_grd', rwr.produce_output_netcdf, intf_tuple.xvalues, intf_tuple.yvalues, vel,
+              'mm/yr', outdir + '/velo_nsbas.grd');
+        timed(timings, 'write_TS_grids', rwr.produce_output_TS_grids, intf_tuple.xvalues, intf_tuple.yvalues, TS,
+              x_dts, 'mm', outdir);
+    elif write_grds:
+        print("gmt not found: skipping the grd writers");
+
+    good = ~np.isnan(vel);
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': get_git_commit(), 'host': platform.node(),
+              'workload': {'n_dates': n_dates, 'n_intf': len(intf_files), 'ny': ny, 'nx': nx, 'network': network,
+                           'nan_rate': nan_rate, 'seed': seed, 'nsbas_good_perc': nsbas_good_perc,
+                           'smoothing': smoothing, 'workers': workers},
+              'timings_s': timings,
+              'pixels_inverted': int(np.sum(good)),
+              'velocity_rms_error': float(np.sqrt(np.mean((vel[good] - velocity[good]) ** 2))) if np.any(good) else None,
+              'full_ts_profile': profiler.report()};
+    if results_file is not None:
+        with open(results_file, 'a') as ofile:
+            ofile.write(json.dumps(record) + "\n");
+        print("Appended benchmark results to %s " % results_file);
+    if not keep_stack:
+        shutil.rmtree(stackdir);
+        shutil.rmtree(outdir);
+    return record;
+
+
+def workload_key(record):
+    w = record['workload'];
+    return "%s %dd %dx%d nan%.2f w%d" % (w['network'], w['n_dates'], w['ny'], w['nx'], w['nan_rate'], w['workers']);
+
+
+def compare_results(results_file):
+    # Print the stage timings of every run in results_file, grouped by workload, oldest run first
+    records = [json.loads(line) for line in open(results_file) if line.strip()];
+    stages = [];
+    for record in records:
+        stages = stages + [x for x in record['timings_s'] if x not in stages];
+    for key in sorted(set([workload_key(x) for x in records])):
+        print("\n" + key);
+        print("%-10s %-20s" % ('commit', 'time') + "".join([" %17s" % x[0:17] for x in stages]));
+        for record in [x for x in records if workload_key(x) == key]:
+            print("%-10s %-20s" % (record['commit'], record['time']) + "".join(
+                [" %17.3f" % record['timings_s'][x] if x in record['timings_s'] else " %17s" % '-' for x in stages]));
+    return;
+
+
+if __name__ == "__main__":
+    results_file = sys.argv[1] if len(sys.argv) > 1 else 'benchmark_results.jsonl';
+    workdir = 'benchmark_workdir';
+    workloads = [{'n_dates': 30, 'ny': 100, 'nx': 150, 'network': 'SBAS', 'nan_rate': 0.1},
+                 {'n_dates': 30, 'ny': 100, 'nx': 150, 'network': 'CHAIN', 'nan_rate': 0.0},
+                 {'n_dates': 90, 'ny': 100, 'nx': 150, 'network': 'SBAS+1YR', 'nan_rate': 0.3}];
+    for workload in workloads:
+        run_benchmark(workdir, results_file=results_file, **workload);
+    compare_results(results_file);
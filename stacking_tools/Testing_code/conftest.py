@@ -0,0 +1,6 @@
+# The tests import the stacking modules the way the drivers do, from stacking_tools and the top of the repo
+import sys
+import os
+
+testing_dir = os.path.dirname(os.path.abspath(__file__));
+sys.path[:0] = [os.path.dirname(testing_dir), os.path.dirname(os.path.dirname(testing_dir))];
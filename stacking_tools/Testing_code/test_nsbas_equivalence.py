@@ -0,0 +1,492 @@
+# Equivalence tests of the NSBAS engines on small synthetic stacks:
+# every faster path must give the same time series as the path it replaces,
+# and both must match the NSBAS equations written out independently here.
+# Run with: python -m pytest stacking_tools/Testing_code
+
+import numpy as np
+import datetime as dt
+import os
+import shutil
+from netCDF4 import Dataset
+import pytest
+import netcdf_read_write as rwr
+import readmytupledata as rmd
+import nsbas
+import nsbas_batched
+import nsbas_accessing
+import nsbas_incremental
+import dem_error_correction
+import stacking_profiler
+import stack_reference
+
+WAVELENGTH = 56;
+
+
+def make_stack(ny=20, nx=15, n_dates=10, nan_rate=0.15, seed=0):
+    # An interferogram tuple (radians) and a coherence tuple of a small SBAS network.
+    # Each date is linked to the next three; a fraction nan_rate of the phase values are nans,
+    # the reference pixel (0, 0) has none, and pixel (2, 3) loses every interferogram across one date.
+    rng = np.random.default_rng(seed);
+    dates = [dt.datetime(2016, 1, 5) + dt.timedelta(days=12 * k) for k in range(n_dates)];
+    pairs = [(a, b) for a in range(n_dates) for b in range(a + 1, min(a + 4, n_dates))];
+    days = np.array([(x - dates[0]).days for x in dates]);
+    velocity = rng.normal(size=(ny, nx));
+    phase = velocity[np.newaxis] * days[:, np.newaxis, np.newaxis] / 100.0 + rng.normal(0, 0.3, (n_dates, ny, nx));
+    zvalues = np.array([phase[b] - phase[a] for a, b in pairs]);
+    zvalues[rng.random(np.shape(zvalues)) < nan_rate] = np.nan;
+    zvalues[:, 0, 0] = np.nan_to_num(zvalues[:, 0, 0]);
+    zvalues[[k for k, (a, b) in enumerate(pairs) if a <= n_dates // 2 < b], 2, 3] = np.nan;
+    date_pairs_julian = [dt.datetime.strftime(dates[a], "%Y%j") + "_" + dt.datetime.strftime(dates[b], "%Y%j")
+                         for a, b in pairs];
+    intf_tuple = rmd.data(filepaths=np.array(date_pairs_julian), date_pairs_julian=np.array(date_pairs_julian),
+                          date_deltas=np.array([(dates[b] - dates[a]).days / 365.24 for a, b in pairs]),
+                          xvalues=np.arange(nx, dtype=float), yvalues=np.arange(ny, dtype=float), zvalues=zvalues,
+                          date_pairs_dt=np.array([[dates[a], dates[b]] for a, b in pairs]), ts_dates=None);
+    coh_tuple = intf_tuple._replace(zvalues=rng.uniform(0.2, 1, np.shape(zvalues)));
+    return intf_tuple, coh_tuple;
+
+
+def select_intfs(intf_tuple, mask):
+    return intf_tuple._replace(filepaths=intf_tuple.filepaths[mask],
+                               date_pairs_julian=intf_tuple.date_pairs_julian[mask],
+                               date_deltas=intf_tuple.date_deltas[mask], zvalues=intf_tuple.zvalues[mask],
+                               date_pairs_dt=intf_tuple.date_pairs_dt[mask]);
+
+
+def signal_spread(intf_tuple):
+    return np.full((len(intf_tuple.yvalues), len(intf_tuple.xvalues)), 100.0);
+
+
+def solve_TS(intf_tuple, smoothing=0, rowref=0, colref=0, **kwargs):
+    # The whole nsbas_batched.ts_results, or None when streamed
+    return nsbas.Full_TS(intf_tuple, 50, smoothing, WAVELENGTH, rowref, colref, signal_spread(intf_tuple), **kwargs);
+
+
+def full_TS(intf_tuple, smoothing=0, rowref=0, colref=0, **kwargs):
+    results = solve_TS(intf_tuple, smoothing, rowref, colref, **kwargs);
+    return None if results is None else results.TS;
+
+
+def solve_velocities(intf_tuple, smoothing=0, rowref=0, colref=0, **kwargs):
+    return nsbas.Velocities(intf_tuple, 50, smoothing, WAVELENGTH, rowref, colref, signal_spread(intf_tuple),
+                            **kwargs);
+
+
+def velocities(intf_tuple, smoothing=0, rowref=0, colref=0, **kwargs):
+    return solve_velocities(intf_tuple, smoothing, rowref, colref, **kwargs).vel;
+
+
+def TS_cube(intf_tuple, smoothing=0, **kwargs):
+    # The batched solver itself, for the options that Full_TS does not pass on
+    datestrs = nsbas.get_TS_dates(intf_tuple.date_pairs_julian)[0];
+    results = nsbas_batched.compute_TS_cube(intf_tuple, 50, smoothing, WAVELENGTH, 0, 0, signal_spread(intf_tuple),
+                                            datestrs, **kwargs);
+    return None if results is None else results.TS;
+
+
+def reference_TS(intf_tuple, smoothing=0, coh_tuple=None):
+    # NSBAS written out pixel by pixel with np.linalg.lstsq: one column per increment between epochs,
+    # one row per interferogram that is not nan, rows scaled by coherence for coherence-squared weights,
+    # then the smoothing problem [I; smoothing * D] x = [m; 0] with D the first differences.
+    datestrs = sorted(set([pair[0:7] for pair in intf_tuple.date_pairs_julian] +
+                          [pair[8:15] for pair in intf_tuple.date_pairs_julian]));
+    n_epochs = len(datestrs);
+    G_all = np.zeros((len(intf_tuple.date_pairs_julian), n_epochs - 1));
+    for k, pair in enumerate(intf_tuple.date_pairs_julian):
+        G_all[k, datestrs.index(pair[0:7]):datestrs.index(pair[8:15])] = 1;
+    D = np.eye(n_epochs - 1, n_epochs) - np.eye(n_epochs - 1, n_epochs, 1);
+    zvalues = intf_tuple.zvalues - intf_tuple.zvalues[:, 0:1, 0:1];
+    TS = np.full((n_epochs, len(intf_tuple.yvalues), len(intf_tuple.xvalues)), np.nan);
+    for i, j in np.ndindex(np.shape(zvalues[0])):
+        good = ~np.isnan(zvalues[:, i, j]);
+        G = G_all[good];
+        if np.sum(~good) >= len(good) * 0.5 or np.linalg.matrix_rank(G) < n_epochs - 1:
+            continue;
+        scale = np.ones(np.sum(good)) if coh_tuple is None else coh_tuple.zvalues[good, i, j];
+        m = np.linalg.lstsq(G * scale[:, np.newaxis], zvalues[good, i, j] * scale, rcond=None)[0];
+        cumulative = np.concatenate(([0], np.cumsum(m)));
+        if smoothing > 0:
+            cumulative = np.linalg.lstsq(np.vstack((np.eye(n_epochs), smoothing * D)),
+                                         np.concatenate((cumulative, np.zeros(n_epochs - 1))), rcond=None)[0];
+        TS[:, i, j] = -cumulative * WAVELENGTH / (4 * np.pi);
+        TS[:, i, j] = TS[:, i, j] - TS[0, i, j];
+    return TS;
+
+
+@pytest.mark.parametrize("smoothing", [0, 2.0])
+@pytest.mark.parametrize("weighted", [False, True])
+def test_batched_and_pixel_by_pixel_match_reference(smoothing, weighted):
+    # batched=False solves each pixel with nsbas.do_nsbas_pixel
+    intf_tuple, coh_tuple = make_stack();
+    coh_tuple = coh_tuple if weighted else None;
+    expected = reference_TS(intf_tuple, smoothing, coh_tuple=coh_tuple);
+    batched = full_TS(intf_tuple, smoothing, coh_tuple=coh_tuple);
+    by_pixel = full_TS(intf_tuple, smoothing, coh_tuple=coh_tuple, batched=False);
+    by_pixel = np.array([[ts[0] for ts in row] for row in by_pixel]).transpose(2, 0, 1);
+    assert np.all(np.isnan(expected[:, 2, 3]));  # disconnected network
+    np.testing.assert_allclose(batched, expected, rtol=0, atol=1e-8);
+    np.testing.assert_allclose(by_pixel, expected, rtol=0, atol=1e-8);
+
+
+def test_workers_match_serial():
+    intf_tuple, coh_tuple = make_stack();
+    serial = full_TS(intf_tuple, coh_tuple=coh_tuple, tile_rows=5);
+    parallel = full_TS(intf_tuple, coh_tuple=coh_tuple, tile_rows=5, workers=2);
+    np.testing.assert_array_equal(parallel, serial);
+    np.testing.assert_allclose(serial, full_TS(intf_tuple, coh_tuple=coh_tuple), rtol=0, atol=1e-10);
+    np.testing.assert_array_equal(velocities(intf_tuple, coh_tuple=coh_tuple, tile_rows=5, workers=2),
+                                  velocities(intf_tuple, coh_tuple=coh_tuple, tile_rows=5));
+
+
+def test_design_matrix_cache():
+    intf_tuple, _ = make_stack();
+    datestrs = nsbas.get_TS_dates(intf_tuple.date_pairs_julian)[0];
+    cache = nsbas_batched.DesignMatrixCache(intf_tuple.date_pairs_julian, datestrs, maxsize=2);
+    patterns = ~np.isnan(intf_tuple.zvalues[:, 1, 0:3].T);
+    entry = cache.get(patterns[0]);
+    assert cache.get(patterns[0].copy()) is entry;
+    G = np.array([[1 if pair[0:7] <= epoch < pair[8:15] else 0 for epoch in datestrs[:-1]]
+                  for pair in intf_tuple.date_pairs_julian[patterns[0]]]);
+    np.testing.assert_array_equal(entry.G, G);
+    np.testing.assert_allclose(entry.pinv, np.linalg.pinv(G), rtol=0, atol=1e-12);
+    cache.get(patterns[1]);
+    cache.get(patterns[2]);  # drops patterns[0], the least recently used
+    stats = cache.stats();
+    assert (stats['hits'], stats['misses'], stats['size'], stats['hit_rate']) == (1, 3, 2, 0.25);
+    assert not cache.get(~np.isnan(intf_tuple.zvalues[:, 2, 3])).connected;
+
+
+def test_resmoothing_matches_smoothing_in_nsbas(tmp_path):
+    # Re-smoothing an unsmoothed TS.nc gives the time series NSBAS would have given with that smoothing
+    intf_tuple, _ = make_stack();
+    _, xdates, _ = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    rwr.produce_output_timeseries(intf_tuple.xvalues, intf_tuple.yvalues, full_TS(intf_tuple), xdates, 'mm',
+                                  str(tmp_path / "TS.nc"));
+    nsbas_accessing.drive_resmooth_TS(str(tmp_path / "TS.nc"), 2.0, str(tmp_path / "TS_smoothed.nc"));
+    resmoothed = rwr.read_3D_netcdf(str(tmp_path / "TS_smoothed.nc"))[3];
+    np.testing.assert_allclose(resmoothed, full_TS(intf_tuple, 2.0), rtol=0, atol=1e-4);
+    # Older files only store days since the first acquisition; the re-smoothed file keeps those units
+    rwr.produce_output_timeseries(intf_tuple.xvalues, intf_tuple.yvalues, full_TS(intf_tuple), xdates, 'mm',
+                                  str(tmp_path / "TS_legacy.nc"), tunits='days');
+    nsbas_accessing.drive_resmooth_TS(str(tmp_path / "TS_legacy.nc"), 2.0, str(tmp_path / "TS_legacy_smoothed.nc"));
+    rootgrp = Dataset(str(tmp_path / "TS_legacy_smoothed.nc"), 'r');
+    assert rootgrp.variables['t'].units == 'days';
+    np.testing.assert_allclose(rootgrp.variables['z'][:], resmoothed, rtol=0, atol=1e-6);
+    rootgrp.close();
+
+
+def test_resmoothing_split_network_pixels(tmp_path):
+    # Pixel (2, 4) is orphaned at epoch 3 and pixel (5, 6) at the first epoch: they are re-smoothed
+    # over the epochs that were solved, with [I; smoothing * D] written out for those epochs only
+    intf_tuple, _ = make_stack();
+    datestrs, xdates, _ = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    for epoch, i, j in [(3, 2, 4), (0, 5, 6)]:
+        intf_tuple.zvalues[[k for k, pair in enumerate(intf_tuple.date_pairs_julian) if datestrs[epoch] in pair],
+                           i, j] = np.nan;
+    TS = full_TS(intf_tuple, split_disconnected=True);
+    rwr.produce_output_timeseries(intf_tuple.xvalues, intf_tuple.yvalues, TS, xdates, 'mm', str(tmp_path / "TS.nc"));
+    nsbas_accessing.drive_resmooth_TS(str(tmp_path / "TS.nc"), 2.0, str(tmp_path / "TS_smoothed.nc"));
+    resmoothed = rwr.read_3D_netcdf(str(tmp_path / "TS_smoothed.nc"))[3];
+    for epoch, i, j in [(3, 2, 4), (0, 5, 6)]:
+        solved = ~np.isnan(TS[:, i, j]);
+        assert not solved[epoch] and np.sum(solved) == len(datestrs) - 1;
+        n_solved = np.sum(solved);
+        D = np.eye(n_solved - 1, n_solved) - np.eye(n_solved - 1, n_solved, 1);
+        expected = np.linalg.lstsq(np.vstack((np.eye(n_solved), 2.0 * D)),
+                                   np.concatenate((TS[solved, i, j], np.zeros(n_solved - 1))), rcond=None)[0];
+        np.testing.assert_allclose(resmoothed[solved, i, j], expected - expected[0], rtol=0, atol=1e-4);
+        assert np.isnan(resmoothed[epoch, i, j]);
+    complete = ~np.isnan(TS).any(axis=0);
+    np.testing.assert_allclose(resmoothed[:, complete], full_TS(intf_tuple, 2.0, split_disconnected=True)[:, complete],
+                               rtol=0, atol=1e-4);
+
+
+def test_streamed_matches_in_memory(tmp_path):
+    intf_tuple, _ = make_stack();
+    _, xdates, _ = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    output_file = str(tmp_path / "TS.nc");
+    assert full_TS(intf_tuple, 2.0, output_file=output_file) is None;
+    tdata, _, _, streamed = rwr.read_3D_netcdf(output_file);
+    assert streamed.dtype == np.float32;
+    np.testing.assert_array_equal(tdata, [(x - xdates[0]).days for x in xdates]);
+    np.testing.assert_allclose(streamed, full_TS(intf_tuple, 2.0), rtol=0, atol=1e-4);
+
+
+def test_velocities_match_polyfit():
+    rng = np.random.default_rng(1);
+    x_axis_days = np.cumsum(rng.integers(6, 30, 12)) - 6;
+    TS = rng.normal(size=(12, 4, 5)) + rng.normal(size=(4, 5)) * x_axis_days[:, np.newaxis, np.newaxis] / 100.0;
+    TS[rng.random(np.shape(TS)) < 0.2] = np.nan;
+    TS[:, 0, 0] = np.nan;
+    TS[2:, 0, 1] = np.nan;  # two epochs: a velocity but no residual scatter
+    vel, intercept, rms, vel_sigma = nsbas_batched.velocities_from_TS_cube(TS, x_axis_days, max_nans=10,
+                                                                             full_output=True, tile_rows=3);
+    for i, j in np.ndindex(4, 5):
+        good = ~np.isnan(TS[:, i, j]);
+        if np.sum(good) < 2:
+            assert np.isnan(vel[i, j]);
+            continue;
+        fit, cov = np.polyfit(x_axis_days[good], TS[good, i, j], 1, cov='unscaled');
+        residuals = TS[good, i, j] - np.polyval(fit, x_axis_days[good]);
+        np.testing.assert_allclose([vel[i, j], intercept[i, j], rms[i, j]],
+                                   [fit[0] * 365.24, fit[1], np.sqrt(np.mean(residuals ** 2))], rtol=1e-10, atol=1e-10);
+        if np.sum(good) > 2:
+            sigma = np.sqrt(cov[0, 0] * np.sum(residuals ** 2) / (np.sum(good) - 2)) * 365.24;
+            np.testing.assert_allclose(vel_sigma[i, j], sigma, rtol=1e-10);
+    complete = nsbas_batched.velocities_from_TS_cube(TS, x_axis_days);
+    assert np.all(np.isnan(complete[np.isnan(TS).any(axis=0)]));
+
+
+def test_resume_matches_full_run(tmp_path, monkeypatch):
+    intf_tuple, _ = make_stack();
+    _, xdates, _ = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    output_file = str(tmp_path / "TS.nc");
+
+    def run():
+        return TS_cube(intf_tuple, 2.0, tile_rows=5, output_file=output_file, xdates=xdates, resume=True);
+
+    solve_tile = nsbas_batched.compute_TS_tile;
+    solved = [];
+
+    def killed_after_two_blocks(*args, **kwargs):
+        if len(solved) == 2:
+            raise KeyboardInterrupt;
+        solved.append(args[1]);
+        return solve_tile(*args, **kwargs);
+
+    monkeypatch.setattr(nsbas_batched, 'compute_TS_tile', killed_after_two_blocks);
+    with pytest.raises(KeyboardInterrupt):
+        run();
+
+    def counted(*args, **kwargs):
+        solved.append(args[1]);
+        return solve_tile(*args, **kwargs);
+
+    solved = [];
+    monkeypatch.setattr(nsbas_batched, 'compute_TS_tile', counted);
+    run();
+    assert [rows.start for rows in solved] == [10, 15];  # only the blocks that were not finished
+    resumed = rwr.read_3D_netcdf(output_file)[3];
+    np.testing.assert_allclose(resumed, full_TS(intf_tuple, 2.0), rtol=0, atol=1e-4);
+
+
+def test_resume_starts_over_when_inputs_change(tmp_path, monkeypatch):
+    # The signal spread, the coherence files and the baseline table are part of the run signature
+    intf_tuple, coh_tuple = make_stack();
+    datestrs, xdates, _ = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    coh_files = [tmp_path / ("coh_%d.grd" % k) for k in range(len(intf_tuple.filepaths))];
+    for coh_file in coh_files:
+        coh_file.touch();
+    coh_tuple = coh_tuple._replace(filepaths=np.array([str(coh_file) for coh_file in coh_files]));
+    baseline_file = write_baseline_table(tmp_path / "baseline_table.dat", xdates,
+                                         np.linspace(-50, 50, len(xdates)));
+    spread = signal_spread(intf_tuple);
+    output_file = str(tmp_path / "TS.nc");
+    solve_tile = nsbas_batched.compute_TS_tile;
+    solved = [];
+
+    def counted(*args, **kwargs):
+        solved.append(args[1]);
+        return solve_tile(*args, **kwargs);
+
+    def run():
+        solved.clear();
+        nsbas_batched.compute_TS_cube(intf_tuple, 50, 0, WAVELENGTH, 0, 0, spread, datestrs,
+                                      baseline_file=str(baseline_file), coh_tuple=coh_tuple, tile_rows=5,
+                                      output_file=output_file, xdates=xdates, resume=True);
+        return len(solved);
+
+    def touch(filename):
+        os.utime(filename, ns=(os.stat(filename).st_atime_ns, os.stat(filename).st_mtime_ns + 10**9));
+
+    monkeypatch.setattr(nsbas_batched, 'compute_TS_tile', counted);
+    assert run() == 4;
+    assert run() == 0;  # nothing changed: every block is already done
+    spread = spread.copy();
+    spread[3, 4] = 90.0;
+    assert run() == 4;
+    touch(coh_files[5]);
+    assert run() == 4;
+    touch(baseline_file);
+    assert run() == 4;
+    assert run() == 0;
+
+
+@pytest.mark.parametrize("smoothing, workers", [(0, 1), (2.0, 2)])
+def test_incremental_matches_full_run(tmp_path, smoothing, workers):
+    intf_tuple, _ = make_stack();
+    second_dates = np.array([pair[8:15] for pair in intf_tuple.date_pairs_julian]);
+    old = second_dates <= sorted(set(second_dates))[5];
+    TS_file, state_file = str(tmp_path / "TS.nc"), str(tmp_path / "TS_state.nc");
+    # with workers, each worker builds the state of its blocks from the read it solves
+    full_TS(select_intfs(intf_tuple, old), smoothing, output_file=TS_file, state_file=state_file, workers=workers);
+    new = ~old;
+    new[0] = True;  # already in the state, and ignored
+    nsbas_incremental.update_TS(select_intfs(intf_tuple, new), 50, smoothing, WAVELENGTH,
+                                signal_spread(intf_tuple), TS_file, state_file, tile_rows=7);
+    updated = rwr.read_3D_netcdf(TS_file)[3];
+    np.testing.assert_allclose(updated, full_TS(intf_tuple, smoothing), rtol=0, atol=1e-4);
+
+
+def test_split_network_velocities_fit_the_solved_epochs():
+    # Pixel (2, 3) is split into two components; pixel (2, 4) also has an orphaned epoch.
+    intf_tuple, _ = make_stack();
+    datestrs, _, x_axis_days = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    orphaned = [k for k, pair in enumerate(intf_tuple.date_pairs_julian) if datestrs[3] in pair];
+    intf_tuple.zvalues[orphaned, 2, 4] = np.nan;
+    TS = full_TS(intf_tuple, split_disconnected=True);
+    vel = velocities(intf_tuple, split_disconnected=True);
+    assert np.isnan(TS[3, 2, 4]);
+    for i, j in [(2, 3), (2, 4)]:
+        solved = ~np.isnan(TS[:, i, j]);
+        expected = np.polyfit(np.array(x_axis_days)[solved], TS[solved, i, j], 1)[0] * 365.24;
+        np.testing.assert_allclose(vel[i, j], expected, rtol=1e-10);
+    connected = velocities(intf_tuple);
+    assert np.all(np.isnan(connected[2, 3:5]));
+    np.testing.assert_array_equal(vel[~np.isnan(connected)], connected[~np.isnan(connected)]);
+
+
+def write_baseline_table(baseline_file, dates, baselines):
+    # GMTSAR days start at 0 on January 1
+    baseline_file.write_text("".join(["S1_%s_ALL_F1 %d.5 0 0 %f\n" % (x.strftime("%Y%m%d"),
+                                                                      int(x.strftime("%Y%j")) - 1, b)
+                                      for x, b in zip(dates, baselines)]));
+    return baseline_file;
+
+
+def test_dem_error_correction_recovers_baseline_term(tmp_path):
+    # A linear time series plus K_z_error times the baseline history: driver_cube removes exactly the baseline term
+    rng = np.random.default_rng(2);
+    dates = [dt.datetime(2016, 1, 5) + dt.timedelta(days=12 * k) for k in range(10)];
+    baselines = np.concatenate(([0], rng.normal(0, 100, 9)));
+    baseline_file = write_baseline_table(tmp_path / "baseline_table.dat", dates, baselines);
+    datestrs = [x.strftime("%Y%j") for x in dates];
+    days = np.array([(x - dates[0]).days for x in dates], dtype=float)[:, np.newaxis, np.newaxis];
+    linear = rng.normal(size=(5, 4)) * days / 365.24;
+    K_true = rng.normal(size=(5, 4)) / 100.0;
+    TS = linear + K_true * baselines[:, np.newaxis, np.newaxis];
+    TS[4, 1, 2] = np.nan;
+    corrected, K_z_error = dem_error_correction.driver_cube(TS, datestrs, str(baseline_file));
+    good = ~np.isnan(TS).any(axis=0);
+    assert np.isnan(K_z_error[1, 2]) and np.array_equal(np.isnan(corrected), np.isnan(TS));
+    np.testing.assert_allclose(K_z_error[good], K_true[good], rtol=0, atol=1e-8);
+    np.testing.assert_allclose(corrected[:, good], linear[:, good], rtol=0, atol=1e-8);
+    np.testing.assert_allclose(dem_error_correction.driver(TS[:, 3, 3], datestrs, str(baseline_file)),
+                               corrected[:, 3, 3], rtol=0, atol=1e-12);
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_uncertainty_matches_propagated_covariance(weighted):
+    # The increments have covariance sigma0^2 (G^T W G)^-1 with sigma0^2 = r^T W r / (n_used - n_increments);
+    # the epochs are their cumulative sums, and the velocity is the least squares slope of the epochs.
+    intf_tuple, coh_tuple = make_stack();
+    coh_tuple = coh_tuple if weighted else None;
+    TS, ts_sigma, vel_sigma, outliers = solve_TS(intf_tuple, coh_tuple=coh_tuple, uncertainty=True);
+    assert outliers is None;
+    np.testing.assert_array_equal(TS, full_TS(intf_tuple, coh_tuple=coh_tuple));
+    datestrs, _, x_axis_days = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    n_epochs = len(datestrs);
+    G_all = np.array([[1.0 if pair[0:7] <= epoch < pair[8:15] else 0 for epoch in datestrs[:-1]]
+                      for pair in intf_tuple.date_pairs_julian]);
+    cumulative = np.tril(np.ones((n_epochs, n_epochs - 1)), -1);
+    x = np.array(x_axis_days) - np.mean(x_axis_days);
+    slope = x / np.sum(x * x) * 365.24;
+    zvalues = intf_tuple.zvalues - intf_tuple.zvalues[:, 0:1, 0:1];
+    for i, j in [(1, 1), (4, 7), (13, 2), (19, 14)]:
+        good = ~np.isnan(zvalues[:, i, j]);
+        G, d = G_all[good], zvalues[good, i, j];
+        W = np.diag(np.ones(len(d)) if coh_tuple is None else coh_tuple.zvalues[good, i, j] ** 2);
+        C = np.linalg.inv(G.T @ W @ G);
+        r = d - G @ (C @ G.T @ W @ d);
+        cov_epochs = (r @ W @ r) / (len(d) - (n_epochs - 1)) * cumulative @ C @ cumulative.T;
+        scale = WAVELENGTH / (4 * np.pi);
+        np.testing.assert_allclose(ts_sigma[:, i, j], np.sqrt(np.diag(cov_epochs)) * scale, rtol=1e-8, atol=1e-12);
+        np.testing.assert_allclose(vel_sigma[i, j], np.sqrt(slope @ cov_epochs @ slope) * scale, rtol=1e-8);
+    assert np.all(np.isnan(ts_sigma[:, 2, 3])) and np.isnan(vel_sigma[2, 3]);
+
+
+@pytest.mark.parametrize("sparse_method", ['normal', 'lsqr'])
+def test_sparse_matches_dense(sparse_method):
+    intf_tuple, _ = make_stack();
+    dense = full_TS(intf_tuple, 2.0);
+    sparse = full_TS(intf_tuple, 2.0, sparse_epochs=0, sparse_method=sparse_method);
+    np.testing.assert_allclose(sparse, dense, rtol=0, atol=1e-4);
+
+
+def test_profiler_merges_worker_reports(tmp_path):
+    # With workers, each process times its own blocks; the merged report counts the same work as a serial run
+    intf_tuple, _ = make_stack();
+    json_file = str(tmp_path / "profile.jsonl");
+    reports = [];
+    for workers in [1, 2]:
+        profiler = stacking_profiler.Profiler(interval=None, callback=reports.append, json_file=json_file,
+                                              verbose=False);
+        TS_cube(intf_tuple, tile_rows=5, workers=workers, profiler=profiler);
+    serial, parallel = reports;
+    assert serial['final'] and parallel['final'];
+    assert serial['pixels']['total'] == 20 * 15;
+    assert parallel['pixels'] == serial['pixels'];
+    for stage_name in ['read', 'group_patterns', 'solve', 'smoothing']:
+        assert parallel['stages'][stage_name]['calls'] == serial['stages'][stage_name]['calls'];
+    assert all(name.startswith('design_matrix/worker') for name in parallel['caches']);  # one cache per worker
+    lookups = [sum(stats['hits'] + stats['misses'] for stats in report['caches'].values()) for report in reports];
+    assert lookups[0] == lookups[1];
+    with open(json_file) as ifile:
+        assert len(ifile.readlines()) == 2;
+
+
+def test_stack_reference_window_and_gps():
+    intf_tuple, _ = make_stack();
+    # Referenced once up front and passed on with rowref=colref=None, as a pixel reference inside NSBAS
+    referenced = stack_reference.reference_stack(intf_tuple, 0, 0, in_place=False);
+    np.testing.assert_array_equal(full_TS(referenced, 2.0, None, None), full_TS(intf_tuple, 2.0));
+    # A window reference subtracts the nanmean of the box around the reference pixel
+    windowed = stack_reference.reference_stack(intf_tuple, 5, 0, window=1, in_place=False);
+    box_mean = np.nanmean(intf_tuple.zvalues[:, 4:7, 0:2], axis=(1, 2));
+    np.testing.assert_allclose(windowed.zvalues, intf_tuple.zvalues - box_mean[:, np.newaxis, np.newaxis],
+                               rtol=0, atol=1e-12);
+    # A GPS anchor makes the reference pixel move at the station's velocity, and shifts every velocity by it
+    anchored = stack_reference.reference_stack(intf_tuple, 0, 0, gps_los_velocity=3.0, wavelength=WAVELENGTH,
+                                               in_place=False);
+    shifted = velocities(anchored, 0, None, None) - velocities(referenced, 0, None, None);
+    np.testing.assert_allclose(shifted[~np.isnan(shifted)], 3.0, rtol=0, atol=1e-9);
+    assert np.sum(~np.isnan(shifted)) > 250;
+    assert not np.shares_memory(referenced.zvalues, intf_tuple.zvalues);
+
+
+def test_float32_matches_float64():
+    intf_tuple, _ = make_stack();
+    TS64 = full_TS(intf_tuple);
+    TS32 = full_TS(intf_tuple._replace(zvalues=intf_tuple.zvalues.astype(np.float32)));
+    assert TS32.dtype == np.float32;
+    np.testing.assert_allclose(TS32, TS64, rtol=0, atol=1e-3);
+
+
+@pytest.mark.parametrize("robust", ['huber', 'l1'])
+def test_robust_recovers_unwrapping_error(robust, tmp_path):
+    # One interferogram of pixel (7, 8) gets an unwrapping error of 2 pi
+    intf_tuple, _ = make_stack();
+    clean = full_TS(intf_tuple);
+    zvalues = intf_tuple.zvalues.copy();
+    unwrapping_error = np.where(~np.isnan(zvalues[:, 7, 8]))[0][4];
+    zvalues[unwrapping_error, 7, 8] = zvalues[unwrapping_error, 7, 8] + 2 * np.pi;
+    corrupted = intf_tuple._replace(zvalues=zvalues);
+    least_squares_error = np.max(np.abs(full_TS(corrupted)[:, 7, 8] - clean[:, 7, 8]));
+    TS, ts_sigma, _, outliers = solve_TS(corrupted, robust=robust);
+    assert ts_sigma is None;
+    assert np.max(np.abs(TS[:, 7, 8] - clean[:, 7, 8])) < 0.2 * least_squares_error;
+    assert outliers[7, 8] >= 1;
+    # A streamed run keeps the counts in the outliers variable of TS.nc
+    output_file = str(tmp_path / "TS.nc");
+    full_TS(corrupted, robust=robust, output_file=output_file);
+    rootgrp = Dataset(output_file, 'r');
+    np.testing.assert_array_equal(rootgrp.variables['outliers'][:, :].filled(np.nan), outliers);
+    rootgrp.close();
+
+
+@pytest.mark.skipif(shutil.which('gmt') is None, reason="the grid writers call gmt")
+def test_robust_outlier_file(tmp_path):
+    intf_tuple, _ = make_stack();
+    outlier_file = str(tmp_path / "outliers.grd");
+    outliers = solve_velocities(intf_tuple, robust='huber', outlier_file=outlier_file).outliers;
+    np.testing.assert_array_equal(rwr.read_netcdf4_xyz(outlier_file)[2], outliers);
@@ -0,0 +1,147 @@
+# Tests of the stack readers on a small GMTSAR-style stack written from the synthetic stack of
+# test_nsbas_equivalence: every reader must give back the values of the full eager read.
+# Run with: python -m pytest stacking_tools/Testing_code
+
+import numpy as np
+import os
+import pytest
+import netcdf_read_write as rwr
+import readmytupledata as rmd
+import nsbas
+import stack_cache
+import stack_reference
+from test_nsbas_equivalence import make_stack, full_TS, velocities
+
+
+def write_gmtsar_stack(intf_tuple, outdir):
+    # One YYYYDDD_YYYYDDD/unwrap.grd per interferogram (GMTSAR days start at 0 on January 1)
+    filepaths = [];
+    for pair, zvalues in zip(intf_tuple.date_pairs_julian, intf_tuple.zvalues):
+        folder = outdir / ("%d_%d" % (int(pair[0:7]) - 1, int(pair[8:15]) - 1));
+        folder.mkdir();
+        rwr.write_netcdf4(intf_tuple.xvalues, intf_tuple.yvalues, zvalues, str(folder / "unwrap.grd"));
+        filepaths.append(str(folder / "unwrap.grd"));
+    return filepaths;
+
+
+@pytest.fixture
+def stack(tmp_path):
+    # The synthetic interferograms and their grd files
+    intf_tuple, _ = make_stack();
+    return intf_tuple, write_gmtsar_stack(intf_tuple, tmp_path);
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_reader_matches_written_stack(stack, workers):
+    intf_tuple, filepaths = stack;
+    mydata = rmd.reader(filepaths, workers=workers);
+    np.testing.assert_array_equal(mydata.zvalues, intf_tuple.zvalues);  # in file order
+    single = rmd.reader(filepaths, dtype=np.float32, workers=workers).zvalues;
+    assert single.dtype == np.float32;
+    np.testing.assert_array_equal(single, intf_tuple.zvalues.astype(np.float32));
+    np.testing.assert_array_equal(mydata.date_pairs_julian, intf_tuple.date_pairs_julian);
+    np.testing.assert_allclose(mydata.date_deltas, intf_tuple.date_deltas, rtol=0, atol=1e-12);
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_reader_points_match_full_read(stack, workers):
+    intf_tuple, filepaths = stack;
+    rows, cols = [0, 5, 19], [0, 7, 14];
+    points = rmd.reader_points(filepaths, rows, cols, radius=1, workers=workers);
+    assert np.shape(points.zvalues) == (len(filepaths), 3, 3, 3);
+    padded = np.pad(intf_tuple.zvalues, ((0, 0), (1, 1), (1, 1)), constant_values=np.nan);
+    for k, (row, col) in enumerate(zip(rows, cols)):
+        np.testing.assert_array_equal(points.zvalues[:, k], padded[:, row:row + 3, col:col + 3]);
+    np.testing.assert_array_equal(points.date_pairs_julian, intf_tuple.date_pairs_julian);
+    np.testing.assert_array_equal(points.yvalues, intf_tuple.yvalues);
+
+
+def test_stack_cache_serves_and_invalidates(stack, tmp_path):
+    intf_tuple, filepaths = stack;
+    cache_dir = str(tmp_path / "stack_cache");
+    stack_cache.read_stack(filepaths, cache_dir);
+    cached = stack_cache.read_stack(filepaths, cache_dir);  # served from the cache
+    assert isinstance(cached.zvalues, np.memmap);
+    np.testing.assert_array_equal(cached.zvalues, intf_tuple.zvalues);
+    np.testing.assert_array_equal(cached.date_pairs_julian, intf_tuple.date_pairs_julian);
+    np.testing.assert_array_equal(full_TS(cached), full_TS(intf_tuple));
+    # Referencing in place changes the copy-on-write map, not the cache
+    stack_reference.reference_stack(cached, 5, 5);
+    np.testing.assert_array_equal(stack_cache.read_stack(filepaths, cache_dir).zvalues, intf_tuple.zvalues);
+    # A rewritten grid has a new mtime: the cache is rebuilt in place of the old one
+    changed = intf_tuple.zvalues.copy();
+    changed[3] = changed[3] + 1;
+    rwr.write_netcdf4(intf_tuple.xvalues, intf_tuple.yvalues, changed[3], filepaths[3]);
+    os.utime(filepaths[3], ns=(os.stat(filepaths[3]).st_atime_ns, os.stat(filepaths[3]).st_mtime_ns + 10**9));
+    rebuilt = stack_cache.read_stack(filepaths, cache_dir);
+    assert isinstance(rebuilt.zvalues, np.memmap);
+    np.testing.assert_array_equal(rebuilt.zvalues, changed);
+    assert len(os.listdir(cache_dir)) == 2;  # one cube and its manifest
+
+
+def test_pixel_layout_matches_image_layout(stack, tmp_path):
+    # Same values and indexing; each pixel's time series is contiguous in memory
+    intf_tuple, filepaths = stack;
+    cache_dir = str(tmp_path / "stack_cache");
+    for mydata in [rmd.reader(filepaths, layout='pixel'), rmd.to_pixel_major(intf_tuple),
+                   stack_cache.read_stack(filepaths, cache_dir, layout='pixel'),
+                   stack_cache.read_stack(filepaths, cache_dir, layout='pixel')]:
+        assert rmd.get_layout(mydata.zvalues) == 'pixel';
+        assert mydata.zvalues[:, 4, 5].flags['C_CONTIGUOUS'];
+        np.testing.assert_array_equal(mydata.zvalues, intf_tuple.zvalues);
+    np.testing.assert_array_equal(full_TS(rmd.to_pixel_major(intf_tuple), workers=2), full_TS(intf_tuple, workers=2));
+
+
+def test_lazy_stack_matches_eager(stack):
+    intf_tuple, filepaths = stack;
+    lazy = rmd.reader(filepaths, lazy=True);
+    assert isinstance(lazy.zvalues, rmd.LazyStack);
+    np.testing.assert_array_equal(lazy.zvalues[:, 3:7, :], intf_tuple.zvalues[:, 3:7, :]);
+    np.testing.assert_array_equal(lazy.zvalues[:, 4, 5], intf_tuple.zvalues[:, 4, 5]);
+    np.testing.assert_array_equal(np.asarray(lazy.zvalues), intf_tuple.zvalues);
+    expected = full_TS(intf_tuple);
+    np.testing.assert_array_equal(full_TS(lazy), expected);
+    np.testing.assert_array_equal(full_TS(lazy, workers=2), expected);  # each worker reads its own blocks
+    referenced = stack_reference.reference_stack(lazy, 0, 0);
+    np.testing.assert_array_equal(full_TS(referenced, 0, None, None), expected);
+    # the pixel-by-pixel loop also runs on a lazy stack
+    np.testing.assert_allclose(velocities(lazy, batched=False), velocities(intf_tuple), rtol=0, atol=1e-8);
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_window_bounds_and_decimate_pushdown(stack, tmp_path, lazy):
+    intf_tuple, filepaths = stack;
+    cropped = rmd.reader(filepaths, lazy=lazy, window=(2, 12, 3, 9), decimate=2);
+    np.testing.assert_array_equal(np.asarray(cropped.zvalues), intf_tuple.zvalues[:, 2:12:2, 3:9:2]);
+    np.testing.assert_array_equal(cropped.xvalues, intf_tuple.xvalues[3:9:2]);
+    np.testing.assert_array_equal(cropped.yvalues, intf_tuple.yvalues[2:12:2]);
+    np.testing.assert_array_equal(cropped.zvalues[:, 1:3, 2], intf_tuple.zvalues[:, 4:8:2, 7]);  # composed slices
+    # bounds are in the units of the axes (here x = column and y = row); with a window, the overlap is read
+    bounded = rmd.reader(filepaths, lazy=lazy, bounds=(4, 10, 1, 6));
+    np.testing.assert_array_equal(np.asarray(bounded.zvalues), intf_tuple.zvalues[:, 1:7, 4:11]);
+    both = rmd.reader(filepaths, lazy=lazy, window=(0, 4, 0, 6), bounds=(4, 10, 1, 6));
+    np.testing.assert_array_equal(np.asarray(both.zvalues), intf_tuple.zvalues[:, 1:4, 4:6]);
+    cache_dir = str(tmp_path / "stack_cache");
+    stack_cache.read_stack(filepaths, cache_dir, window=(2, 12, 3, 9), decimate=2);
+    cached = stack_cache.read_stack(filepaths, cache_dir, window=(2, 12, 3, 9), decimate=2);
+    assert isinstance(cached.zvalues, np.memmap);
+    np.testing.assert_array_equal(cached.zvalues, intf_tuple.zvalues[:, 2:12:2, 3:9:2]);
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_reader_ts_netcdf(tmp_path, lazy):
+    intf_tuple, _ = make_stack();
+    _, xdates, x_axis_days = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
+    TS_file = str(tmp_path / "TS.nc");
+    full_TS(intf_tuple, output_file=TS_file);
+    expected = full_TS(intf_tuple).astype(np.float32);
+    ts_tuple = rmd.reader_ts_netcdf(TS_file, lazy=lazy);
+    np.testing.assert_array_equal(ts_tuple.ts_dates, xdates);
+    assert isinstance(ts_tuple.zvalues, rmd.LazyTimeSeries) == lazy;
+    np.testing.assert_array_equal(np.asarray(ts_tuple.zvalues), expected);
+    np.testing.assert_array_equal(ts_tuple.zvalues[2:5, 4, :], expected[2:5, 4, :]);
+    np.testing.assert_allclose(nsbas.Velocities_from_TS(ts_tuple),
+                               nsbas.Velocities_from_TS(ts_tuple._replace(zvalues=expected)), rtol=0, atol=1e-4);
+    cropped = rmd.reader_ts_netcdf(TS_file, lazy=lazy, window=(2, 12, 3, 9), decimate=2);
+    np.testing.assert_array_equal(np.asarray(cropped.zvalues), expected[:, 2:12:2, 3:9:2]);
+    np.testing.assert_array_equal(cropped.xvalues, intf_tuple.xvalues[3:9:2]);
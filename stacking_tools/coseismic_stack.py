@@ -3,13 +3,16 @@
 
 import numpy as np
 import sys
-import readmytupledata as rmd
+import stack_reference
+import stack_cache
 import netcdf_read_write as rwr
 
 
-def drive_coseismic_stack_gmtsar(intf_files, wavelength, rowref, colref, outdir):
-    intf_tuple = rmd.reader(intf_files);
-    average_coseismic = get_avg_coseismic(intf_tuple, rowref, colref, wavelength);
+def drive_coseismic_stack_gmtsar(intf_files, wavelength, rowref, colref, outdir, ref_window=0, cache_dir=None):
+    # cache_dir: read the interferograms through the stack cache there (see stack_cache)
+    intf_tuple = stack_cache.read_stack(intf_files, cache_dir);
+    intf_tuple = stack_reference.reference_stack(intf_tuple, rowref, colref, ref_window);
+    average_coseismic = get_avg_coseismic(intf_tuple, None, None, wavelength);
     rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, average_coseismic, 'mm',
                               outdir + '/coseismic.grd');
     rwr.produce_output_plot(outdir + '/coseismic.grd', 'LOS Displacement', outdir + '/coseismic.png',
@@ -17,9 +20,10 @@ def drive_coseismic_stack_gmtsar(intf_files, wavelength, rowref, colref, outdir)
     return;
 
 
-def drive_coseismic_stack_isce(intf_files, wavelength, rowref, colref, outdir):
-    intf_tuple = rmd.reader_isce(intf_files);
-    average_coseismic = get_avg_coseismic(intf_tuple, rowref, colref, wavelength);
+def drive_coseismic_stack_isce(intf_files, wavelength, rowref, colref, outdir, ref_window=0, cache_dir=None):
+    intf_tuple = stack_cache.read_stack(intf_files, cache_dir, reader='isce');
+    intf_tuple = stack_reference.reference_stack(intf_tuple, rowref, colref, ref_window);
+    average_coseismic = get_avg_coseismic(intf_tuple, None, None, wavelength);
     rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, average_coseismic, 'mm',
                               outdir + '/coseismic.grd');
     rwr.produce_output_plot(outdir + '/coseismic.grd', 'LOS Displacement', outdir + '/coseismic.png',
@@ -29,11 +33,12 @@ def drive_coseismic_stack_isce(intf_files, wavelength, rowref, colref, outdir):
 
 
 def get_avg_coseismic(intf_tuple, rowref, colref, wavelength):
-    # I could send this into the iterator_func in NSBAS if I wanted to.
     # Negative sign matches the NSBAS code
-    disp = np.zeros(np.shape(intf_tuple.zvalues[0, :, :]));
-    for i in range(len(intf_tuple.yvalues)):
-        for j in range(len(intf_tuple.xvalues)):
-            pixel_value = np.subtract(intf_tuple.zvalues[:, i, j], intf_tuple.zvalues[:, rowref, colref]);
-            disp[i][j] = np.nanmean(pixel_value) * -wavelength / (4 * np.pi);
-    return disp;
+    # rowref, colref can be None if intf_tuple is already referenced (stack_reference).
+    zvalues = intf_tuple.zvalues;
+    if rowref is not None:
+        zvalues = np.subtract(zvalues, zvalues[:, rowref, colref][:, np.newaxis, np.newaxis]);
+    n_valid = np.sum(~np.isnan(zvalues), axis=0);
+    disp = np.full(np.shape(n_valid), np.nan);
+    disp[n_valid > 0] = np.nansum(zvalues, axis=0)[n_valid > 0] / n_valid[n_valid > 0];
+    return disp * -wavelength / (4 * np.pi);
@@ -5,42 +5,71 @@
 
 import numpy as np
 import datetime as dt
+import functools
 import sentinel_utilities
 
-def driver(ts_vector, datestrs, baseline_file):
-    # A function to implement Fattahi and Amelung's 2013 paper
-    # Right now, this assumes a linear velocity, although more complicated time histories can be implemented.
+
+@functools.lru_cache(maxsize=8)
+def read_baseline_history(baseline_file):
+    # The acquisition dates and baselines of the baseline table, in chronological order.
+    # Read and parsed once per baseline file; the arrays are shared between callers.
     # stems format: 'S1_20190105_ALL_F2'
     # times format: float years
     # xbaselines format: meters (first one 0 by definition)
-    # datestrs format: '2015134'
-
     [_, times, baselines, _] = sentinel_utilities.read_baseline_table(baseline_file);
     dtarray = [];
     for i in range(len(times)):
         dtarray.append(dt.datetime.strptime(str(int(times[i] + 1)), '%Y%j'));
 
     # Re-order times and baselines in chronological order
-    baselines = [x for _, x in sorted(zip(dtarray, baselines))];
-    dtarray = sorted(dtarray);
+    baselines = np.array([x for _, x in sorted(zip(dtarray, baselines))]);
+    dtarray = tuple(sorted(dtarray));
+    baselines.setflags(write=False);
+    return dtarray, baselines;
+
 
+def build_G(dtarray, baselines, n_TS):
     # design matrix: phase(t) = v(t-t0) + other terms + .... (4pi/lamda B(ti)/rsin(theta) z_error)
     # Baseline history: Bdot(i) = B(t_i)-B(t_i-t_i-1) / (t_i-t_i-1), i=[1-N]
     # velocity history: v(i) = phi(t_i)-phi(t_i-1)  / (t_i-t_i-1), i=[1-N]
     # The model we're solving for is [velocity, (4pi/lamda z_error/rsin(theta))].
     # I call that constant K_z_error
-    G = np.ones((len(datestrs)-1, 2))
-    v = np.zeros((len(datestrs)-1));
-    Bdot = np.zeros((len(datestrs)-1));
-    for i in range(0,len(datestrs)-1):
-        v[i] = (ts_vector[i+1] - ts_vector[i]) / (dtarray[i+1]-dtarray[i]).days / 365.24;
-        Bdot[i] = (baselines[i+1] - baselines[i]) / (dtarray[i+1]-dtarray[i]).days / 365.24;
-        G[i,1] = Bdot[i];
+    # The same G serves every pixel. Returns G and the scaling of each time interval.
+    interval = np.array([(dtarray[i+1]-dtarray[i]).days for i in range(n_TS-1)]) * 365.24;
+    G = np.ones((n_TS-1, 2));
+    G[:, 1] = np.diff(baselines[0:n_TS]) / interval;
+    return G, interval;
 
+
+def correct_block(TS, dtarray, baselines):
+    # TS: (n_TS, n_pixels) time series without nans. All pixels are solved in one least squares call.
+    # Returns the corrected time series and K_z_error for each pixel.
+    G, interval = build_G(dtarray, baselines, len(TS));
+    v = np.diff(TS, axis=0) / interval[:, np.newaxis];
     model = np.linalg.lstsq(G, v, rcond=0.001);  # rcond helps the solution converge
-    K_z_error = model[0][1]  # constant time z_error;
+    K_z_error = model[0][1, :];  # constant time z_error;
+    topo_phase = K_z_error[np.newaxis, :] * np.subtract(baselines, baselines[0])[:, np.newaxis];
+    return np.subtract(TS, topo_phase), K_z_error;
+
 
-    topo_phase = [K_z_error * (x-baselines[0]) for x in baselines];
+def driver_cube(TS, datestrs, baseline_file):
+    # DEM error correction of many pixels at once. TS is (n_TS, n_pixels) or (n_TS, ny, nx).
+    # Pixels with any nan are left alone and get a nan K_z_error.
+    # Returns the corrected time series and the K_z_error map (mm of correction per meter of baseline).
+    dtarray, baselines = read_baseline_history(baseline_file);
+    TS = np.array(TS, dtype=float);
+    corrected = np.reshape(TS, (len(datestrs), -1));
+    K_z_error = np.full((np.shape(corrected)[1],), np.nan);
+    good = ~np.isnan(corrected).any(axis=0);
+    corrected[:, good], K_z_error[good] = correct_block(corrected[:, good], dtarray, baselines);
+    return np.reshape(corrected, np.shape(TS)), np.reshape(K_z_error, np.shape(TS)[1:]);
 
-    corrected_ts_vector = np.subtract(ts_vector,topo_phase);
-    return corrected_ts_vector;
\ No newline at end of file
+
+def driver(ts_vector, datestrs, baseline_file):
+    # A function to implement Fattahi and Amelung's 2013 paper
+    # Right now, this assumes a linear velocity, although more complicated time histories can be implemented.
+    # datestrs format: '2015134'
+    dtarray, baselines = read_baseline_history(baseline_file);
+    corrected_ts_vector, _ = correct_block(np.reshape(np.array(ts_vector, dtype=float), (-1, 1)), dtarray,
+                                           baselines);
+    return corrected_ts_vector[:, 0];
@@ -3,10 +3,12 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import sys
-import math
 import datetime as dt
-import stacking_utilities
 import dem_error_correction
+import nsbas_batched
+import stacking_profiler
+import stack_reference
+import netcdf_read_write as rwr
 
 
 # ------------ UTILITY FUNCTIONS ------------ #
@@ -31,132 +33,215 @@ def get_TS_dates(date_julstrings):
 # make an NSBAS matrix describing each image that's a real number (not nan).
 
 def Velocities(intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data,
-               baseline_file=None, coh_tuple=None):
+               baseline_file=None, coh_tuple=None, batched=True, workers=1, split_disconnected=False,
+               uncertainty=False, sparse_epochs=nsbas_batched.SPARSE_EPOCHS, sparse_method='normal', profiler=None,
+               robust=None, robust_iterations=nsbas_batched.ROBUST_ITERATIONS, outlier_file=None,
+               tile_rows=nsbas_batched.TILE_ROWS):
     # This is how you access velocity solutions from NSBAS - solve the TS first, then package velocities
-    retval = np.zeros([len(intf_tuple.yvalues), len(intf_tuple.xvalues)]);
+    # rowref, colref: the reference pixel, or None if intf_tuple is already referenced (see stack_reference).
+    # batched=True solves groups of pixels together (nsbas_batched); batched=False loops pixel by pixel.
+    # workers > 1 spreads blocks of tile_rows rows over that many processes (batched only).
+    # split_disconnected solves disconnected networks one component at a time (batched only).
+    #   The velocity of such a pixel is fit to the epochs that were solved, leaving out its orphaned epochs.
+    # uncertainty also computes the formal 1-sigma velocity uncertainty in mm/yr (batched only).
+    # robust ('huber' or 'l1') down-weights outlier interferograms, such as unwrapping errors, by iteratively
+    # reweighted least squares (batched only). The number of outliers of each pixel is also kept, and
+    # written to outlier_file if given.
+    # Returns an nsbas_batched.velocity_results (vel, vel_sigma, outliers); what was not asked for is None.
+    # Stacks with more than sparse_epochs epochs use sparse design matrices, solved by sparse_method
+    # ('normal' or 'lsqr').
+    # profiler: a stacking_profiler.Profiler that reports stage timings, throughput and cache hit rates.
+    # Velocities come back in the precision of intf_tuple.zvalues (see readmytupledata.reader dtype).
+    retval = np.zeros([len(intf_tuple.yvalues), len(intf_tuple.xvalues)],
+                      dtype=nsbas_batched.get_stack_dtype(intf_tuple.zvalues));
     datestrs, x_dts, x_axis_days = get_TS_dates(intf_tuple.date_pairs_julian);
 
+    if batched:
+        # Only one block of rows of the time series is kept at a time.
+        # Solved pixels have no nans, except the orphaned epochs of split networks.
+        max_nans = len(datestrs) - 2 if split_disconnected else 0;
+        vel_sigma = np.full(np.shape(retval), np.nan, dtype=retval.dtype);
+        outliers = np.full(np.shape(retval), np.nan, dtype=retval.dtype);
+        for rows, ts_tile, extras in nsbas_batched.iterate_TS_tiles(intf_tuple, nsbas_good_perc, smoothing,
+                                                                    wavelength, rowref, colref, signal_spread_data,
+                                                                    datestrs, baseline_file=baseline_file,
+                                                                    coh_tuple=coh_tuple, tile_rows=tile_rows,
+                                                                    workers=workers,
+                                                                    split_disconnected=split_disconnected,
+                                                                    uncertainty=uncertainty,
+                                                                    sparse_epochs=sparse_epochs,
+                                                                    sparse_method=sparse_method,
+                                                                    profiler=profiler, robust=robust,
+                                                                    robust_iterations=robust_iterations):
+            with stacking_profiler.stage(profiler, 'velocity_fit'):
+                retval[rows, :] = nsbas_batched.velocities_from_TS_cube(ts_tile, x_axis_days, max_nans=max_nans);
+            if uncertainty:
+                vel_sigma[rows, :] = extras['vel_sigma'];
+            if robust is not None:
+                outliers[rows, :] = extras['outliers'];
+        if outlier_file is not None and robust is not None:
+            rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, outliers, 'count', outlier_file);
+        return nsbas_batched.velocity_results(vel=retval, vel_sigma=vel_sigma if uncertainty else None,
+                                              outliers=outliers if robust is not None else None);
+    nsbas_batched.check_input_shapes(intf_tuple, signal_spread_data, coh_tuple);
+    if rowref is not None:  # reference a copy of the stack once, rather than once per pixel
+        intf_tuple = stack_reference.reference_stack(intf_tuple, rowref, colref, in_place=False);
+        rowref, colref = None, None;
+    design_cache = nsbas_batched.DesignMatrixCache(intf_tuple.date_pairs_julian, datestrs,
+                                                   sparse_epochs=sparse_epochs, sparse_method=sparse_method);
+    if profiler is not None:
+        profiler.watch_cache('design_matrix', design_cache);
+
     def packager_function(i, j, intf_tuple):
         # Giving access to all these variables
         return compute_vel(i, j, intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data,
-                           datestrs, x_axis_days, baseline_file, coh_tuple);
+                           datestrs, x_axis_days, baseline_file, coh_tuple, design_cache);
 
-    retval = iterator_func(intf_tuple, packager_function, retval);
-    return retval
+    retval = iterator_func(intf_tuple, packager_function, retval, profiler=profiler);
+    return nsbas_batched.velocity_results(vel=retval, vel_sigma=None, outliers=None);
 
 
 def Full_TS(intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data, start_index=0,
-            end_index=10e6, baseline_file=None, coh_tuple=None):
+            end_index=10e6, baseline_file=None, coh_tuple=None, batched=True, workers=1, output_file=None,
+            zlib=False, resume=False, state_file=None, split_disconnected=False, dem_error_file=None,
+            uncertainty=False, sparse_epochs=nsbas_batched.SPARSE_EPOCHS, sparse_method='normal', profiler=None,
+            robust=None, robust_iterations=nsbas_batched.ROBUST_ITERATIONS, outlier_file=None,
+            tile_rows=nsbas_batched.TILE_ROWS):
     # This is how you access Time Series solutions from NSBAS
+    # rowref, colref: the reference pixel, or None if intf_tuple is already referenced (see stack_reference).
+    # Returns an nsbas_batched.ts_results (TS, ts_sigma, vel_sigma, outliers); what was not asked for is None.
+    # batched=True solves with nsbas_batched, using workers processes; TS is a (n_epochs, ny, nx) array.
+    #   Pixels are solved in blocks of tile_rows rows, which are also the chunks of output_file.
+    #   With output_file, each solved block is streamed into a chunked float32 NetCDF4 (t, y, x) file instead,
+    #   optionally zlib-compressed, and None is returned.
+    #   With output_file and resume=True, blocks finished by an earlier run with the same inputs are skipped.
+    #   With output_file and state_file (unweighted only), the normal equations are saved for nsbas_incremental.
+    #   With split_disconnected, pixels with disconnected networks are solved one component at a time
+    #   instead of returning nans; their orphaned epochs are still nans.
+    #   With a baseline_file, the K_z_error map of the DEM error correction is written to dem_error_file.
+    #   With uncertainty, the formal 1-sigma of every epoch (mm) and of the velocity (mm/yr) are also returned
+    #   in ts_sigma and vel_sigma, or written to the z_sigma and vel_sigma variables of output_file.
+    #   With robust ('huber' or 'l1'), outlier interferograms are down-weighted by iteratively reweighted
+    #   least squares. The number of outliers of each pixel is returned in outliers, or written to the outliers
+    #   variable of output_file, and to outlier_file if given.
+    # Stacks with more than sparse_epochs epochs use sparse design matrices, solved by sparse_method
+    # ('normal' or 'lsqr').
+    # profiler: a stacking_profiler.Profiler that reports stage timings, throughput and cache hit rates.
+    # batched=False loops pixel by pixel. TS is then not an array but the old list of rows, each a list of
+    # [ts_vector] (so TS[j][i][0] is the time series of pixel (j, i)), and the by-products are None.
     datestrs, x_dts, _ = get_TS_dates(intf_tuple.date_pairs_julian);
+
+    if batched:
+        return nsbas_batched.compute_TS_cube(intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref,
+                                             signal_spread_data, datestrs, start_index=start_index,
+                                             end_index=end_index, baseline_file=baseline_file, coh_tuple=coh_tuple,
+                                             tile_rows=tile_rows, workers=workers, output_file=output_file,
+                                             xdates=x_dts, zlib=zlib, resume=resume, state_file=state_file,
+                                             split_disconnected=split_disconnected, dem_error_file=dem_error_file,
+                                             uncertainty=uncertainty, sparse_epochs=sparse_epochs,
+                                             sparse_method=sparse_method, profiler=profiler, robust=robust,
+                                             robust_iterations=robust_iterations, outlier_file=outlier_file);
+
     # Establishing the return array
     empty_vector = [np.empty(np.shape(datestrs))];
     retval = [[empty_vector for i in range(len(intf_tuple.xvalues))] for j in range(len(intf_tuple.yvalues))];
+    nsbas_batched.check_input_shapes(intf_tuple, signal_spread_data, coh_tuple);
+    if rowref is not None:  # reference a copy of the stack once, rather than once per pixel
+        intf_tuple = stack_reference.reference_stack(intf_tuple, rowref, colref, in_place=False);
+        rowref, colref = None, None;
+    design_cache = nsbas_batched.DesignMatrixCache(intf_tuple.date_pairs_julian, datestrs,
+                                                   sparse_epochs=sparse_epochs, sparse_method=sparse_method);
+    if profiler is not None:
+        profiler.watch_cache('design_matrix', design_cache);
 
     def packager_function(i, j, intf_tuple):
         # Giving access to all these variables.
         return compute_TS(i, j, intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data,
-                          datestrs, baseline_file, coh_tuple);
+                          datestrs, baseline_file, coh_tuple, design_cache);
 
-    retval = iterator_func(intf_tuple, packager_function, retval, start_index, end_index);
-    return retval;
+    retval = iterator_func(intf_tuple, packager_function, retval, start_index, end_index, profiler=profiler);
+    return nsbas_batched.ts_results(TS=retval, ts_sigma=None, vel_sigma=None, outliers=None);
 
 
-def Velocities_from_TS(ts_tuple):
+def Velocities_from_TS(ts_tuple, full_output=False):
     # The easy function to take a timeseries saved on disk and construct velocities
-    # This one doesn't have a memory leak.
-    retval = np.zeros([len(ts_tuple.yvalues), len(ts_tuple.xvalues)]);
+    # All pixels are fit at once by nsbas_batched.velocities_from_TS_cube; pixels with more than 30 nans get nan.
+    # With full_output, also returns intercept, residual RMS and velocity uncertainty grids.
     x_axis_days = [(i - ts_tuple.ts_dates[0]).days for i in ts_tuple.ts_dates];
+    return nsbas_batched.velocities_from_TS_cube(ts_tuple.zvalues, x_axis_days, max_nans=30,
+                                                 full_output=full_output);
 
-    def packager_function(i, j, ts_tuple):
-        return compute_velocity_from_ts(i, j, ts_tuple, x_axis_days);
 
-    retval = iterator_func(ts_tuple, packager_function, retval);
-    return retval;
-
-
-def iterator_func(intf_tuple, func, retval, start_index=0, end_index=None):
+def iterator_func(intf_tuple, func, retval, start_index=0, end_index=None, profiler=None):
     # This iterator performs a for loop. It assumes the return value can be stored in an array of ixj
+    # profiler: a stacking_profiler.Profiler that times each pixel and counts inverted and skipped pixels.
     print("Performing NSBAS on %d files" % (len(intf_tuple.zvalues)));
     print("Started at: ");
     print(dt.datetime.now());
     previous_time = dt.datetime.now();
-    c = 0;
     true_count = 1;
+    ny, nx = len(intf_tuple.yvalues), len(intf_tuple.xvalues);
     if end_index is None:
-        end_index = len(intf_tuple.yvalues) * len(intf_tuple.xvalues);
-    it = np.nditer(intf_tuple.zvalues[0, :, :], flags=['multi_index'],
-                   order='F');  # iterate through the 3D array of data
-    while not it.finished:
-        i = it.multi_index[0];
-        j = it.multi_index[1];
-        if c >= start_index:
-            if c == end_index:
-                break;
+        end_index = ny * nx;
+    for i, j in np.ndindex(ny, nx):  # row by row through the data, so lazy stacks read each block of rows once
+        c = j * ny + i;  # start_index and end_index count pixels in column-major order
+        if c < start_index or c >= end_index:
+            continue;
+        with stacking_profiler.stage(profiler, 'pixel'):
             retval[i][j], nanflag = func(i, j, intf_tuple);
-            if np.mod(c, 10000) == 0:
-                print('Done with ' + str(c) + ' out of ' + str(
-                    len(intf_tuple.xvalues) * len(intf_tuple.yvalues)) + ' pixels')
-            if not nanflag:
-                true_count = true_count + 1;  # how many pixels were actually inverted?
-            if np.mod(true_count, 10000) == 0:
-                current_time = dt.datetime.now();
-                delta = current_time - previous_time;
-                print("--> 10K inversions took: %.2f s" % delta.total_seconds());
-                previous_time = current_time;
-        # if c==60000:
-        # 	break;
-        c = c + 1;
-        it.iternext();
+        if profiler is not None:
+            profiler.add_pixels(not nanflag, nanflag);
+            profiler.maybe_emit();
+        if np.mod(i * nx + j, 10000) == 0:
+            print('Done with ' + str(i * nx + j) + ' out of ' + str(ny * nx) + ' pixels')
+        if not nanflag:
+            true_count = true_count + 1;  # how many pixels were actually inverted?
+        if np.mod(true_count, 10000) == 0:
+            current_time = dt.datetime.now();
+            delta = current_time - previous_time;
+            print("--> 10K inversions took: %.2f s" % delta.total_seconds());
+            previous_time = current_time;
     print("Finished at: ");
     print(dt.datetime.now());
+    if profiler is not None:
+        profiler.emit(final=True);
     return retval;
 
 
 # ---------- LOWER LEVEL COMPUTE FUNCTIONS ---------- #
 
 def compute_vel(i, j, intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data, datestrs,
-                x_axis_days, baseline_file=None, coh_tuple=None):
+                x_axis_days, baseline_file=None, coh_tuple=None, design_cache=None):
     TS, nanflag = compute_TS(i, j, intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref,
-                             signal_spread_data, datestrs, baseline_file=baseline_file, coh_tuple=coh_tuple);
+                             signal_spread_data, datestrs, baseline_file=baseline_file, coh_tuple=coh_tuple,
+                             design_cache=design_cache);
     if nanflag:
         vel = np.nan;
     else:
-        vel = compute_velocity_math(TS, x_axis_days);
+        vel = compute_velocity_math(TS[0], x_axis_days);  # TS is [ts_vector]
     return vel, nanflag;
 
 
 def compute_TS(i, j, intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data, datestrs,
-               baseline_file=None, coh_tuple=None):
+               baseline_file=None, coh_tuple=None, design_cache=None):
     # For a given pixel, what are the SBAS time series?
     # Returns TS in mm
-    # Defensive programming
-    if np.shape(intf_tuple.zvalues[0]) != np.shape(signal_spread_data):
-        print("ERROR: signal spread does not match input data. Stopping immediately. ");
-        print("Shape of signal spread:", np.shape(signal_spread_data));
-        print("Shape of data array:", np.shape(intf_tuple.zvalues[0]));
-        sys.exit(1);
-    if coh_tuple is not None:
-        if np.shape(intf_tuple.zvalues[0]) != np.shape(coh_tuple.zvalues[0]):
-            print("ERROR: coherence data does not match input data. Stopping immediately. ");
-            print("Shape of coherence data:", np.shape(coh_tuple.zvalues[0]));
-            print("Shape of data array:", np.shape(intf_tuple.zvalues[0]));
-            sys.exit(1);     
+    # The shapes of the inputs are checked once per run (nsbas_batched.check_input_shapes), not per pixel.
 
     empty_vector = np.empty(np.shape(datestrs));  # Length of the TS model
     empty_vector[:] = np.nan;
     signal_spread = signal_spread_data[i, j];
     pixel_value = intf_tuple.zvalues[:, i, j];
-    reference_pixel_value = intf_tuple.zvalues[:, rowref, colref];
     if coh_tuple is None:
         coh_value = None;
     else:
         coh_value = coh_tuple.zvalues[:, i, j];
     if signal_spread > nsbas_good_perc and sum(np.isnan(pixel_value)) < len(pixel_value) * 0.5:  
         # Defensive programming for degenerate cases (happened on coastlines where the water was just coherent enough)
-        pixel_value = np.subtract(pixel_value, reference_pixel_value);  # with respect to the reference pixel.
+        if rowref is not None:  # rowref=colref=None: intf_tuple is already referenced (stack_reference)
+            pixel_value = np.subtract(pixel_value, intf_tuple.zvalues[:, rowref, colref]);
         ts_vector = do_nsbas_pixel(pixel_value, intf_tuple.date_pairs_julian, smoothing, wavelength, datestrs,
-                                   coh_value=coh_value);
+                                   coh_value=coh_value, design_cache=design_cache);
         if baseline_file is not None:  # If we are implementing a DEM error correction
             ts_vector = dem_error_correction.driver(ts_vector, datestrs, baseline_file);
         TS = [ts_vector];
@@ -183,58 +268,46 @@ def compute_velocity_math(TS, x_axis_days):
     return vel;
 
 
-def do_nsbas_pixel(pixel_value, date_pairs, smoothing, wavelength, datestrs, coh_value=None):
+def do_nsbas_pixel(pixel_value, date_pairs, smoothing, wavelength, datestrs, coh_value=None, design_cache=None):
     # pixel_value: if we have 62 intf, this is a (62,) array of the phase values in each interferogram
     # date_pairs: if we have 62 intf, this is a (62) list with the image pairs used in each image,
     #   format 2015157_2018177 (real julian day)
     # datestrs: a list of the dates we want to invert on, in format 2015157
     # This solves Gm = d for the movement of the pixel with smoothing.
     # If coh_value is an array, we do weighted least squares
+    # design_cache: an nsbas_batched.DesignMatrixCache built from the same date_pairs and datestrs.
+    #   Pass one in when looping over many pixels, so that G is only built once per pattern of nans.
     # This function expects the values in the preferred reference system (i.e. reference pixel already implemented).
     empty_vector = np.empty(np.shape(datestrs));  # Length of the TS model
     empty_vector[:] = np.nan;
+    if design_cache is None:
+        design_cache = nsbas_batched.DesignMatrixCache(date_pairs, datestrs, maxsize=1);
 
-    d = np.array([]);
-    diagonals = [];
-    date_pairs_used = [];
-
-    for i in range(len(pixel_value)):
-        if not math.isnan(pixel_value[i]):
-            d = np.append(d, pixel_value[i]);  # removes the nans from the computation.
-            date_pairs_used.append(date_pairs[i]);
-            # might be a slightly shorter array of which interferograms actually got used.
-            if coh_value is not None:
-                diagonals.append(np.power(coh_value[i], 2));  # using coherence squared as the weighting.
-            else:
-                diagonals.append(1);
-    model_num = len(datestrs) - 1;
-    # The weighting vector
-    W = np.diag(diagonals);
+    pixel_value = np.array(pixel_value, dtype=float);
+    used = ~np.isnan(pixel_value);  # removes the nans from the computation.
+    d = pixel_value[used];
 
     # More defensive programming for degenerate cases like disconnected networks
-    cc_num = stacking_utilities.connected_components_search(date_pairs_used, datestrs);
-    if cc_num != 1:
+    design = design_cache.get(used);
+    if not design.connected:
         print("SINGULAR MATRIX ENCOUNTERED. RETURNING VECTOR OF NANS.");
         return empty_vector;
-
-    # building G matrix line by line.
-    G = np.zeros([len(date_pairs_used), model_num]);
-    for i in range(len(d)):
-        ith_intf = date_pairs_used[i];
-        first_image = ith_intf.split('_')[0];  # in format '2017082'
-        second_image = ith_intf.split('_')[1];  # in format '2017094'
-        first_index = datestrs.index(first_image);
-        second_index = datestrs.index(second_image);
-        for j in range(second_index - first_index):
-            G[i][first_index + j] = 1;
+    G = design.G;
 
     # solving the SBAS linear least squares equation for displacement between each epoch.
-    if coh_value is not None:
+    if design.factor is not None:  # long stacks: G is sparse
+        w = None;
+        if coh_value is not None:
+            w = np.power(np.array(coh_value, dtype=float)[used], 2)[:, np.newaxis];
+        m = nsbas_batched.solve_sparse_group(design, d[:, np.newaxis], w, design_cache.sparse_method)[:, 0];
+    elif coh_value is not None:
+        diagonals = np.power(np.array(coh_value, dtype=float)[used], 2);  # using coherence squared as the weighting.
+        W = np.diag(diagonals);
         GTWG = np.dot(np.transpose(G), np.dot(W, G))
         GTWd = np.dot(np.transpose(G), np.dot(W, d))
         m = np.dot(np.linalg.inv(GTWG), GTWd)
     else:
-        m = np.linalg.lstsq(G, d, rcond=None)[0];  # rcond=None comes from futurewarning
+        m = np.dot(design.pinv, d);  # least squares solution from the cached pseudo-inverse
 
     # modeled_data=np.dot(G,m);
     # plt.figure();
@@ -267,22 +340,9 @@ def temporal_smoothing_ts(LOS_phase, smoothing):
     # Implementing temporal smoothing after uncorrected timeseries formation.
     # I'm doing this as an overconstrained linear inverse problem
     # This is similar to a Gaussian smoothing.
-    n_TS = len(LOS_phase);
-    G_top = np.eye(n_TS);  # Constructing the G matrix
-    alpha_array = np.full((n_TS - 1,), smoothing)
-    G_positive_alpha = np.diag(alpha_array);
-    G_negative_alpha = np.diag(-alpha_array[0:-1], 1);
-    G_bottom = np.add(G_positive_alpha, G_negative_alpha);
-    G_last_column = np.zeros((n_TS - 1, 1));
-    G_last_column[-1] = -smoothing;
-    G_bottom = np.hstack((G_bottom, G_last_column))
-    G = np.vstack((G_top, G_bottom))
-
-    # Constructing the data vector
-    d = np.hstack((LOS_phase, np.zeros(n_TS - 1, )));
-
-    # Implementing the smoothing
-    smoothed_los = np.dot(np.dot(np.linalg.inv(np.dot(G.T, G)), G.T), d);
+    # The operator (G^T G)^-1 G^T only depends on len(LOS_phase) and smoothing,
+    # so it comes pre-built from nsbas_batched.smoothing_operator.
+    smoothed_los = np.dot(nsbas_batched.smoothing_operator(len(LOS_phase), float(smoothing)), LOS_phase);
     return smoothed_los;
 
 
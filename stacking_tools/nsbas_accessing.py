@@ -1,35 +1,66 @@
 from subprocess import call
 import numpy as np
-import sys, glob
+import datetime as dt
+import sys, glob, os
 import stacking_utilities
 import readmytupledata as rmd
 import netcdf_read_write as rwr
 import nsbas
+import nsbas_batched
+import nsbas_incremental
+import stacking_profiler
+import stack_reference
+import stack_cache
 import dem_error_correction
 import sentinel_utilities
+from netCDF4 import Dataset
 
 
 # LET'S GET A VELOCITY FIELD
 def drive_velocity_gmtsar(intf_files, nsbas_min_intfs, smoothing, wavelength, rowref, colref, outdir,
-                          signal_spread_file, baseline_file=None, coh_files=None):
+                          signal_spread_file, baseline_file=None, coh_files=None, workers=1, uncertainty=False,
+                          profiler=None, ref_window=0, ref_gps_velocity=None, dtype=float, robust=None,
+                          cache_dir=None, tile_rows=nsbas_batched.TILE_ROWS):
     # GMTSAR DRIVING VELOCITIES
+    # workers: processes for decoding the stack and for solving NSBAS, in blocks of tile_rows rows.
+    # cache_dir: read the interferograms and coherence through the stack cache there (see stack_cache).
+    # With uncertainty, the formal velocity uncertainty is written to velo_nsbas_sigma.grd
+    # With robust ('huber' or 'l1'), outlier interferograms are down-weighted, and the number of outliers
+    # of each pixel is written to velo_nsbas_outliers.grd
+    # The stack is referenced once to the reference pixel, or to the nanmean of a box of +/- ref_window pixels
+    # around it, optionally anchored to a GPS station's LOS velocity ref_gps_velocity (mm/yr); see stack_reference.
+    # dtype=np.float32 keeps the stacks and the output grids in single precision (the solves stay in float64).
     signal_spread_file = outdir + "/" + signal_spread_file; 
-    intf_tuple = rmd.reader(intf_files);
-    coh_tuple = None;
-    if coh_files is not None:
-        coh_tuple = rmd.reader(coh_files);
-    signal_spread_data = rwr.read_grd(signal_spread_file);
-    velocities = nsbas.Velocities(intf_tuple, nsbas_min_intfs, smoothing, wavelength, rowref, colref,
-                                  signal_spread_data, baseline_file=baseline_file, coh_tuple=coh_tuple);
-    rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, velocities, 'mm/yr', outdir + '/velo_nsbas.grd');
+    with stacking_profiler.stage(profiler, 'read_stack'):
+        intf_tuple = stack_cache.read_stack(intf_files, cache_dir, dtype=dtype, workers=workers);
+        coh_tuple = None;
+        if coh_files is not None:
+            coh_tuple = stack_cache.read_stack(coh_files, cache_dir, dtype=dtype, workers=workers);
+        signal_spread_data = rwr.read_grd(signal_spread_file);
+        intf_tuple = stack_reference.reference_stack(intf_tuple, rowref, colref, ref_window, ref_gps_velocity,
+                                                     wavelength);
+    velocities = nsbas.Velocities(intf_tuple, nsbas_min_intfs, smoothing, wavelength, None, None,
+                                  signal_spread_data, baseline_file=baseline_file, coh_tuple=coh_tuple, workers=workers,
+                                  tile_rows=tile_rows, uncertainty=uncertainty, profiler=profiler, robust=robust,
+                                  outlier_file=outdir + '/velo_nsbas_outliers.grd' if robust is not None else None);
+    if uncertainty:
+        rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, velocities.vel_sigma, 'mm/yr',
+                                  outdir + '/velo_nsbas_sigma.grd', dtype=dtype);
+    rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, velocities.vel, 'mm/yr',
+                              outdir + '/velo_nsbas.grd', dtype=dtype);
     rwr.produce_output_plot(outdir + '/velo_nsbas.grd', 'LOS Velocity', outdir + '/velo_nsbas.png', 'velocity (mm/yr)');
     return;
 
 
 # LET'S GET SOME PIXELS AND OUTPUT THEIR TS. 
 def drive_point_ts_gmtsar(intf_files, ts_points_file, smoothing, wavelength, rowref, colref, outdir,
-                          baseline_file=None, coh_files=None, geocoded_flag=0):
+                          baseline_file=None, coh_files=None, geocoded_flag=0, ref_window=0, ref_gps_velocity=None,
+                          dtype=float, point_radius=0, workers=1):
     # For general use, please provide a file with [lon, lat, row, col, name]
+    # ref_window, ref_gps_velocity, dtype: see drive_velocity_gmtsar
+    # Only the pixels around each point and the reference are read from each file (rmd.reader_points),
+    # spread over `workers` processes if workers > 1. With point_radius > 0, each point's time series
+    # is made from the nanmean of the +/- point_radius box around it.
     lons, lats, names, rows, cols = stacking_utilities.drive_cache_ts_points(ts_points_file, intf_files[0], geocoded_flag);
     if lons is None:
         return;
@@ -37,22 +68,28 @@ def drive_point_ts_gmtsar(intf_files, ts_points_file, smoothing, wavelength, row
     print("TS OUTPUT DIR IS: " + outdir);
     call(['mkdir', '-p', outdir], shell=False);
     print("Computing TS for %d pixels" % len(lons));
-    intf_tuple = rmd.reader(intf_files);
+    radius = max(point_radius, ref_window);
+    query_rows, query_cols = list(rows) + [rowref], list(cols) + [colref];  # the reference is the last point
+    intf_tuple = rmd.reader_points(intf_files, query_rows, query_cols, radius, workers, dtype=dtype);
     coh_tuple = None; 
     coh_value = None;
     if coh_files is not None:
-        coh_tuple = rmd.reader(coh_files);
+        coh_tuple = rmd.reader_points(coh_files, query_rows, query_cols, radius, workers, dtype=dtype);
     datestrs, x_dts, x_axis_days = nsbas.get_TS_dates(intf_tuple.date_pairs_julian);
-    reference_pixel_vector = intf_tuple.zvalues[:, rowref, colref];
+    ref_box = slice(radius - ref_window, radius + ref_window + 1);
+    reference_vector = stack_reference.reference_from_box(intf_tuple.zvalues[:, -1, ref_box, ref_box],
+                                                          intf_tuple.date_deltas, ref_gps_velocity, wavelength);
+    point_box = slice(radius - point_radius, radius + point_radius + 1);
+    design_cache = nsbas_batched.DesignMatrixCache(intf_tuple.date_pairs_julian, datestrs);
 
     for i in range(len(rows)):
-        pixel_value = intf_tuple.zvalues[:, rows[i], cols[i]];
-        pixel_value = np.subtract(pixel_value, reference_pixel_vector);  # with respect to the reference pixel. 
+        pixel_value = stack_reference.box_mean(intf_tuple.zvalues[:, i, point_box, point_box]);
+        pixel_value = np.subtract(pixel_value, reference_vector);  # with respect to the reference
         if coh_tuple is not None:
-            coh_value = coh_tuple.zvalues[:, rows[i], cols[i]];
+            coh_value = stack_reference.box_mean(coh_tuple.zvalues[:, i, point_box, point_box]);
         stacking_utilities.write_testing_pixel(intf_tuple, pixel_value, coh_value, outdir+'/testing_pixel_'+str(i)+'.txt');
         m_cumulative = nsbas.do_nsbas_pixel(pixel_value, intf_tuple.date_pairs_julian, smoothing, wavelength, datestrs,
-                                            coh_value=coh_value);
+                                            coh_value=coh_value, design_cache=design_cache);
 
         # If we're using DEM error, then we pass in the baseline table.
         if baseline_file is not None:
@@ -64,59 +101,130 @@ def drive_point_ts_gmtsar(intf_files, ts_points_file, smoothing, wavelength, row
 
 # LET'S GET THE FULL TS FOR EVERY PIXEL
 def drive_full_TS_gmtsar(intf_files, nsbas_min_intfs, sbas_smoothing, wavelength, rowref, colref, outdir, 
-                         signal_spread_file, baseline_file=None, coh_files=None):
+                         signal_spread_file, baseline_file=None, coh_files=None, workers=1, incremental=False,
+                         uncertainty=False, profiler=None, ref_window=0, ref_gps_velocity=None, dtype=float,
+                         robust=None, cache_dir=None, save_state=False, tile_rows=nsbas_batched.TILE_ROWS):
     # SETUP. 
-    start_index = 0;
-    end_index = 7000000;
+    # The time series is streamed into outdir/TS.nc with a manifest of finished blocks.
+    # If the run is killed, running it again with the same inputs continues where it stopped.
+    # With save_state, an unweighted, non-robust run also saves its normal equations in outdir/TS_state.nc
+    # (G^T d in float64 for every epoch and pixel, so more than twice the size of TS.nc).
+    # With incremental=True, intf_files are only the new interferograms, and they are added
+    # to the run already in outdir/TS.nc and outdir/TS_state.nc.
+    # With uncertainty, the formal 1-sigma of each epoch is kept in the z_sigma variable of TS.nc
+    # and the velocity uncertainty is written to velo_nsbas_sigma.grd (not available in incremental mode).
+    # With robust ('huber' or 'l1'), outlier interferograms are down-weighted, and the number of outliers
+    # of each pixel is kept in the outliers variable of TS.nc and written to outliers.grd (not incremental).
+    # ref_window, ref_gps_velocity, dtype, cache_dir, tile_rows: see drive_velocity_gmtsar.
+    # tile_rows is also the chunk size of TS.nc along y; a killed run resumes only with the same tile_rows.
+    # An incremental run must use the same reference.
+    # TS.nc is always float32.
     signal_spread_file = outdir + "/" + signal_spread_file;
-
-    intf_tuple = rmd.reader(intf_files);
-    coh_tuple = None;
-    if coh_files is not None:
-        coh_tuple = rmd.reader(coh_files);
-    xdates = stacking_utilities.get_xdates_from_intf_tuple(intf_tuple);
-    signal_spread_data = rwr.read_grd(signal_spread_file);
+    TS_NC_file = outdir + "/TS.nc";
+    state_file = outdir + "/TS_state.nc";
+    if save_state and (coh_files is not None or robust is not None):
+        print("ERROR: only unweighted, non-robust NSBAS can save its state. Stopping immediately. ");
+        sys.exit(1);
+
+    with stacking_profiler.stage(profiler, 'read_stack'):
+        intf_tuple = stack_cache.read_stack(intf_files, cache_dir, dtype=dtype, workers=workers);
+        coh_tuple = None;
+        if coh_files is not None:
+            coh_tuple = stack_cache.read_stack(coh_files, cache_dir, dtype=dtype, workers=workers);
+        signal_spread_data = rwr.read_grd(signal_spread_file);
+        intf_tuple = stack_reference.reference_stack(intf_tuple, rowref, colref, ref_window, ref_gps_velocity,
+                                                     wavelength);
 
     # TIME SERIES
-    TS = nsbas.Full_TS(intf_tuple, nsbas_min_intfs, sbas_smoothing, wavelength, rowref, colref, signal_spread_data,
-                       start_index=start_index, end_index=end_index, baseline_file=baseline_file, coh_tuple=coh_tuple);
-    rwr.produce_output_TS_grids(intf_tuple.xvalues, intf_tuple.yvalues, TS, xdates, 'mm', outdir);
+    if incremental:
+        if coh_tuple is not None or robust is not None or not os.path.isfile(state_file):
+            print("ERROR: incremental NSBAS needs an unweighted, non-robust run saved with save_state in %s. "
+                  "Stopping immediately. " % state_file);
+            sys.exit(1);
+        nsbas_incremental.update_TS(intf_tuple, nsbas_min_intfs, sbas_smoothing, wavelength, signal_spread_data,
+                                    TS_NC_file, state_file, baseline_file=baseline_file, tile_rows=tile_rows);
+    else:
+        nsbas.Full_TS(intf_tuple, nsbas_min_intfs, sbas_smoothing, wavelength, None, None, signal_spread_data,
+                      baseline_file=baseline_file, coh_tuple=coh_tuple, workers=workers, tile_rows=tile_rows,
+                      output_file=TS_NC_file, resume=True, state_file=state_file if save_state else None,
+                      dem_error_file=outdir + "/dem_error.grd" if baseline_file is not None else None,
+                      uncertainty=uncertainty, profiler=profiler, robust=robust,
+                      outlier_file=outdir + "/outliers.grd" if robust is not None else None);
+
+    # OUTPUTS: one grid per date, read from TS.nc one date at a time
+    start = dt.datetime.now();
+    ts_tuple = rmd.reader_ts_netcdf(TS_NC_file, dtype=dtype);
+    rwr.produce_output_TS_grids(intf_tuple.xvalues, intf_tuple.yvalues, ts_tuple.zvalues, ts_tuple.ts_dates, 'mm',
+                                outdir, dtype=dtype);
+    rootgrp = Dataset(TS_NC_file, 'r');
+    rootgrp.set_auto_mask(False);
+    if 'vel_sigma' in rootgrp.variables:
+        rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, rootgrp.variables['vel_sigma'][:, :],
+                                  'mm/yr', outdir + '/velo_nsbas_sigma.grd', dtype=dtype);
+    rootgrp.close();
+    if profiler is not None:
+        profiler.add_time('write_grids', (dt.datetime.now() - start).total_seconds());
+        profiler.emit(final=True);
     return;
 
 
-def make_vels_from_ts_grids(ts_dir, geocoded=False):
+def make_vels_from_ts_grids(ts_dir, geocoded=False, dtype=float):
+    # In radar coordinates, the time series is read from ts_dir/TS.nc if it is there,
+    # a block of rows at a time, and otherwise from the grid of each date.
     if geocoded:
         filelist = glob.glob(ts_dir + "/publish/*_ll.grd");
-        mydata = rmd.reader_from_ts(filelist, "lon", "lat", "z");  # put these if using geocoded values
+        mydata = rmd.reader_from_ts(filelist, "lon", "lat", "z", dtype=dtype);  # put these if using geocoded values
+    elif os.path.isfile(ts_dir + "/TS.nc"):
+        mydata = rmd.reader_ts_netcdf(ts_dir + "/TS.nc", dtype=dtype);
     else:
         filelist = glob.glob(ts_dir + "/????????.grd");
-        mydata = rmd.reader_from_ts(filelist);
+        mydata = rmd.reader_from_ts(filelist, dtype=dtype);
     vel = nsbas.Velocities_from_TS(mydata);
-    rwr.produce_output_netcdf(mydata.xvalues, mydata.yvalues, vel, 'mm/yr', ts_dir + '/velo_nsbas.grd');
+    rwr.produce_output_netcdf(mydata.xvalues, mydata.yvalues, vel, 'mm/yr', ts_dir + '/velo_nsbas.grd', dtype=dtype);
     rwr.produce_output_plot(ts_dir + '/velo_nsbas.grd', 'LOS Velocity', ts_dir + '/velo_nsbas.png', 'velocity (mm/yr)');
     return;
 
 
+def drive_resmooth_TS(TS_NC_file, smoothing, outfile, start_date=None):
+    # Re-smooth an existing TS.nc with a new sbas_smoothing, without re-running NSBAS.
+    # Start from an unsmoothed time series (sbas_smoothing = 0) to get the same answer as smoothing during NSBAS.
+    # Pixels of split networks are smoothed over the epochs that were solved; their orphaned epochs stay nan.
+    # Older files only store days since the first acquisition. Give their start_date to write real dates;
+    # otherwise outfile keeps the units of TS_NC_file, and any start date gives back the same t axis.
+    rootgrp = Dataset(TS_NC_file, 'r');
+    tunits = getattr(rootgrp.variables['t'], 'units', 'days');
+    rootgrp.close();
+    no_dates = 'since' not in tunits and start_date is None;
+    ts_tuple = rmd.reader_ts_netcdf(TS_NC_file, lazy=False,
+                                    start_date=dt.datetime(2000, 1, 1) if no_dates else start_date);
+    TS_smoothed = nsbas_batched.smooth_TS_cube(ts_tuple.zvalues, smoothing);
+    # first epoch stays at zero; for split networks that lost their first epoch, the first one that was solved
+    first_finite = np.argmax(np.isfinite(TS_smoothed), axis=0);
+    TS_smoothed = TS_smoothed - np.take_along_axis(TS_smoothed, first_finite[np.newaxis, :, :], axis=0);
+    rwr.produce_output_timeseries(ts_tuple.xvalues, ts_tuple.yvalues, TS_smoothed, list(ts_tuple.ts_dates), 'mm',
+                                  outfile, tunits=tunits if no_dates else None);
+    return;
+
+
 # LET'S GET THE FULL TS FOR UAVSAR/ISCE FILES.
 def drive_full_TS_isce(intf_files, nsbas_min_intfs, sbas_smoothing, wavelength, rowref, colref, outdir,
-                       baseline_file=None, coh_files=None):
+                       baseline_file=None, coh_files=None, cache_dir=None):
     # SETUP. 
     signal_spread_file = outdir + "/signalspread_cut.nc"
-    intf_tuple = rmd.reader_isce(intf_files);
+    intf_tuple = stack_cache.read_stack(intf_files, cache_dir, reader='isce');
     coh_tuple = None;
     if coh_files is not None:
-        coh_tuple = rmd.reader_isce(coh_files);
+        coh_tuple = stack_cache.read_stack(coh_files, cache_dir, reader='isce');
     xdates = stacking_utilities.get_xdates_from_intf_tuple(intf_tuple);
     signal_spread_data = rwr.read_grd(signal_spread_file);
 
-    # TIME SERIES
-    TS = nsbas.Full_TS(intf_tuple, nsbas_min_intfs, sbas_smoothing, wavelength, rowref, colref, signal_spread_data,
-                       baseline_file=baseline_file, coh_tuple=coh_tuple);
-
-    # OUTPUTS
+    # TIME SERIES, streamed straight into the output file
     TS_NC_file = outdir + "/TS.nc";
     TS_image_file = outdir + "/TS.png";
-    rwr.produce_output_timeseries(intf_tuple.xvalues, intf_tuple.yvalues, TS, xdates, 'mm', TS_NC_file);
+    nsbas.Full_TS(intf_tuple, nsbas_min_intfs, sbas_smoothing, wavelength, rowref, colref, signal_spread_data,
+                  baseline_file=baseline_file, coh_tuple=coh_tuple, output_file=TS_NC_file);
+
+    # OUTPUTS
     stacking_utilities.plot_full_timeseries(TS_NC_file, xdates, TS_image_file, vmin=-50, vmax=200, aspect=1 / 8);
     return;
 
@@ -0,0 +1,1083 @@
+# Batched NSBAS engine.
+# Pixels that are missing the same interferograms share the same design matrix.
+# Instead of building G and running lstsq once per pixel, we group the pixels of a tile by their
+# pattern of nans across the interferogram axis, look up G and its pseudo-inverse once per group
+# in a DesignMatrixCache, and solve every pixel in the group with one matrix multiply.
+# The numbers match nsbas.do_nsbas_pixel column by column.
+
+import numpy as np
+import datetime as dt
+import sys
+import os
+import json
+import hashlib
+import time
+import collections
+import functools
+import multiprocessing
+from multiprocessing import shared_memory
+import scipy.sparse
+import scipy.sparse.linalg
+import stacking_utilities
+import stacking_profiler
+import dem_error_correction
+import netcdf_read_write as rwr
+import readmytupledata as rmd
+from netCDF4 import Dataset
+
+
+# ------------ DESIGN MATRIX ------------ #
+
+SPARSE_EPOCHS = 200;  # above this many epochs, design matrices are kept and solved in sparse form
+TILE_ROWS = 100;  # rows of pixels in each block that is solved, streamed and given to a worker
+ROBUST_ITERATIONS = 10;  # reweighting passes of robust NSBAS
+HUBER_K = 1.345;  # Huber threshold, in units of the residual scale
+OUTLIER_SIGMAS = 3.0;  # an interferogram whose residual is beyond this many scales counts as an outlier
+ROBUST_MIN_SCALE = 0.1;  # radians; floor on the residual scale, for pixels with little redundancy
+
+# What the solvers return. The by-products that were not asked for (uncertainty, robust) are None.
+# ts_results.TS is a (n_epochs, ny, nx) array from the batched solvers, but nsbas.Full_TS(batched=False)
+# keeps the old per-pixel TS: a list of rows, each a list of [ts_vector].
+velocity_results = collections.namedtuple('velocity_results', ['vel', 'vel_sigma', 'outliers']);
+ts_results = collections.namedtuple('ts_results', ['TS', 'ts_sigma', 'vel_sigma', 'outliers']);
+
+def get_epoch_indices(date_pairs, datestrs):
+    # For each interferogram in format 2015157_2018177, the index of its first and second image in datestrs
+    lookup = {datestr: idx for idx, datestr in enumerate(datestrs)};
+    first_idx = np.array([lookup[pair[0:7]] for pair in date_pairs], dtype=int);
+    second_idx = np.array([lookup[pair[8:15]] for pair in date_pairs], dtype=int);
+    return first_idx, second_idx;
+
+
+def build_G(first_idx, second_idx, model_num):
+    # Each row of G has ones for every increment between the first and second image of that interferogram
+    columns = np.arange(model_num);
+    G = (columns >= first_idx[:, np.newaxis]) & (columns < second_idx[:, np.newaxis]);
+    return G.astype(float);
+
+
+def build_G_sparse(first_idx, second_idx, model_num):
+    # The same G as build_G in CSR form, for long stacks where it is mostly zeros
+    lengths = second_idx - first_idx;
+    rows = np.repeat(np.arange(len(first_idx)), lengths);
+    offsets = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths);
+    cols = np.repeat(first_idx, lengths) + offsets;
+    return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(first_idx), model_num));
+
+
+DesignMatrix = collections.namedtuple('DesignMatrix', ['G', 'pinv', 'GTG_inv', 'connected', 'n_components', 'labels',
+                                                       'orphans', 'components', 'factor']);
+Component = collections.namedtuple('Component', ['epochs', 'rows', 'G', 'pinv']);
+
+
+class DesignMatrixCache:
+    # LRU cache of design matrices, keyed by the packed bitmask of which interferograms are valid.
+    # Each entry holds G, its pseudo-inverse, (G^T G)^-1, and the connectivity of the network:
+    # the number of components, a component label for each epoch, and the orphaned epochs.
+    # Disconnected networks also get the G and pseudo-inverse of each component, for split solves.
+    # So a repeated pattern costs only a matrix multiply.
+    # With more than sparse_epochs epochs, G is kept in sparse form and each entry holds a sparse LU
+    # factorization of G^T G (factor) instead of the dense pseudo-inverse; see solve_sparse_group.
+    # sparse_method is 'normal' (sparse normal equations) or 'lsqr'. sparse_epochs=None never goes sparse.
+    # All lookups must use the same date_pairs and datestrs that the cache was built with.
+    def __init__(self, date_pairs, datestrs, maxsize=512, sparse_epochs=SPARSE_EPOCHS, sparse_method='normal'):
+        self.date_pairs = list(date_pairs);
+        self.datestrs = list(datestrs);
+        self.first_idx, self.second_idx = get_epoch_indices(self.date_pairs, self.datestrs);
+        self.sparse = sparse_epochs is not None and len(self.datestrs) > sparse_epochs;
+        self.sparse_method = sparse_method;
+        if self.sparse:
+            self.G_all = build_G_sparse(self.first_idx, self.second_idx, len(self.datestrs) - 1);
+        else:
+            self.G_all = build_G(self.first_idx, self.second_idx, len(self.datestrs) - 1);
+        self.maxsize = maxsize;
+        self.hits = 0;
+        self.misses = 0;
+        self.build_seconds = {'connectivity': 0.0, 'factorization': 0.0};
+        self._entries = collections.OrderedDict();
+
+    def get(self, used):
+        # used: boolean array with one element per interferogram
+        key = np.packbits(used).tobytes();
+        if key in self._entries:
+            self.hits = self.hits + 1;
+            self._entries.move_to_end(key);
+            return self._entries[key];
+        self.misses = self.misses + 1;
+        entry = self.build_entry(used);
+        self._entries[key] = entry;
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False);  # dropping the least recently used pattern
+        return entry;
+
+    def build_entry(self, used):
+        first_idx, second_idx = self.first_idx[used], self.second_idx[used];
+        start = time.perf_counter();
+        n_components, labels, orphans = stacking_utilities.network_components(first_idx, second_idx,
+                                                                              len(self.datestrs));
+        self.build_seconds['connectivity'] = self.build_seconds['connectivity'] + time.perf_counter() - start;
+        start = time.perf_counter();
+        try:
+            return self.build_design(used, first_idx, second_idx, n_components, labels, orphans);
+        finally:
+            self.build_seconds['factorization'] = self.build_seconds['factorization'] + time.perf_counter() - start;
+
+    def build_design(self, used, first_idx, second_idx, n_components, labels, orphans):
+        if n_components > 1:
+            return DesignMatrix(G=None, pinv=None, GTG_inv=None, connected=False, n_components=n_components,
+                                labels=labels, orphans=orphans,
+                                components=build_components(first_idx, second_idx, labels, orphans), factor=None);
+        if self.sparse:
+            G = self.G_all[np.where(used)[0], :];
+            factor = scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(G.T @ G));
+            return DesignMatrix(G=G, pinv=None, GTG_inv=None, connected=True, n_components=1, labels=labels,
+                                orphans=orphans, components=None, factor=factor);
+        G = self.G_all[used, :];
+        pinv = np.linalg.pinv(G);
+        return DesignMatrix(G=G, pinv=pinv, GTG_inv=np.dot(pinv, pinv.T), connected=True, n_components=1,
+                            labels=labels, orphans=orphans, components=None, factor=None);
+
+    def stats(self):
+        total = self.hits + self.misses;
+        hit_rate = self.hits / total if total > 0 else 0.0;
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'hit_rate': hit_rate,
+                'connectivity_s': self.build_seconds['connectivity'],
+                'factorization_s': self.build_seconds['factorization']};
+
+
+def solve_normal(design, b):
+    # (G^T G)^-1 b, from the cached dense inverse or the cached sparse factorization
+    if design.factor is not None:
+        return design.factor.solve(np.asarray(b, dtype=float));
+    return np.dot(design.GTG_inv, b);
+
+
+def build_components(first_idx, second_idx, labels, orphans):
+    # For each component of a disconnected network that has interferograms: its epochs,
+    # the interferograms inside it, and the G and pseudo-inverse of the increments between its own epochs.
+    components = [];
+    for k in range(np.max(labels) + 1):
+        epochs = np.where(labels == k)[0];
+        if len(epochs) == 1 and epochs[0] in orphans:
+            continue;
+        rows = np.where(labels[first_idx] == k)[0];
+        G = build_G(np.searchsorted(epochs, first_idx[rows]), np.searchsorted(epochs, second_idx[rows]),
+                    len(epochs) - 1);
+        components.append(Component(epochs=epochs, rows=rows, G=G, pinv=np.linalg.pinv(G)));
+    return components;
+
+
+def group_by_nan_pattern(data):
+    # data: (n_intf, n_pixels) array. Pixels with the same interferograms available go in the same group.
+    # Returns the validity pattern of each group (n_groups, n_intf) and a list of pixel indices for each group.
+    return group_by_validity(~np.isnan(data));
+
+
+def group_by_validity(valid):
+    # valid: (n_intf, n_pixels) boolean array of the interferograms each pixel uses.
+    if np.shape(valid)[1] == 0:
+        return np.zeros((0, np.shape(valid)[0]), dtype=bool), [];
+    packed = np.packbits(valid, axis=0).T;  # one row of bytes per pixel
+    _, first_pixel, inverse = np.unique(packed, axis=0, return_index=True, return_inverse=True);
+    inverse = np.ravel(inverse);
+    patterns = valid[:, first_pixel].T;
+    order = np.argsort(inverse, kind='stable');
+    splits = np.cumsum(np.bincount(inverse, minlength=len(first_pixel)))[0:-1];
+    groups = np.split(order, splits);
+    return patterns, groups;
+
+
+@functools.lru_cache(maxsize=16)
+def smoothing_operator(n_TS, smoothing):
+    # The linear operator of nsbas.temporal_smoothing_ts. It depends only on the number of epochs and the
+    # smoothing value, so it is built once and cached; applying it is a single matrix multiply.
+    # The bottom of the data vector is zeros, so only the first n_TS columns of (G^T G)^-1 G^T matter.
+    G_top = np.eye(n_TS);
+    alpha_array = np.full((n_TS - 1,), smoothing)
+    G_bottom = np.add(np.diag(alpha_array), np.diag(-alpha_array[0:-1], 1));
+    G_last_column = np.zeros((n_TS - 1, 1));
+    G_last_column[-1] = -smoothing;
+    G_bottom = np.hstack((G_bottom, G_last_column));
+    G = np.vstack((G_top, G_bottom));
+    operator = np.dot(np.linalg.inv(np.dot(G.T, G)), G.T)[:, 0:n_TS];
+    operator.setflags(write=False);  # shared between callers
+    return operator;
+
+
+def smooth_TS_cube(TS, smoothing, tile_rows=TILE_ROWS):
+    # Apply temporal smoothing to a (n_epochs, n_pixels) block or a (n_epochs, ny, nx) cube.
+    # The smoothing operator preserves constants, so smoothing a time series that starts at zero
+    # and then re-setting the first epoch to zero gives the same answer as smoothing inside NSBAS.
+    # Pixels with some nans, such as the orphaned epochs of split networks, are smoothed over their finite
+    # epochs only (see smooth_TS_block); their nans stay nan.
+    if smoothing <= 0:
+        return TS;
+    if np.ndim(TS) == 2:
+        return smooth_TS_block(TS, float(smoothing));
+    smoothed = np.empty(np.shape(TS));
+    n_TS, ny, nx = np.shape(TS);
+    for row_start in range(0, ny, tile_rows):
+        rows = slice(row_start, min(row_start + tile_rows, ny));
+        block = np.reshape(TS[:, rows, :], (n_TS, -1));
+        smoothed[:, rows, :] = np.reshape(smooth_TS_block(block, float(smoothing)), (n_TS, -1, nx));
+    return smoothed;
+
+
+def smooth_TS_block(block, smoothing):
+    # block: (n_epochs, n_pixels). Complete pixels share one operator. Pixels with at least two finite epochs
+    # are grouped by their pattern of nans, and each group is smoothed with the operator of its own epochs,
+    # as if the nan epochs had never been there. Pixels with fewer finite epochs are left as they are.
+    n_TS = np.shape(block)[0];
+    smoothed = np.dot(smoothing_operator(n_TS, smoothing), block);
+    finite = np.isfinite(block);
+    n_finite = np.sum(finite, axis=0);
+    partial = np.where((n_finite < n_TS) & (n_finite >= 2))[0];
+    smoothed[:, n_finite < 2] = block[:, n_finite < 2];
+    patterns, groups = group_by_validity(finite[:, partial]);
+    for epochs, pixels in zip(patterns, groups):
+        pixels = partial[pixels];
+        operator = smoothing_operator(int(np.sum(epochs)), smoothing);
+        smoothed[:, pixels] = np.nan;
+        smoothed[np.ix_(epochs, pixels)] = np.dot(operator, block[np.ix_(epochs, pixels)]);
+    return smoothed;
+
+
+@functools.lru_cache(maxsize=16)
+def epoch_operator(n_TS, smoothing):
+    # The linear map from increments m to the epochs of increments_to_TS, before conversion to mm:
+    # cumulative sum, smoothing, and the first epoch set to zero. Used to propagate the covariance of m.
+    E = np.tril(np.ones((n_TS, n_TS - 1)), -1);
+    if smoothing > 0:
+        E = np.dot(smoothing_operator(n_TS, float(smoothing)), E);
+    E = E - E[0, :];
+    E.setflags(write=False);
+    return E;
+
+
+def velocity_operator(datestrs):
+    # The row vector that takes a time series in mm to its least squares velocity in mm/yr,
+    # as velocities_from_TS_cube does for pixels without nans.
+    x_axis_days = np.array([(dt.datetime.strptime(x, "%Y%j") - dt.datetime.strptime(datestrs[0], "%Y%j")).days
+                            for x in datestrs], dtype=float);
+    x = x_axis_days - np.mean(x_axis_days);
+    return x / np.sum(x * x) * 365.24;
+
+
+# ------------ COMPUTE ------------ #
+
+def solve_nsbas_block(data, date_pairs, smoothing, wavelength, datestrs, coh=None, design_cache=None,
+                      split_disconnected=False, uncertainty=False, profiler=None, robust=None,
+                      robust_iterations=ROBUST_ITERATIONS):
+    # data: (n_intf, n_pixels) phase values, already with respect to the reference pixel.
+    # coh: matching (n_intf, n_pixels) coherence for weighted least squares, or None.
+    # design_cache: a DesignMatrixCache for these date_pairs, to reuse G between calls.
+    # Returns a ts_results with TS the (n_epochs, n_pixels) displacements in mm.
+    # Columns of disconnected networks are returned as nans, like do_nsbas_pixel.
+    # With split_disconnected, they are solved one network component at a time instead (see solve_split_group),
+    # and only their orphaned epochs are nans.
+    # With uncertainty, ts_sigma and vel_sigma are the formal 1-sigma of each epoch (n_epochs, n_pixels) in mm
+    # and of the velocity (n_pixels,) in mm/yr; see propagate_uncertainty.
+    # robust: 'huber' or 'l1' for iteratively reweighted least squares (see solve_robust_group), which downweights
+    # interferograms with unwrapping errors. Then outliers is the number of outlier interferograms of each pixel
+    # (n_pixels,), nan for pixels not solved.
+    # profiler: a stacking_profiler.Profiler that receives the time of each stage.
+    n_pixels = np.shape(data)[1];
+    model_num = len(datestrs) - 1;
+    if design_cache is None:
+        design_cache = DesignMatrixCache(date_pairs, datestrs);
+    m = np.full((model_num, n_pixels), np.nan);
+    orphaned = np.zeros((model_num + 1, n_pixels), dtype=bool);
+    if uncertainty:
+        E = epoch_operator(model_num + 1, float(smoothing));
+        c = np.dot(velocity_operator(datestrs), E);
+        ts_var, vel_var = np.full((model_num + 1, n_pixels), np.nan), np.full((n_pixels,), np.nan);
+    n_outliers = np.full((n_pixels,), np.nan);
+
+    with stacking_profiler.stage(profiler, 'group_patterns'):
+        patterns, groups = group_by_nan_pattern(data);
+    for used, pixels in zip(patterns, groups):
+        with stacking_profiler.stage(profiler, 'design_matrix'):
+            design = design_cache.get(used);
+        d = data[:, pixels][used, :];
+        w = None;
+        if coh is not None:
+            w = np.power(coh[:, pixels][used, :], 2);  # using coherence squared as the weighting.
+        if not design.connected and not split_disconnected:
+            print("SINGULAR MATRIX ENCOUNTERED FOR %d PIXELS. RETURNING VECTORS OF NANS." % len(pixels));
+            continue;
+        with stacking_profiler.stage(profiler, 'solve'):
+            if not design.connected:
+                print("SPLITTING %d PIXELS INTO %d NETWORK COMPONENTS (%d ORPHANED EPOCHS)." % (
+                    len(pixels), design.n_components, len(design.orphans)));
+                if robust is None:
+                    m[:, pixels] = solve_split_group(design, d, w);
+                else:
+                    m[:, pixels], n_outliers[pixels] = solve_split_group(design, d, w, robust, robust_iterations);
+                orphaned[np.ix_(design.orphans, pixels)] = True;
+            elif robust is not None:
+                m[:, pixels], w, n_outliers[pixels] = solve_robust_group(design.G, d, w,
+                                                                         get_group_solver(design, d, design_cache),
+                                                                         robust, robust_iterations);
+            elif design.factor is not None:
+                m[:, pixels] = solve_sparse_group(design, d, w, design_cache.sparse_method);
+            elif w is None:
+                m[:, pixels] = np.dot(design.pinv, d);
+            else:
+                m[:, pixels] = solve_weighted_group(design.G, d, w);
+        if uncertainty and design.connected:
+            with stacking_profiler.stage(profiler, 'uncertainty'):
+                ts_var[:, pixels], vel_var[pixels] = propagate_uncertainty(design, d, w, m[:, pixels], E, c);
+
+    with stacking_profiler.stage(profiler, 'smoothing'):
+        disp_ts = increments_to_TS(m, smoothing, wavelength);
+    disp_ts[orphaned] = np.nan;
+    retval = ts_results(TS=disp_ts, ts_sigma=None, vel_sigma=None, outliers=None);
+    if uncertainty:
+        scale = wavelength / (4 * np.pi);  # radians to mm
+        retval = retval._replace(ts_sigma=np.sqrt(ts_var) * scale, vel_sigma=np.sqrt(vel_var) * scale);
+    if robust is not None:
+        retval = retval._replace(outliers=n_outliers);
+    return retval;
+
+
+def get_group_solver(design, d, design_cache):
+    # solve(w) -> m for the pixels d of a connected group, with weights w (n_used, n_pixels) or None
+    def solve(w):
+        if design.factor is not None:
+            return solve_sparse_group(design, d, w, design_cache.sparse_method);
+        if w is None:
+            return np.dot(design.pinv, d);
+        return solve_weighted_group(design.G, d, w);
+    return solve;
+
+
+def solve_robust_group(G, d, w, solve, norm='huber', iterations=ROBUST_ITERATIONS):
+    # Robust NSBAS by iteratively reweighted least squares, for a group of pixels sharing G.
+    # Each pass computes the residuals r = d - G m of every pixel, their scale sigma = 1.4826 * median(|r|),
+    # and multiplies the original weights w (coherence^2, or 1) by
+    #   'huber': 1 for |r| <= HUBER_K sigma, HUBER_K sigma / |r| beyond;
+    #   'l1': sigma / |r| (floored), which converges to the least absolute deviations solution.
+    # There are always `iterations` passes after the first solve, so every group costs the same.
+    # solve(w) gives m for weights w (see get_group_solver).
+    # Returns m, the final weights, and the number of interferograms of each pixel beyond OUTLIER_SIGMAS sigma.
+    if norm not in ['huber', 'l1']:
+        print("ERROR: robust NSBAS norm must be 'huber' or 'l1', not %s. Stopping immediately. " % norm);
+        sys.exit(1);
+    base_w = np.ones(np.shape(d)) if w is None else w;
+    m = solve(w);
+    for iteration in range(iterations):
+        residuals, sigma = get_robust_residuals(G, d, m);
+        ratio = np.abs(residuals) / sigma;
+        if norm == 'huber':
+            reweight = np.minimum(1, HUBER_K / np.maximum(ratio, 1e-12));
+        else:
+            reweight = 1 / np.maximum(ratio, 1e-2);
+        w = base_w * reweight;
+        m = solve(w);
+    residuals, sigma = get_robust_residuals(G, d, m);
+    n_outliers = np.sum(np.abs(residuals) > OUTLIER_SIGMAS * sigma, axis=0);
+    return m, w, n_outliers;
+
+
+def get_robust_residuals(G, d, m):
+    # Residuals (n_used, n_pixels) and their robust scale (n_pixels,), from the median absolute residual
+    residuals = d - G @ m;
+    sigma = np.maximum(1.4826 * np.median(np.abs(residuals), axis=0), ROBUST_MIN_SCALE);
+    return residuals, sigma;
+
+
+def solve_sparse_group(design, d, w=None, method='normal'):
+    # NSBAS for many pixels sharing a sparse G (long stacks). d and w: (n_used, n_pixels).
+    # 'normal': unweighted pixels reuse the cached factorization of G^T G, so the whole group is one
+    #   sparse product and one triangular solve; weighted pixels factor their own sparse G^T W G.
+    # 'lsqr': each pixel is solved iteratively from G itself, without forming normal equations.
+    G = design.G;
+    n_pixels = np.shape(d)[1];
+    if method == 'normal' and w is None:
+        return design.factor.solve(np.asarray(G.T @ d));
+    m = np.full((np.shape(G)[1], n_pixels), np.nan);
+    for k in range(n_pixels):
+        if w is not None and not np.isfinite(w[:, k]).all():
+            continue;  # nan coherence gives a nan solution, as in solve_weighted_group
+        if method == 'lsqr':
+            sqrt_w = np.ones(np.shape(d)[0]) if w is None else np.sqrt(w[:, k]);
+            A = scipy.sparse.csr_matrix(G.multiply(sqrt_w[:, np.newaxis]));
+            m[:, k] = scipy.sparse.linalg.lsqr(A, d[:, k] * sqrt_w, atol=1e-12, btol=1e-12)[0];
+            continue;
+        GTWG = scipy.sparse.csc_matrix(G.T @ G.multiply(w[:, k][:, np.newaxis]));
+        try:
+            m[:, k] = scipy.sparse.linalg.splu(GTWG).solve(G.T @ (w[:, k] * d[:, k]));
+        except RuntimeError:  # singular weighted system
+            continue;
+    return m;
+
+
+def propagate_uncertainty(design, d, w, m, E, c, max_elements=2**25):
+    # Formal variances from the covariance of the increments, sigma0^2 (G^T W G)^-1.
+    # sigma0^2 is the a posteriori variance of unit weight, chi^2 / (n_used - model_num), nan without redundancy.
+    # For unweighted groups (G^T G)^-1 is the one cached for the validity pattern, so this is nearly free;
+    # weighted groups invert their own G^T W G, in chunks of pixels.
+    # E: epoch_operator; c: velocity_operator times E. Returns epoch variances (n_epochs, n_pixels) and
+    # velocity variances (n_pixels,), in radians^2 (per yr^2).
+    G = design.G;
+    n_used, model_num = np.shape(G);
+    residuals = d - G @ m;
+    if w is None:
+        chi2 = np.sum(residuals * residuals, axis=0);
+        ts_factor = np.sum(solve_normal(design, E.T).T * E, axis=1)[:, np.newaxis];
+        vel_factor = np.dot(c, solve_normal(design, c));
+    else:
+        chi2 = np.sum(w * residuals * residuals, axis=0);
+        if scipy.sparse.issparse(G):
+            G = G.toarray();  # dense for the batched inverse, one group at a time
+        n_pixels = np.shape(d)[1];
+        ts_factor, vel_factor = np.zeros((len(E), n_pixels)), np.zeros((n_pixels,));
+        chunk = max(1, max_elements // (n_used * model_num + model_num * model_num));
+        for start in range(0, n_pixels, chunk):
+            pixels = slice(start, min(start + chunk, n_pixels));
+            GTWG = np.einsum('ij,ip,ik->pjk', G, w[:, pixels], G);
+            try:
+                C = np.linalg.inv(GTWG);
+            except np.linalg.LinAlgError:
+                C = np.linalg.pinv(GTWG);
+            ts_factor[:, pixels] = np.einsum('ej,pjk,ek->ep', E, C, E);
+            vel_factor[pixels] = np.einsum('j,pjk,k->p', c, C, c);
+    dof = n_used - model_num;
+    sigma0_sq = chi2 / dof if dof > 0 else np.full(np.shape(chi2), np.nan);
+    return ts_factor * sigma0_sq, vel_factor * sigma0_sq;
+
+
+def solve_split_group(design, d, w=None, robust=None, robust_iterations=ROBUST_ITERATIONS):
+    # Solve a group of pixels whose network falls apart into several components, one component at a time.
+    # Each component gives the displacements of its own epochs relative to its first epoch.
+    # The offset between components is not constrained by the data, so we assume no motion across the gap:
+    # the first epoch of each component continues from the epoch just before it. Orphaned epochs are
+    # carried across the same way; the caller should set them to nan.
+    # Returns (model_num, n_pixels) increments; with robust, each component is solved by solve_robust_group
+    # and the outlier counts of all components are returned too.
+    n_epochs = len(design.labels);
+    relative = np.zeros((n_epochs, np.shape(d)[1]));
+    n_outliers = np.zeros(np.shape(d)[1]);
+    for component in design.components:
+        d_component = d[component.rows, :];
+        w_component = None if w is None else w[component.rows, :];
+        solve = get_component_solver(component, d_component);
+        if robust is None:
+            m_component = solve(w_component);
+        else:
+            m_component, _, outliers = solve_robust_group(component.G, d_component, w_component, solve, robust,
+                                                          robust_iterations);
+            n_outliers = n_outliers + outliers;
+        relative[component.epochs[1:], :] = np.cumsum(m_component, axis=0);
+
+    disp = np.zeros(np.shape(relative));
+    offsets = {};
+    for epoch in range(n_epochs):
+        label = design.labels[epoch];
+        if label not in offsets:  # first epoch of this component
+            offsets[label] = disp[epoch - 1, :] if epoch > 0 else 0;
+        disp[epoch, :] = relative[epoch, :] + offsets[label];
+    if robust is not None:
+        return np.diff(disp, axis=0), n_outliers;
+    return np.diff(disp, axis=0);
+
+
+def get_component_solver(component, d):
+    # solve(w) -> m for the pixels d of one network component
+    def solve(w):
+        if w is None:
+            return np.dot(component.pinv, d);
+        return solve_weighted_group(component.G, d, w);
+    return solve;
+
+
+def increments_to_TS(m, smoothing, wavelength):
+    # m: (model_num, n_pixels) phase increments between epochs. Returns (n_epochs, n_pixels) displacements in mm.
+    # Adding up all the displacement.
+    n_pixels = np.shape(m)[1];
+    m_cumulative = np.vstack((np.zeros((1, n_pixels)), np.cumsum(m, axis=0)));
+
+    # Smoothing after the time series has been created
+    m_cumulative = smooth_TS_cube(m_cumulative, smoothing);
+
+    # Conversion from radians to mm, range change to subsidence, and beginning set to zero
+    disp_ts = -m_cumulative * wavelength / (4 * np.pi);
+    disp_ts = disp_ts - disp_ts[0, :];
+    disp_ts[:, np.isnan(m).any(axis=0)] = np.nan;
+    return disp_ts;
+
+
+def solve_weighted_group(G, d, w, max_elements=2**25):
+    # Weighted least squares for many pixels that share G but not weights.
+    # G: (n_used, model_num); d and w: (n_used, n_pixels). Returns m: (model_num, n_pixels).
+    # G^T W G and G^T W d are accumulated by broadcasting the weights (no dense W),
+    # then every pixel's normal equations are solved through a batched Cholesky factorization.
+    # Pixels are taken in chunks so that the stack of normal matrices stays below max_elements numbers.
+    model_num = np.shape(G)[1];
+    n_pixels = np.shape(d)[1];
+    m = np.full((model_num, n_pixels), np.nan);
+    finite = np.isfinite(w).all(axis=0);  # nan coherence gives a nan solution, as before
+    chunk = max(1, int(max_elements / (model_num * model_num)));
+    for chunk_start in range(0, n_pixels, chunk):
+        cols = np.arange(chunk_start, min(chunk_start + chunk, n_pixels));
+        cols = cols[finite[cols]];
+        if len(cols) == 0:
+            continue;
+        wc = w[:, cols];
+        GTWG = np.einsum('ij,ip,ik->pjk', G, wc, G, optimize=True);  # (n_pixels, model_num, model_num)
+        GTWd = np.dot(G.T, wc * d[:, cols]).T[:, :, np.newaxis];  # (n_pixels, model_num, 1)
+        try:
+            m[:, cols] = cholesky_solve(GTWG, GTWd)[:, :, 0].T;
+        except np.linalg.LinAlgError:  # some pixel has a singular weighted system; solve them one at a time
+            for k in range(len(cols)):
+                try:
+                    m[:, cols[k]] = cholesky_solve(GTWG[k], GTWd[k])[:, 0];
+                except np.linalg.LinAlgError:
+                    continue;
+    return m;
+
+
+def cholesky_solve(A, b):
+    # Solve A x = b for symmetric positive definite A, batched over leading dimensions. x has the shape of b.
+    L = np.linalg.cholesky(A);
+    y = np.linalg.solve(L, b);  # forward substitution
+    x = np.linalg.solve(np.swapaxes(L, -1, -2), y);  # back substitution
+    return x;
+
+
+def check_input_shapes(intf_tuple, signal_spread_data, coh_tuple=None):
+    # Defensive programming, done once for the whole frame, from the shapes only (nothing is read of a lazy stack)
+    grid_shape = tuple(np.shape(intf_tuple.zvalues)[1:]);
+    if grid_shape != np.shape(signal_spread_data):
+        print("ERROR: signal spread does not match input data. Stopping immediately. ");
+        print("Shape of signal spread:", np.shape(signal_spread_data));
+        print("Shape of data array:", grid_shape);
+        sys.exit(1);
+    if coh_tuple is not None:
+        if grid_shape != tuple(np.shape(coh_tuple.zvalues)[1:]):
+            print("ERROR: coherence data does not match input data. Stopping immediately. ");
+            print("Shape of coherence data:", tuple(np.shape(coh_tuple.zvalues)[1:]));
+            print("Shape of data array:", grid_shape);
+            sys.exit(1);
+    return;
+
+
+def get_stack_dtype(zvalues):
+    # The precision that a stack is kept and returned in: its own if it is floating point, otherwise float64.
+    # The solves themselves are always done in float64, one block at a time.
+    dtype = np.dtype(getattr(zvalues, 'dtype', float));
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(float);
+
+
+def get_referenced_block(intf_tuple, rows, rowref, colref, start_index=0, end_index=None):
+    # The (n_intf, n_rows, n_cols) phase of a block of rows with respect to the reference pixel,
+    # and the mask of pixels inside [start_index, end_index) of the column-major pixel counter of iterator_func.
+    # With rowref=colref=None the stack is already referenced (stack_reference) and is used as is.
+    ny, nx = len(intf_tuple.yvalues), len(intf_tuple.xvalues);
+    if end_index is None:
+        end_index = ny * nx;
+    block = np.asarray(intf_tuple.zvalues[:, rows, :], dtype=float);
+    if rowref is not None:
+        reference_pixel_value = np.asarray(intf_tuple.zvalues[:, rowref, colref], dtype=float);
+        block = np.subtract(block, reference_pixel_value[:, np.newaxis, np.newaxis]);
+    row_idx, col_idx = np.meshgrid(np.arange(ny)[rows], np.arange(nx), indexing='ij');
+    pixel_counter = row_idx + col_idx * ny;
+    in_range = (pixel_counter >= start_index) & (pixel_counter < end_index);
+    return block, in_range;
+
+
+def select_pixels(block, in_range, signal_spread, nsbas_good_perc):
+    # Enough signal spread, and fewer than half of the interferograms are nans
+    nan_count = np.sum(np.isnan(block), axis=0);
+    return in_range & (signal_spread > nsbas_good_perc) & (nan_count < len(block) * 0.5);
+
+
+def apply_dem_error(ts_good, datestrs, baseline_file):
+    # DEM error correction of every solved column of a (n_epochs, n_pixels) time series in one least squares call.
+    # Returns the corrected time series and K_z_error for each column (nan where the time series has nans).
+    return dem_error_correction.driver_cube(ts_good, datestrs, baseline_file);
+
+
+def compute_TS_tile(intf_tuple, rows, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data,
+                    datestrs, start_index=0, end_index=None, baseline_file=None, coh_tuple=None, design_cache=None,
+                    split_disconnected=False, uncertainty=False, profiler=None, robust=None,
+                    robust_iterations=ROBUST_ITERATIONS, save_state=False):
+    # The batched equivalent of nsbas.compute_TS for a block of rows.
+    # Returns a (n_epochs, n_rows, n_cols) array in mm, the number of pixels inverted,
+    # and a dictionary of by-products for the same rows:
+    #   'dem_error': K_z_error of the DEM error correction (with a baseline_file)
+    #   'ts_sigma', 'vel_sigma': formal 1-sigma of each epoch in mm and of the velocity in mm/yr (with uncertainty)
+    #   'outliers': number of outlier interferograms of each pixel (with robust)
+    #   'state': the normal equations of the block for a state file, from the same read (with save_state)
+    # Pixels outside [start_index, end_index) are left at zero; pixels that fail the data checks are nans.
+    with stacking_profiler.stage(profiler, 'read'):
+        block, in_range = get_referenced_block(intf_tuple, rows, rowref, colref, start_index, end_index);
+        good = select_pixels(block, in_range, signal_spread_data[rows, :], nsbas_good_perc);
+        data = block[:, good];
+        coh = None;
+        if coh_tuple is not None:
+            coh = np.asarray(coh_tuple.zvalues[:, rows, :], dtype=float)[:, good];
+    if profiler is not None:
+        profiler.add_pixels(np.sum(good), np.sum(in_range) - np.sum(good));
+    ts_tile = np.zeros((len(datestrs), np.shape(good)[0], np.shape(good)[1]));
+    ts_tile[:, in_range] = np.nan;
+    extras = {};
+    if save_state:
+        with stacking_profiler.stage(profiler, 'state'):
+            extras['state'] = get_state_tile(block, in_range, good, intf_tuple.date_pairs_julian, datestrs);
+    solution = solve_nsbas_block(data, intf_tuple.date_pairs_julian, smoothing, wavelength, datestrs, coh=coh,
+                                 design_cache=design_cache, split_disconnected=split_disconnected,
+                                 uncertainty=uncertainty, profiler=profiler, robust=robust,
+                                 robust_iterations=robust_iterations);
+    ts_good = solution.TS;
+    if robust is not None:
+        extras['outliers'] = np.full(np.shape(good), np.nan);
+        extras['outliers'][good] = solution.outliers;
+    if uncertainty:
+        extras['ts_sigma'] = np.full(np.shape(ts_tile), np.nan);
+        extras['ts_sigma'][:, good] = solution.ts_sigma;
+        extras['vel_sigma'] = np.full(np.shape(good), np.nan);
+        extras['vel_sigma'][good] = solution.vel_sigma;
+    if baseline_file is not None:  # If we are implementing a DEM error correction
+        with stacking_profiler.stage(profiler, 'dem_error'):
+            extras['dem_error'] = np.full(np.shape(good), np.nan);
+            ts_good, extras['dem_error'][good] = apply_dem_error(ts_good, datestrs, baseline_file);
+    ts_tile[:, good] = ts_good;
+    return ts_tile, int(np.sum(good)), extras;
+
+
+def get_row_tiles(ny, tile_rows):
+    # Blocks of rows that cover the frame
+    return [slice(row_start, min(row_start + tile_rows, ny)) for row_start in range(0, ny, tile_rows)];
+
+
+def compute_TS_cube(intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data, datestrs,
+                    start_index=0, end_index=None, baseline_file=None, coh_tuple=None, tile_rows=TILE_ROWS, workers=1,
+                    output_file=None, xdates=None, zlib=False, resume=False, state_file=None,
+                    split_disconnected=False, dem_error_file=None, uncertainty=False, sparse_epochs=SPARSE_EPOCHS,
+                    sparse_method='normal', profiler=None, robust=None, robust_iterations=ROBUST_ITERATIONS,
+                    outlier_file=None):
+    # Solve NSBAS for the whole frame, one block of rows at a time.
+    # With workers > 1, the blocks are sent to a pool of processes that share the interferogram cube.
+    # Returns a ts_results whose TS is a (n_epochs, ny, nx) array of displacements in mm, in the precision of the
+    # interferogram cube (float32 for a stack read with dtype=np.float32); each block is solved in float64.
+    # If output_file is given, each block is written into a chunked float32 (t, y, x) NetCDF4 file as soon as
+    # it is solved, so only one block of the time series is held in memory. Then xdates is required
+    # and None is returned. A manifest of finished blocks is kept next to output_file; with resume=True,
+    # a run with the same inputs and parameters picks up where the last one stopped.
+    # If state_file is also given (unweighted, non-robust only), the normal equations of every pixel are saved
+    # there so that nsbas_incremental can add new interferograms later.
+    # split_disconnected: solve pixels with disconnected networks one component at a time (see solve_split_group).
+    # With a baseline_file, the K_z_error map of the DEM error correction is kept in a 'dem_error' variable of
+    # output_file, and also written to dem_error_file if given.
+    # With uncertainty, the formal 1-sigma of each epoch and of the velocity are computed as well: they go in
+    # 'z_sigma' (t, y, x) and 'vel_sigma' (y, x) variables of output_file, or are returned in ts_sigma and vel_sigma.
+    # With more than sparse_epochs epochs, the design matrices are sparse (see DesignMatrixCache).
+    # robust ('huber' or 'l1'): robust NSBAS (see solve_robust_group). The number of outlier interferograms
+    # of each pixel goes in an 'outliers' variable of output_file (or is returned in outliers), and is written to
+    # outlier_file if given.
+    # profiler: a stacking_profiler.Profiler for stage timings, pixel counts and cache hit rates.
+    ny, nx = len(intf_tuple.yvalues), len(intf_tuple.xvalues);
+    tiles = get_row_tiles(ny, tile_rows);
+    if state_file is not None and (output_file is None or coh_tuple is not None or robust is not None):
+        print("ERROR: saving the NSBAS state needs an output_file and unweighted, non-robust NSBAS. "
+              "Stopping immediately. ");
+        sys.exit(1);
+    if output_file is not None:
+        manifest_file = output_file + ".manifest.json";
+        signature = get_run_signature(intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref,
+                                      signal_spread_data, datestrs, start_index, end_index, baseline_file, coh_tuple,
+                                      tile_rows, state_file, split_disconnected, uncertainty, robust,
+                                      robust_iterations);
+        completed = [];
+        if resume and (state_file is None or os.path.isfile(state_file)):
+            completed = read_manifest(manifest_file, output_file, signature);
+        if completed:
+            print("Resuming %s: %d of %d blocks already done" % (output_file, len(completed), len(tiles)));
+            rootgrp = Dataset(output_file, 'a');
+        else:
+            rootgrp = rwr.create_timeseries_netcdf4(intf_tuple.xvalues, intf_tuple.yvalues, xdates, 'mm',
+                                                    output_file, chunk_rows=tile_rows, zlib=zlib);
+            write_manifest(manifest_file, signature, completed);
+        tiles = [rows for rows in tiles if [rows.start, rows.stop] not in completed];
+        TS = rootgrp.variables['z'];
+    else:
+        TS = np.zeros((len(datestrs), ny, nx), dtype=get_stack_dtype(intf_tuple.zvalues));
+    # Where the by-products of each block go: in memory, or variables of output_file
+    extra_specs = [];
+    if baseline_file is not None:
+        extra_specs.append(('dem_error', ('y', 'x'), 'mm/m'));
+    if uncertainty:
+        extra_specs = extra_specs + [('ts_sigma', ('t', 'y', 'x'), 'mm'), ('vel_sigma', ('y', 'x'), 'mm/yr')];
+    if robust is not None:
+        extra_specs.append(('outliers', ('y', 'x'), 'count'));
+    extra_out = {};
+    for name, dims, units in extra_specs:
+        if output_file is not None:
+            extra_out[name] = get_extra_variable(rootgrp, name, dims, units, tile_rows);
+        else:
+            extra_out[name] = np.full(np.shape(TS)[3 - len(dims):], np.nan, dtype=TS.dtype);
+    if state_file is not None:
+        if completed:
+            stategrp = Dataset(state_file, 'a');
+        else:
+            stategrp = create_state_netcdf4(intf_tuple.xvalues, intf_tuple.yvalues, intf_tuple.date_pairs_julian,
+                                            datestrs, rowref, colref, state_file, start_index, end_index,
+                                            chunk_rows=tile_rows);
+    try:
+        for rows, ts_tile, extras in iterate_TS_tiles(intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref,
+                                                      colref, signal_spread_data, datestrs, start_index, end_index,
+                                                      baseline_file, coh_tuple, tile_rows, workers, tiles=tiles,
+                                                      split_disconnected=split_disconnected, uncertainty=uncertainty,
+                                                      sparse_epochs=sparse_epochs, sparse_method=sparse_method,
+                                                      profiler=profiler, robust=robust,
+                                                      robust_iterations=robust_iterations,
+                                                      save_state=state_file is not None):
+            state_tile = extras.pop('state', None);
+            with stacking_profiler.stage(profiler, 'write'):
+                TS[:, rows, :] = ts_tile;
+                for name, tile in extras.items():
+                    if tile.ndim == 3:
+                        extra_out[name][:, rows, :] = tile;
+                    else:
+                        extra_out[name][rows, :] = tile;
+            if state_file is not None:
+                with stacking_profiler.stage(profiler, 'state'):
+                    write_state_tile(stategrp, rows, *state_tile);
+                    stategrp.sync();
+            if output_file is not None:
+                with stacking_profiler.stage(profiler, 'write'):
+                    rootgrp.sync();  # the block is on disk before it goes in the manifest
+                    completed.append([rows.start, rows.stop]);
+                    write_manifest(manifest_file, signature, completed);
+        if dem_error_file is not None and 'dem_error' in extra_out:
+            rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, np.array(extra_out['dem_error'][:, :]),
+                                      'mm/m', dem_error_file);
+        if outlier_file is not None and 'outliers' in extra_out:
+            rwr.produce_output_netcdf(intf_tuple.xvalues, intf_tuple.yvalues, np.array(extra_out['outliers'][:, :]),
+                                      'count', outlier_file);
+    finally:
+        if output_file is not None:
+            rootgrp.close();
+        if state_file is not None:
+            stategrp.close();
+    if output_file is not None:
+        return None;
+    return ts_results(TS=TS, ts_sigma=extra_out.get('ts_sigma'), vel_sigma=extra_out.get('vel_sigma'),
+                      outliers=extra_out.get('outliers'));
+
+
+def get_extra_variable(rootgrp, name, dims, units, chunk_rows=100):
+    # A float32 by-product variable of a time series file, created the first time it is needed.
+    # ts_sigma is stored as z_sigma, next to z.
+    varname = 'z_sigma' if name == 'ts_sigma' else name;
+    if varname not in rootgrp.variables:
+        chunks = [1 if dim == 't' else min(chunk_rows, len(rootgrp.dimensions[dim])) if dim == 'y'
+                  else len(rootgrp.dimensions[dim]) for dim in dims];
+        var = rootgrp.createVariable(varname, 'f4', dims, chunksizes=chunks, fill_value=np.nan);
+        var.units = units;
+    return rootgrp.variables[varname];
+
+
+def iterate_TS_tiles(intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data, datestrs,
+                     start_index=0, end_index=None, baseline_file=None, coh_tuple=None, tile_rows=TILE_ROWS, workers=1,
+                     tiles=None, split_disconnected=False, uncertainty=False, sparse_epochs=SPARSE_EPOCHS,
+                     sparse_method='normal', profiler=None, robust=None, robust_iterations=ROBUST_ITERATIONS,
+                     save_state=False):
+    # Yields (rows, ts_tile, extras) for each block of rows as it is solved, with extras as in compute_TS_tile.
+    # With workers > 1 they arrive in any order.
+    # tiles: the blocks of rows to solve (default: the whole frame in blocks of tile_rows).
+    # profiler: receives stage timings and pixel counts, and emits its reports between blocks and at the end.
+    check_input_shapes(intf_tuple, signal_spread_data, coh_tuple);
+    ny = len(intf_tuple.yvalues);
+    if tiles is None:
+        tiles = get_row_tiles(ny, tile_rows);
+    tile_args = {'nsbas_good_perc': nsbas_good_perc, 'smoothing': smoothing, 'wavelength': wavelength,
+                 'rowref': rowref, 'colref': colref, 'signal_spread_data': signal_spread_data, 'datestrs': datestrs,
+                 'start_index': start_index, 'end_index': end_index, 'baseline_file': baseline_file,
+                 'split_disconnected': split_disconnected, 'uncertainty': uncertainty, 'robust': robust,
+                 'robust_iterations': robust_iterations, 'save_state': save_state};
+    cache_args = {'sparse_epochs': sparse_epochs, 'sparse_method': sparse_method};
+    print("Performing batched NSBAS on %d files with %d worker(s)" % (len(intf_tuple.zvalues), workers));
+    print("Started at: ");
+    print(dt.datetime.now());
+    if workers > 1 and len(tiles) > 0:
+        for result in iterate_TS_tiles_parallel(intf_tuple, coh_tuple, tiles, tile_args, cache_args, workers):
+            rows, ts_tile, n_inverted, extras, delta, profile, worker_id, cache_stats = result;
+            print_tile_progress(rows, ny, n_inverted, delta);
+            if profiler is not None:
+                profiler.merge(profile);
+                profiler.watch_cache('design_matrix/worker%d' % worker_id, cache_stats);
+                profiler.maybe_emit();
+            yield rows, ts_tile, extras;
+    else:
+        design_cache = DesignMatrixCache(intf_tuple.date_pairs_julian, datestrs, **cache_args);
+        if profiler is not None:
+            profiler.watch_cache('design_matrix', design_cache);
+        for rows in tiles:
+            previous_time = dt.datetime.now();
+            ts_tile, n_inverted, extras = compute_TS_tile(intf_tuple, rows, **tile_args, coh_tuple=coh_tuple,
+                                                          design_cache=design_cache, profiler=profiler);
+            print_tile_progress(rows, ny, n_inverted, dt.datetime.now() - previous_time);
+            if profiler is not None:
+                profiler.maybe_emit();
+            yield rows, ts_tile, extras;
+        print("Design matrix cache: %(hits)d hits, %(misses)d misses, %(size)d patterns kept" % design_cache.stats());
+    print("Finished at: ");
+    print(dt.datetime.now());
+    if profiler is not None:
+        profiler.emit(final=True);
+    return;
+
+
+def print_tile_progress(rows, ny, n_inverted, delta):
+    print("Done with rows %d to %d of %d: %d inversions took %.2f s" % (rows.start, rows.stop, ny, n_inverted,
+                                                                          delta.total_seconds()));
+    return;
+
+
+# ------------ CHECKPOINTS ------------ #
+# The manifest is a small json file next to the output: the run signature and the list of finished blocks.
+# It is rewritten atomically after every block, so a killed job loses at most the blocks in flight.
+
+def get_run_signature(intf_tuple, nsbas_good_perc, smoothing, wavelength, rowref, colref, signal_spread_data,
+                      datestrs, start_index, end_index, baseline_file, coh_tuple, tile_rows, state_file=None,
+                      split_disconnected=False, uncertainty=False, robust=None, robust_iterations=ROBUST_ITERATIONS):
+    # Everything that changes the numbers in the output. A resumed run must match it exactly.
+    # Input files are known by their paths and mtimes; the signal spread grid by a checksum of its values.
+    signal_spread = np.ascontiguousarray(signal_spread_data, dtype=float);
+    signature = {'filepaths': [str(f) for f in intf_tuple.filepaths], 'mtimes': get_mtimes(intf_tuple.filepaths),
+                 'date_pairs': [str(f) for f in intf_tuple.date_pairs_julian], 'datestrs': list(datestrs),
+                 'shape': [len(intf_tuple.yvalues), len(intf_tuple.xvalues)], 'tile_rows': tile_rows,
+                 'nsbas_good_perc': float(nsbas_good_perc), 'smoothing': float(smoothing),
+                 'wavelength': float(wavelength), 'ref': get_reference_signature(intf_tuple, rowref, colref),
+                 'signal_spread': hashlib.sha1(signal_spread.tobytes()).hexdigest(),
+                 'index_range': [float(start_index), None if end_index is None else float(end_index)],
+                 'baseline_file': baseline_file,
+                 'baseline_mtime': None if baseline_file is None else get_mtimes([baseline_file])[0],
+                 'coh_filepaths': None if coh_tuple is None else [str(f) for f in coh_tuple.filepaths],
+                 'coh_mtimes': None if coh_tuple is None else get_mtimes(coh_tuple.filepaths),
+                 'state_file': state_file, 'split_disconnected': bool(split_disconnected),
+                 'uncertainty': bool(uncertainty), 'robust': robust, 'robust_iterations': int(robust_iterations)};
+    return signature;
+
+
+def get_mtimes(filepaths):
+    # None for a file that is not on disk, such as a stack built in memory
+    return [os.path.getmtime(f) if os.path.isfile(f) else None for f in filepaths];
+
+
+def get_reference_signature(intf_tuple, rowref, colref):
+    # The reference pixel; or, for a stack that is already referenced, a checksum of its middle row,
+    # which changes with any change of reference (pixel, window or GPS velocity).
+    if rowref is not None:
+        return [int(rowref), int(colref)];
+    middle_row = np.asarray(intf_tuple.zvalues[:, len(intf_tuple.yvalues) // 2, :], dtype=float);
+    return 'referenced %.12e' % np.nansum(middle_row);
+
+
+def read_manifest(manifest_file, output_file, signature):
+    # Returns the finished blocks as [[row_start, row_stop], ...] if we can resume, otherwise []
+    if not (os.path.isfile(manifest_file) and os.path.isfile(output_file)):
+        return [];
+    with open(manifest_file, 'r') as ifile:
+        manifest = json.load(ifile);
+    if manifest['signature'] != json.loads(json.dumps(signature)):
+        print("Manifest %s is from a different run; starting over." % manifest_file);
+        return [];
+    return manifest['completed'];
+
+
+def write_manifest(manifest_file, signature, completed):
+    temp_file = manifest_file + ".tmp";
+    with open(temp_file, 'w') as ofile:
+        json.dump({'signature': signature, 'completed': completed}, ofile);
+        ofile.flush();
+        os.fsync(ofile.fileno());
+    os.replace(temp_file, manifest_file);
+    return;
+
+
+# ------------ NORMAL EQUATION STATE ------------ #
+# For unweighted NSBAS, G^T G of a pixel only depends on which interferograms it used.
+# So the state of a run is, for every pixel: a bitmask of the interferograms used and G^T d.
+# That is enough to add new interferograms later without re-reading the old ones (see nsbas_incremental).
+
+def create_state_netcdf4(xdata, ydata, date_pairs, datestrs, rowref, colref, state_file, start_index=0,
+                         end_index=None, chunk_rows=100):
+    print("Creating NSBAS state file %s " % state_file);
+    n_bytes = (len(date_pairs) + 7) // 8;
+    chunks = (1, max(min(chunk_rows, len(ydata)), 1), max(len(xdata), 1));
+    root_grp = Dataset(state_file, 'w', format="NETCDF4");
+    root_grp.history = 'NSBAS normal equations';
+    root_grp.date_pairs = ' '.join([str(i) for i in date_pairs]);
+    root_grp.datestrs = ' '.join(datestrs);
+    root_grp.rowref = -1 if rowref is None else int(rowref);  # -1: the stack was already referenced
+    root_grp.colref = -1 if colref is None else int(colref);
+    root_grp.start_index = float(start_index);
+    root_grp.end_index = float(len(xdata) * len(ydata) if end_index is None else end_index);
+    root_grp.createDimension('incr', len(datestrs) - 1);
+    root_grp.createDimension('byte', n_bytes);
+    root_grp.createDimension('y', len(ydata));
+    root_grp.createDimension('x', len(xdata));
+    x = root_grp.createVariable('x', 'f8', ('x',));
+    x[:] = xdata;
+    y = root_grp.createVariable('y', 'f8', ('y',));
+    y[:] = ydata;
+    root_grp.createVariable('GTd', 'f8', ('incr', 'y', 'x'), chunksizes=chunks, fill_value=0);
+    root_grp.createVariable('valid', 'u1', ('byte', 'y', 'x'), chunksizes=chunks, fill_value=0);
+    root_grp.createVariable('selected', 'u1', ('y', 'x'), chunksizes=chunks[1:], fill_value=0);
+    return root_grp;
+
+
+def get_state_tile(block, in_range, good, date_pairs, datestrs):
+    # block: (n_intf, n_rows, n_cols) referenced phase. Every pixel in range is saved, inverted or not,
+    # so that a pixel can be picked up once new interferograms give it enough data.
+    # Returns G^T d, the packed validity of each interferogram, and the pixels inverted, for write_state_tile.
+    first_idx, second_idx = get_epoch_indices(date_pairs, datestrs);
+    G_all = build_G(first_idx, second_idx, len(datestrs) - 1);
+    n_rows, nx = np.shape(in_range);
+    data = block[:, in_range];
+    GTd = np.zeros((np.shape(G_all)[1], n_rows, nx));
+    GTd[:, in_range] = np.dot(G_all.T, np.nan_to_num(data));  # nans contribute nothing
+    valid = np.zeros(((len(block) + 7) // 8, n_rows, nx), dtype=np.uint8);
+    valid[:, in_range] = np.packbits(~np.isnan(data), axis=0);
+    return GTd, valid, good;
+
+
+def write_state_tile(root_grp, rows, GTd, valid, good):
+    root_grp.variables['GTd'][:, rows, :] = GTd;
+    root_grp.variables['valid'][:, rows, :] = valid;
+    root_grp.variables['selected'][rows, :] = good.astype(np.uint8);
+    return;
+
+
+# ------------ PARALLEL ------------ #
+# The interferogram cube (and coherence cube) go into shared memory once.
+# Each worker attaches to them and solves blocks of rows. Only the solved block
+# comes back to the main process, which puts it in place (in memory or on disk).
+
+_worker_state = {};
+
+
+def share_array(array):
+    # Copy an array into a new block of shared memory
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1));
+    shared = np.ndarray(np.shape(array), dtype=array.dtype, buffer=shm.buf);
+    shared[:] = array;
+    return shm, shared;
+
+
+def share_stack(zvalues, dtype):
+    # Copy a (n_intf, ny, nx) cube into shared memory in its own layout (see readmytupledata.empty_stack).
+    # Returns the shared memory and the spec for attach_shared_array.
+    # A lazy stack is not read here: each worker reads its own blocks from the files.
+    if isinstance(zvalues, rmd.LazyStack):
+        return None, zvalues;
+    layout = rmd.get_layout(zvalues);
+    array = np.asarray(zvalues, dtype=dtype);
+    if layout == 'pixel':
+        array = np.moveaxis(array, 0, -1);
+    shm, _ = share_array(array);
+    return shm, (shm.name, np.shape(array), dtype, layout);
+
+
+def attach_shared_array(spec):
+    # spec is (name, shape, dtype, layout) of a block of shared memory made by share_stack, or a lazy stack
+    if isinstance(spec, rmd.LazyStack):
+        return None, spec;
+    name, shape, dtype, layout = spec;
+    shm = shared_memory.SharedMemory(name=name);
+    shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf);
+    if layout == 'pixel':
+        shared = shared.transpose(2, 0, 1);
+    return shm, shared;
+
+
+def init_worker(specs, intf_header, coh_header, tile_args, cache_args):
+    # Runs once in each worker process: attach to the shared cubes
+    for key in specs.keys():
+        _worker_state[key + '_shm'], _worker_state[key] = attach_shared_array(specs[key]);
+    _worker_state['intf_tuple'] = intf_header._replace(zvalues=_worker_state['intf']);
+    _worker_state['coh_tuple'] = None;
+    if coh_header is not None:
+        _worker_state['coh_tuple'] = coh_header._replace(zvalues=_worker_state['coh']);
+    _worker_state['tile_args'] = tile_args;
+    _worker_state['design_cache'] = DesignMatrixCache(intf_header.date_pairs_julian, tile_args['datestrs'],
+                                                      **cache_args);
+    return;
+
+
+def solve_tile_in_worker(rows):
+    start_time = dt.datetime.now();
+    profiler = stacking_profiler.Profiler(interval=None, verbose=False);  # counters for this block only
+    ts_tile, n_inverted, extras = compute_TS_tile(_worker_state['intf_tuple'], rows, **_worker_state['tile_args'],
+                                                  coh_tuple=_worker_state['coh_tuple'],
+                                                  design_cache=_worker_state['design_cache'], profiler=profiler);
+    return (rows, ts_tile, n_inverted, extras, dt.datetime.now() - start_time, profiler.snapshot(), os.getpid(),
+            _worker_state['design_cache'].stats());
+
+
+def iterate_TS_tiles_parallel(intf_tuple, coh_tuple, tiles, tile_args, cache_args, workers):
+    shms = [];
+    try:
+        # The cubes are shared in their own precision (a float32 stack stays float32)
+        intf_shm, intf_spec = share_stack(intf_tuple.zvalues, get_stack_dtype(intf_tuple.zvalues));
+        shms.append(intf_shm);
+        specs = {'intf': intf_spec};
+        coh_header = None;
+        if coh_tuple is not None:
+            coh_shm, coh_spec = share_stack(coh_tuple.zvalues, get_stack_dtype(coh_tuple.zvalues));
+            shms.append(coh_shm);
+            specs['coh'] = coh_spec;
+            coh_header = coh_tuple._replace(zvalues=None);
+        with multiprocessing.Pool(workers, initializer=init_worker,
+                                  initargs=(specs, intf_tuple._replace(zvalues=None), coh_header, tile_args,
+                                            cache_args)) as pool:
+            for result in pool.imap_unordered(solve_tile_in_worker, tiles):
+                yield result;
+    finally:
+        for shm in shms:
+            if shm is not None:
+                shm.close();
+                shm.unlink();
+    return;
+
+
+def velocities_from_TS_cube(TS, x_axis_days, max_nans=0, full_output=False, tile_rows=TILE_ROWS):
+    # Linear velocity in mm/yr for every pixel of a (n_epochs, ny, nx) time series cube in mm, in one closed-form pass.
+    # Each pixel uses only its non-nan epochs (masked normal equations for a line).
+    # The fit is done in float64, one block of rows at a time; the grids come back in the precision of TS.
+    # Pixels with more than max_nans nans, or fewer than 2 epochs, get nan.
+    # With full_output, also returns the intercept (mm), the residual RMS (mm), and the formal 1-sigma
+    # velocity uncertainty (mm/yr) from the residual scatter.
+    n_TS, ny, nx = np.shape(TS);
+    x_mean = np.mean(x_axis_days);
+    x = np.array(x_axis_days, dtype=float) - x_mean;  # centered for better conditioning
+    vel, intercept, rms, vel_sigma = [np.full((ny, nx), np.nan, dtype=get_stack_dtype(TS)) for _ in range(4)];
+    for rows in get_row_tiles(ny, tile_rows):
+        y = np.reshape(np.asarray(TS[:, rows, :], dtype=float), (n_TS, -1));
+        w = ~np.isnan(y);
+        y = np.where(w, y, 0);
+        n = np.sum(w, axis=0);
+        Sx = np.dot(x, w);
+        Sxx = np.dot(x * x, w);
+        Sy = np.sum(y, axis=0);
+        Sxy = np.dot(x, y);
+        det = n * Sxx - Sx * Sx;
+        ok = (n >= 2) & (n_TS - n <= max_nans) & (det > 0);
+        det = np.where(ok, det, 1);
+        slope = (n * Sxy - Sx * Sy) / det;
+        offset = (Sy - slope * Sx) / np.maximum(n, 1);
+        residuals = np.where(w, y - offset - slope * x[:, np.newaxis], 0);
+        rss = np.sum(residuals * residuals, axis=0);
+        sigma = np.sqrt(rss / np.maximum(n - 2, 1) * n / det);
+        sigma[n <= 2] = np.nan;  # no residual scatter to measure
+        shape = (-1, nx);
+        vel[rows, :] = np.reshape(np.where(ok, slope * 365.24, np.nan), shape);  # mm/day to mm/yr
+        intercept[rows, :] = np.reshape(np.where(ok, offset - slope * x_mean, np.nan), shape);
+        rms[rows, :] = np.reshape(np.where(ok, np.sqrt(rss / np.maximum(n, 1)), np.nan), shape);
+        vel_sigma[rows, :] = np.reshape(np.where(ok, sigma * 365.24, np.nan), shape);
+    if full_output:
+        return vel, intercept, rms, vel_sigma;
+    return vel;
@@ -0,0 +1,136 @@
+# Incremental NSBAS.
+# When a few new acquisitions come in, we don't want to re-read and re-invert the whole stack.
+# For unweighted NSBAS, the solution of each pixel only depends on G^T G and G^T d.
+# G^T G is set by which interferograms the pixel uses, and G^T d can be updated by adding the new rows.
+# A full run saves both in a state file (nsbas.Full_TS with state_file); here we read that state,
+# re-express it on the new set of epochs, add the new interferograms, and solve again.
+# The result matches a full NSBAS run on the old and new interferograms together.
+
+import numpy as np
+import sys
+import os
+import nsbas
+import nsbas_batched
+import netcdf_read_write as rwr
+from netCDF4 import Dataset
+
+
+def read_state_header(state_file):
+    # The interferograms, epochs, and reference pixel of a saved NSBAS state
+    rootgrp = Dataset(state_file, 'r');
+    header = {'date_pairs': rootgrp.date_pairs.split(), 'datestrs': rootgrp.datestrs.split(),
+              'rowref': None if int(rootgrp.rowref) < 0 else int(rootgrp.rowref),
+              'colref': None if int(rootgrp.colref) < 0 else int(rootgrp.colref),
+              'start_index': float(rootgrp.start_index), 'end_index': float(rootgrp.end_index),
+              'xvalues': np.array(rootgrp.variables['x'][:]), 'yvalues': np.array(rootgrp.variables['y'][:])};
+    rootgrp.close();
+    return header;
+
+
+def map_old_increments(old_datestrs, new_datestrs):
+    # For each increment between new epochs, the old increment that contains it, or -1 if outside the old range.
+    # An old interferogram covers the new increment c exactly when it covers old increment old_of_new[c],
+    # so the old G^T d re-expressed on the new epochs is just old_GTd[old_of_new].
+    old_idx = np.searchsorted(old_datestrs, new_datestrs[0:-1], side='right') - 1;
+    outside = (old_idx < 0) | (old_idx >= len(old_datestrs) - 1);
+    old_idx[outside] = -1;
+    return old_idx;
+
+
+def update_TS_tile(stategrp, new_tuple, keep, rows, n_old_intf, old_of_new, G_new, design_cache, header,
+                   nsbas_good_perc, smoothing, wavelength, signal_spread_data, datestrs, baseline_file=None):
+    # Combine the saved normal equations with the new interferograms for a block of rows.
+    # Returns the new time series (n_epochs, n_rows, n_cols), the new G^T d and validity, and the pixels inverted.
+    block, in_range = nsbas_batched.get_referenced_block(new_tuple, rows, header['rowref'], header['colref'],
+                                                         header['start_index'], header['end_index']);
+    block = block[keep];
+    old_GTd = np.asarray(stategrp.variables['GTd'][:, rows, :], dtype=float);
+    old_valid = np.unpackbits(np.asarray(stategrp.variables['valid'][:, rows, :]), axis=0, count=n_old_intf);
+    valid = np.concatenate((old_valid.astype(bool), ~np.isnan(block)), axis=0);
+
+    GTd = np.zeros((len(old_of_new), np.shape(in_range)[0], np.shape(in_range)[1]));
+    GTd[old_of_new >= 0] = old_GTd[old_of_new[old_of_new >= 0]];
+    GTd = GTd + np.tensordot(G_new.T, np.nan_to_num(block), axes=1);
+    GTd[:, ~in_range] = 0;
+    valid[:, ~in_range] = False;
+
+    # Same pixel selection as nsbas.compute_TS, on all the interferograms
+    nan_count = len(valid) - np.sum(valid, axis=0);
+    good = in_range & (signal_spread_data[rows, :] > nsbas_good_perc) & (nan_count < len(valid) * 0.5);
+
+    m = np.full((len(old_of_new), int(np.sum(good))), np.nan);
+    patterns, groups = nsbas_batched.group_by_validity(valid[:, good]);
+    GTd_good = GTd[:, good];
+    for used, pixels in zip(patterns, groups):
+        design = design_cache.get(used);
+        if not design.connected:
+            print("SINGULAR MATRIX ENCOUNTERED FOR %d PIXELS. RETURNING VECTORS OF NANS." % len(pixels));
+            continue;
+        m[:, pixels] = nsbas_batched.solve_normal(design, GTd_good[:, pixels]);
+    ts_good = nsbas_batched.increments_to_TS(m, smoothing, wavelength);
+    if baseline_file is not None:
+        ts_good, _ = nsbas_batched.apply_dem_error(ts_good, datestrs, baseline_file);
+
+    ts_tile = np.zeros((len(datestrs), np.shape(good)[0], np.shape(good)[1]));
+    ts_tile[:, in_range] = np.nan;
+    ts_tile[:, good] = ts_good;
+    return ts_tile, GTd, valid, good;
+
+
+def update_TS(new_tuple, nsbas_good_perc, smoothing, wavelength, signal_spread_data, TS_file, state_file,
+              baseline_file=None, tile_rows=nsbas_batched.TILE_ROWS, zlib=False):
+    # Add the interferograms in new_tuple to the NSBAS run saved in TS_file and state_file.
+    # If the full run was given an already-referenced stack, new_tuple must be referenced the same way.
+    # Interferograms already in the state are ignored. Both files are rewritten with the new epochs;
+    # they are built next to the old ones and only replace them at the end, so a failed update leaves
+    # the old run in place.
+    header = read_state_header(state_file);
+    if len(new_tuple.yvalues) != len(header['yvalues']) or len(new_tuple.xvalues) != len(header['xvalues']):
+        print("ERROR: new interferograms do not match the grid of %s. Stopping immediately. " % state_file);
+        sys.exit(1);
+    old_pairs = header['date_pairs'];
+    keep = np.array([str(pair) not in old_pairs for pair in new_tuple.date_pairs_julian], dtype=bool);
+    new_pairs = [str(pair) for pair, k in zip(new_tuple.date_pairs_julian, keep) if k];
+    print("Adding %d new interferograms to %d old ones (%d already in the state)" % (
+        len(new_pairs), len(old_pairs), len(keep) - len(new_pairs)));
+    if len(new_pairs) == 0:
+        return;
+
+    date_pairs = old_pairs + new_pairs;
+    datestrs, x_dts, _ = nsbas.get_TS_dates(date_pairs);
+    old_of_new = map_old_increments(header['datestrs'], datestrs);
+    first_idx, second_idx = nsbas_batched.get_epoch_indices(new_pairs, datestrs);
+    G_new = nsbas_batched.build_G(first_idx, second_idx, len(datestrs) - 1);
+    design_cache = nsbas_batched.DesignMatrixCache(date_pairs, datestrs);
+    print("Epochs: %d before, %d after" % (len(header['datestrs']), len(datestrs)));
+
+    ny, nx = len(header['yvalues']), len(header['xvalues']);
+    tiles = nsbas_batched.get_row_tiles(ny, tile_rows);
+    stategrp = Dataset(state_file, 'r');
+    stategrp.set_auto_mask(False);
+    new_TS = rwr.create_timeseries_netcdf4(header['xvalues'], header['yvalues'], x_dts, 'mm', TS_file + '.tmp',
+                                           chunk_rows=tile_rows, zlib=zlib);
+    new_state = nsbas_batched.create_state_netcdf4(header['xvalues'], header['yvalues'], date_pairs, datestrs,
+                                                   header['rowref'], header['colref'], state_file + '.tmp',
+                                                   header['start_index'], header['end_index'], chunk_rows=tile_rows);
+    try:
+        for rows in tiles:
+            ts_tile, GTd, valid, good = update_TS_tile(stategrp, new_tuple, keep, rows, len(old_pairs), old_of_new,
+                                                       G_new, design_cache, header, nsbas_good_perc, smoothing,
+                                                       wavelength, signal_spread_data, datestrs, baseline_file);
+            new_TS.variables['z'][:, rows, :] = ts_tile;
+            new_state.variables['GTd'][:, rows, :] = GTd;
+            new_state.variables['valid'][:, rows, :] = np.packbits(valid, axis=0);
+            new_state.variables['selected'][rows, :] = good.astype(np.uint8);
+            print("Rows %d-%d of %d: %d pixels inverted" % (rows.start, rows.stop, ny, np.sum(good)));
+    finally:
+        stategrp.close();
+        new_TS.close();
+        new_state.close();
+    print("Design matrix cache:", design_cache.stats());
+
+    os.replace(TS_file + '.tmp', TS_file);
+    os.replace(state_file + '.tmp', state_file);
+    if os.path.isfile(TS_file + ".manifest.json"):
+        os.remove(TS_file + ".manifest.json");  # the blocks of the full run no longer describe TS_file
+    return;
@@ -1,85 +1,457 @@
 #!/usr/bin/python
 import numpy as np
 import collections
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
+import sys
+import multiprocessing
+import concurrent.futures
 import netcdf_read_write as rwr
+from netCDF4 import Dataset
 
 data = collections.namedtuple('data', ['filepaths', 'date_pairs_julian', 'date_deltas',
                                        'xvalues', 'yvalues', 'zvalues', 'date_pairs_dt', 'ts_dates']);
 
 
-def reader(filepathslist):
+def reader(filepathslist, dtype=float, workers=1, layout='image', lazy=False, window=None, bounds=None, decimate=1):
     """
     This function takes in a list of filepaths to GMTSAR grd files, effectively taking in a cuboid of data. 
     It splits and returns this data in a named tuple.
+    dtype: precision of the zvalues cube, e.g. np.float32 to halve its memory. Masked values become nans.
+    workers: number of files decoded at a time, by a pool of processes (see read_grids).
+    layout: 'image' stores zvalues one image after another; 'pixel' stores the time series of each pixel
+    contiguously, which makes per-pixel slices like zvalues[:, i, j] fast. zvalues is (n_files, ny, nx) either way.
+    lazy: zvalues is a LazyStack that only reads the windows it is sliced with, for frames larger than memory.
+    window, bounds, decimate: read only part of each grid, straight from the files (see get_read_window).
     """
     filepaths = []
     date_pairs_julian, date_deltas, date_pairs = [], [], []
-    xvalues, yvalues, zvalues = [], [], []
     for i in range(len(filepathslist)):
-        print(filepathslist[i])
         # Establish timing and filepath information
         filepaths.append(filepathslist[i])
-        datesplit = re.findall(r"\d\d\d\d\d\d\d_\d\d\d\d\d\d\d", filepathslist[i])[0];  # example: 2010040_2014052
-        # adding 1 to both dates because 000 = January 1
-        date_new = datesplit.replace(datesplit[0:7], str(int(datesplit[0:7]) + 1))  # replacing first date
-        date_new = date_new.replace(date_new[8:15], str(int(date_new[8:15]) + 1))  # replacing second date
-        date_pairs_julian.append(date_new[0:15])  # example: 2015158_2018178
-        acq1 = datetime.strptime(date_new[0:7], '%Y%j');
-        acq2 = datetime.strptime(date_new[8:15], '%Y%j');
+        date_new, acq1, acq2, delta_years = get_gmtsar_dates(filepathslist[i]);
+        date_pairs_julian.append(date_new)  # example: 2015158_2018178
         date_pairs.append([acq1, acq2]);
-        delta = abs(acq1 - acq2)  # timedelta object
-        date_deltas.append(delta.days / 365.24)  # in years. 
+        date_deltas.append(delta_years)  # in years. 
 
-        # Read in the data
-        xdata, ydata, zdata = rwr.read_netcdf4_xyz(filepathslist[i]);  # does this work on netcdf3 as well? 
-        zvalues.append(zdata)
-        if i == round(len(filepathslist) / 2):
-            print('halfway done reading files...')
+    # Read in the data
+    [xdata, ydata] = read_xy_axes(filepathslist[0]);
+    rows, cols = get_read_window(xdata, ydata, window, bounds, decimate);
+    if lazy:
+        zvalues = LazyStack(filepathslist, dtype, rows=rows, cols=cols);
+    else:
+        zvalues = read_grids(filepathslist, read_netcdf_grid, dtype, workers, pool='process', layout=layout,
+                             extra_args=(rows, cols));
+    xdata, ydata = xdata[cols], ydata[rows];
 
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=np.array(date_pairs_julian),
                   date_deltas=np.array(date_deltas), xvalues=np.array(xdata), yvalues=np.array(ydata),
-                  zvalues=np.array(zvalues), date_pairs_dt=np.array(date_pairs), ts_dates=None);
+                  zvalues=zvalues, date_pairs_dt=np.array(date_pairs), ts_dates=None);
     return mydata
 
 
-def reader_from_ts(filepathslist, xvar="x", yvar="y", zvar="z"):
+def get_gmtsar_dates(filepath):
+    # The dates of a GMTSAR interferogram from the YYYYDDD_YYYYDDD in its path.
+    # Returns the julian pair string, the two datetimes, and the time between them in years.
+    datesplit = re.findall(r"\d\d\d\d\d\d\d_\d\d\d\d\d\d\d", filepath)[0];  # example: 2010040_2014052
+    # adding 1 to both dates because 000 = January 1
+    date_new = datesplit.replace(datesplit[0:7], str(int(datesplit[0:7]) + 1))  # replacing first date
+    date_new = date_new.replace(date_new[8:15], str(int(date_new[8:15]) + 1))  # replacing second date
+    acq1 = datetime.strptime(date_new[0:7], '%Y%j');
+    acq2 = datetime.strptime(date_new[8:15], '%Y%j');
+    delta = abs(acq1 - acq2)  # timedelta object
+    return date_new[0:15], acq1, acq2, delta.days / 365.24;
+
+
+def reader_points(filepathslist, rows, cols, radius=0, workers=1, dtype=float):
+    """
+    Like reader(), but only reads the (2*radius+1) x (2*radius+1) boxes around a few (row, col) pixels of each
+    GMTSAR grd file, with windowed netCDF reads, spread over `workers` processes (one at a time by default).
+    zvalues has shape (n_files, n_points, 2*radius+1, 2*radius+1), with the pixel at the center of its box
+    and nans outside the grid. xvalues and yvalues are the axes of the whole grid.
+    """
+    date_pairs_julian, date_deltas, date_pairs = [], [], []
+    for filepath in filepathslist:
+        date_new, acq1, acq2, delta_years = get_gmtsar_dates(filepath);
+        date_pairs_julian.append(date_new);
+        date_pairs.append([acq1, acq2]);
+        date_deltas.append(delta_years);
+    [xdata, ydata] = read_xy_axes(filepathslist[0]);
+    print("Reading %d pixels (radius %d) from %d files with %d worker(s)" % (len(rows), radius, len(filepathslist),
+                                                                           workers));
+    jobs = [(filepath, rows, cols, radius, dtype) for filepath in filepathslist];
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            boxes = pool.map(read_point_boxes, jobs, chunksize=max(len(jobs) // (4 * workers), 1));
+    else:
+        boxes = [read_point_boxes(job) for job in jobs];
+    mydata = data(filepaths=np.array(filepathslist), date_pairs_julian=np.array(date_pairs_julian),
+                  date_deltas=np.array(date_deltas), xvalues=np.array(xdata), yvalues=np.array(ydata),
+                  zvalues=np.array(boxes, dtype=dtype).reshape(len(filepathslist), len(rows), 2 * radius + 1,
+                                                               2 * radius + 1),
+                  date_pairs_dt=np.array(date_pairs), ts_dates=None);
+    return mydata;
+
+
+def read_xy_axes(filename):
+    # Only the x and y axes of a grid (the first two variables, as in rwr.read_netcdf4_xyz)
+    rootgrp = Dataset(filename, "r");
+    [xkey, ykey] = list(rootgrp.variables.keys())[0:2];
+    xdata, ydata = np.array(rootgrp.variables[xkey][:]), np.array(rootgrp.variables[ykey][:]);
+    rootgrp.close();
+    return [xdata, ydata];
+
+
+def read_point_boxes(job):
+    # The (n_points, 2*radius+1, 2*radius+1) boxes around each (row, col) of one grid file.
+    # Only the hyperslab of each box is read from the file.
+    filename, rows, cols, radius, dtype = job;
+    width = 2 * radius + 1;
+    boxes = np.full((len(rows), width, width), np.nan, dtype=dtype);
+    rootgrp = Dataset(filename, "r");
+    zvar = rootgrp.variables[list(rootgrp.variables.keys())[2]];
+    ny, nx = zvar.shape;
+    for k in range(len(rows)):
+        row0, col0 = int(rows[k]) - radius, int(cols[k]) - radius;  # the upper left corner of the box
+        r0, r1 = max(row0, 0), min(row0 + width, ny);
+        c0, c1 = max(col0, 0), min(col0 + width, nx);
+        if r0 < r1 and c0 < c1:
+            boxes[k, r0 - row0:r1 - row0, c0 - col0:c1 - col0] = as_float_grid(zvar[r0:r1, c0:c1], dtype);
+    rootgrp.close();
+    return boxes;
+
+
+def read_grids(filepathslist, read_grid, dtype=float, workers=1, pool='thread', extra_args=(), layout='image'):
+    # Decode every file with read_grid((filepath, dtype) + extra_args) into a preallocated (n_files, ny, nx) cube,
+    # in the order of filepathslist. dtype=None keeps the type of the first grid.
+    # layout='pixel' preallocates the cube in pixel-major order (see empty_stack).
+    # With workers > 1, that many files are decoded at a time by a pool of threads (pool='thread'; most of the
+    # time on network storage is spent waiting on reads) or of processes (pool='process'; needed for netCDF4/HDF5,
+    # whose C library is not thread-safe). Each grid is copied into the cube as it arrives.
+    jobs = [(filepath, dtype) + tuple(extra_args) for filepath in filepathslist];
+    print(filepathslist[0]);
+    first = read_grid(jobs[0]);
+    zvalues = empty_stack((len(jobs),) + np.shape(first),
+                          first.dtype.newbyteorder('=') if dtype is None else dtype, layout);
+    zvalues[0] = first;
+    if workers <= 1:
+        for i in range(1, len(jobs)):
+            print(filepathslist[i]);
+            zvalues[i] = read_grid(jobs[i]);
+            if i == round(len(jobs) / 2):
+                print('halfway done reading files...');
+        return zvalues;
+
+    print("Reading %d files with %d %s worker(s)" % (len(jobs), workers, pool));
+    if pool == 'thread':
+        def fill(i):
+            zvalues[i] = read_grid(jobs[i]);
+            return;
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            list(executor.map(fill, range(1, len(jobs))));
+    elif pool == 'process':
+        with multiprocessing.Pool(workers) as process_pool:
+            grids = process_pool.imap(read_grid, jobs[1:], chunksize=max(len(jobs) // (4 * workers), 1));
+            for i, grid in enumerate(grids, start=1):
+                zvalues[i] = grid;
+    else:
+        print("ERROR: pool must be 'thread' or 'process', not %s. Stopping immediately. " % pool);
+        sys.exit(1);
+    print("Done reading %d files" % len(jobs));
+    return zvalues;
+
+
+def empty_stack(shape, dtype=float, layout='image'):
+    # An uninitialized (n_files, ny, nx) cube.
+    # 'image': C order, each image contiguous.
+    # 'pixel': a (n_files, ny, nx) view of a C-order (ny, nx, n_files) array, so the values of each pixel are
+    #   contiguous and per-pixel solvers read one cache line instead of one image per value.
+    if layout == 'image':
+        return np.empty(shape, dtype=dtype);
+    if layout == 'pixel':
+        return np.empty((shape[1], shape[2], shape[0]), dtype=dtype).transpose(2, 0, 1);
+    print("ERROR: layout must be 'image' or 'pixel', not %s. Stopping immediately. " % layout);
+    sys.exit(1);
+
+
+def get_layout(zvalues):
+    # 'pixel' if the values of each pixel of a (n_files, ny, nx) cube are contiguous, otherwise 'image'
+    zvalues = np.asanyarray(zvalues);
+    if zvalues.ndim == 3 and len(zvalues) > 1 and np.moveaxis(zvalues, 0, -1).flags['C_CONTIGUOUS']:
+        return 'pixel';
+    return 'image';
+
+
+def to_pixel_major(mydata):
+    # The same tuple with zvalues copied into the pixel-major layout (see empty_stack)
+    zvalues = empty_stack(np.shape(mydata.zvalues), mydata.zvalues.dtype, 'pixel');
+    zvalues[:] = mydata.zvalues;
+    return mydata._replace(zvalues=zvalues);
+
+
+def get_read_window(xdata, ydata, window=None, bounds=None, decimate=1):
+    # The rows and columns of the grids to read, as slices that the netCDF and GDAL readers take directly.
+    # window: (row_start, row_stop, col_start, col_stop) in pixels.
+    # bounds: (xmin, xmax, ymin, ymax) in the units of the x and y axes (lon/lat for geocoded grids).
+    # With both, the overlap is read. decimate: keep every decimate-th row and column, for quick looks.
+    ny, nx = len(ydata), len(xdata);
+    row_start, row_stop, col_start, col_stop = 0, ny, 0, nx;
+    if window is not None:
+        row_start, row_stop = max(int(window[0]), 0), min(int(window[1]), ny);
+        col_start, col_stop = max(int(window[2]), 0), min(int(window[3]), nx);
+    if bounds is not None:
+        cols = np.where((xdata >= bounds[0]) & (xdata <= bounds[1]))[0];
+        rows = np.where((ydata >= bounds[2]) & (ydata <= bounds[3]))[0];
+        if len(cols) > 0 and len(rows) > 0:
+            row_start, row_stop = max(row_start, rows[0]), min(row_stop, rows[-1] + 1);
+            col_start, col_stop = max(col_start, cols[0]), min(col_stop, cols[-1] + 1);
+        else:
+            row_start, row_stop = 0, 0;
+    if row_start >= row_stop or col_start >= col_stop:
+        print("ERROR: the window %s / bounds %s contain no pixels of the grid. Stopping immediately. " % (
+            window, bounds));
+        sys.exit(1);
+    return slice(int(row_start), int(row_stop), int(decimate)), slice(int(col_start), int(col_stop), int(decimate));
+
+
+def compose_index(base, key):
+    # Index of the full grid for index key of the window base (a slice of the full grid),
+    # as an int or a slice where possible, so that the reads stay hyperslabs
+    index = np.asarray(base)[key];
+    if np.ndim(index) == 0:
+        return int(index);
+    if len(index) == 0:
+        return slice(0, 0);
+    if len(index) == 1:
+        return slice(int(index[0]), int(index[0]) + 1);
+    step = index[1] - index[0];
+    if step > 0 and np.all(np.diff(index) == step):
+        return slice(int(index[0]), int(index[-1]) + 1, int(step));
+    return index;
+
+
+class LazyStack:
+    # A (n_files, ny, nx) stack of netCDF grids that reads only the windows it is sliced with.
+    # It stands in for the zvalues cube of a tuple: zvalues[:, rows, :] reads those rows from each file,
+    # zvalues[k] reads one whole grid, and np.asarray(zvalues) reads everything.
+    # Reads of single rows or pixels (per-pixel loops, reference pixels) are served from a cached block of
+    # cache_rows full rows, so a loop over pixels in row order reads each file once per block.
+    # offsets: a value per file subtracted from everything read (see with_offsets).
+    # rows, cols: the part of each grid that the stack covers (see get_read_window).
+    def __init__(self, filepathslist, dtype=float, offsets=None, cache_rows=16, rows=slice(None), cols=slice(None)):
+        self.filepaths = list(filepathslist);
+        self.dtype = np.dtype(dtype);
+        self.offsets = offsets;
+        self.cache_rows = cache_rows;
+        self.rows, self.cols = rows, cols;
+        rootgrp = Dataset(self.filepaths[0], "r");
+        full_shape = rootgrp.variables[list(rootgrp.variables.keys())[2]].shape;
+        rootgrp.close();
+        self.row_index, self.col_index = np.arange(full_shape[0])[rows], np.arange(full_shape[1])[cols];
+        self.shape = (len(self.filepaths), len(self.row_index), len(self.col_index));
+        self.ndim = 3;
+        self._block = None;  # (first row, cube of cache_rows rows)
+
+    def __len__(self):
+        return self.shape[0];
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:, :, :], dtype=dtype);
+
+    def __getstate__(self):
+        state = dict(self.__dict__);
+        state['_block'] = None;  # workers read their own windows
+        return state;
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,);
+        key = key + (slice(None),) * (3 - len(key));
+        files, rows, cols = np.arange(self.shape[0])[key[0]], key[1], key[2];
+        if isinstance(rows, (int, np.integer)):
+            row = int(rows) % self.shape[1];
+            return self.get_block(row)[files, row - self._block[0], cols];
+        window = self.read_windows(np.atleast_1d(files), rows, cols);
+        return window[0] if np.ndim(files) == 0 else window;
+
+    def get_block(self, row):
+        # The cached cube of full rows that contains row
+        if self._block is None or not self._block[0] <= row < self._block[0] + self.cache_rows:
+            first = row - row % self.cache_rows;
+            rows = slice(first, min(first + self.cache_rows, self.shape[1]));
+            self._block = (first, self[:, rows, :]);
+        return self._block[1];
+
+    def read_windows(self, files, rows, cols):
+        # The [rows, cols] windows of files, one file at a time
+        return np.array([self.read_window(k, rows, cols) for k in files], dtype=self.dtype);
+
+    def read_window(self, k, rows, cols):
+        # The [rows, cols] window of file k, with nans where masked and its offset removed
+        rows, cols = compose_index(self.row_index, rows), compose_index(self.col_index, cols);
+        rootgrp = Dataset(self.filepaths[k], "r");
+        window = as_float_grid(rootgrp.variables[list(rootgrp.variables.keys())[2]][rows, cols], self.dtype);
+        rootgrp.close();
+        if self.offsets is not None:
+            window = window - self.dtype.type(self.offsets[k]);
+        return window;
+
+    def with_offsets(self, offsets):
+        # The same stack with offsets[k] also subtracted from every value of file k (e.g. a reference)
+        total = np.asarray(offsets, dtype=float) if self.offsets is None else self.offsets + offsets;
+        return LazyStack(self.filepaths, self.dtype, total, self.cache_rows, self.rows, self.cols);
+
+
+class LazyTimeSeries(LazyStack):
+    # A (n_epochs, ny, nx) time series in one 3D (t, y, x) netCDF file, such as TS.nc, read like a LazyStack.
+    # A window of many epochs is one hyperslab of zvar, so zvalues[:, rows, :] reads the chunks of those rows
+    # (TS.nc is chunked by blocks of rows, see rwr.create_timeseries_netcdf4) instead of opening a file per date.
+    def __init__(self, filename, zvar="z", dtype=float, offsets=None, cache_rows=16, rows=slice(None),
+                 cols=slice(None)):
+        self.filename, self.zvar = filename, zvar;
+        self.dtype = np.dtype(dtype);
+        self.offsets = offsets;
+        self.cache_rows = cache_rows;
+        self.rows, self.cols = rows, cols;
+        rootgrp = Dataset(filename, "r");
+        full_shape = rootgrp.variables[zvar].shape;
+        rootgrp.close();
+        self.filepaths = [filename] * full_shape[0];
+        self.row_index, self.col_index = np.arange(full_shape[1])[rows], np.arange(full_shape[2])[cols];
+        self.shape = (full_shape[0], len(self.row_index), len(self.col_index));
+        self.ndim = 3;
+        self._block = None;
+
+    def read_windows(self, files, rows, cols):
+        # The [rows, cols] windows of the epochs in files, in one read when they are evenly spaced
+        epochs = compose_index(files, slice(None));
+        if not isinstance(epochs, slice):
+            return LazyStack.read_windows(self, files, rows, cols);
+        rows, cols = compose_index(self.row_index, rows), compose_index(self.col_index, cols);
+        rootgrp = Dataset(self.filename, "r");
+        window = as_float_grid(rootgrp.variables[self.zvar][epochs, rows, cols], self.dtype);
+        rootgrp.close();
+        if self.offsets is not None:
+            offsets = np.asarray(self.offsets, dtype=self.dtype)[files];
+            window = window - np.reshape(offsets, (-1,) + (1,) * (np.ndim(window) - 1));
+        return window;
+
+    def read_window(self, k, rows, cols):
+        return self.read_windows(np.array([k]), rows, cols)[0];
+
+    def with_offsets(self, offsets):
+        total = np.asarray(offsets, dtype=float) if self.offsets is None else self.offsets + offsets;
+        return LazyTimeSeries(self.filename, self.zvar, self.dtype, total, self.cache_rows, self.rows, self.cols);
+
+
+def read_netcdf_grid(job):
+    # The z grid of one netCDF3/4 file (the third variable, as in rwr.read_netcdf4_xyz), as an array of dtype.
+    # Only the [rows, cols] hyperslab is read.
+    filename, dtype, rows, cols = job;
+    rootgrp = Dataset(filename, "r");
+    zdata = rootgrp.variables[list(rootgrp.variables.keys())[2]][rows, cols];
+    rootgrp.close();
+    return as_float_grid(zdata, dtype);
+
+
+def read_simple_grid(job):
+    # The z grid of one netCDF3 grd file, in its own type
+    filename, _ = job;
+    return rwr.read_grd(filename);
+
+
+def read_isce_grid(job):
+    # One band of an ISCE file, as an array of dtype. Only the rows and columns of the window are read by GDAL;
+    # the decimation (the step of the slices) is applied after.
+    import isce_read_write
+    filename, dtype, band, rows, cols = job;
+    # NOTE: For unwrapped files, this will be band=2
+    # flush_zeros=False preserves the zeros in the input datasets. Added April 9 2020.
+    zdata = isce_read_write.read_scalar_data(filename, band, flush_zeros=False, window=(
+        cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start));
+    return as_float_grid(zdata[::rows.step, ::cols.step], dtype);
+
+
+def as_float_grid(zdata, dtype=float):
+    # A 2D grid from the netCDF readers (maybe a masked array) as a plain array of dtype, with nans where masked
+    return np.ma.filled(np.ma.asarray(zdata).astype(dtype), np.nan);
+
+
+def reader_from_ts(filepathslist, xvar="x", yvar="y", zvar="z", dtype=float, workers=1, layout='image',
+                   lazy=False, window=None, bounds=None, decimate=1):
     """ 
     This function makes a tuple of grids in timesteps
     It can read in radar coords or geocoded coords, depending on the use of xvar, yvar
+    dtype, workers, layout, lazy, window, bounds, decimate: as in reader()
     """
     filepaths = [];
-    zvalues = [];
     ts_dates = [];
     for i in range(len(filepathslist)):
-        print(filepathslist[i])
         # Establish timing and filepath information
         filepaths.append(filepathslist[i]);
         datestr = filepathslist[i].split('/')[-1][0:8];
         datestr = filepathslist[i].split('/')[-1]
         datestr = re.findall(r"\d\d\d\d\d\d\d\d", filepathslist[i])[0];
         ts_dates.append(datetime.strptime(datestr, "%Y%m%d"));
-        # Read in the data, either netcdf3 or netcdf4
-        [xvalues, yvalues, zdata] = rwr.read_netcdf4_xyz(filepathslist[i]);
-        zvalues.append(zdata);
-        if i == round(len(filepathslist) / 2):
-            print('halfway done reading files...');
+    # Read in the data, either netcdf3 or netcdf4
+    [xvalues, yvalues] = read_xy_axes(filepathslist[0]);
+    rows, cols = get_read_window(xvalues, yvalues, window, bounds, decimate);
+    if lazy:
+        zvalues = LazyStack(filepathslist, dtype, rows=rows, cols=cols);
+    else:
+        zvalues = read_grids(filepathslist, read_netcdf_grid, dtype, workers, pool='process', layout=layout,
+                             extra_args=(rows, cols));
+    xvalues, yvalues = xvalues[cols], yvalues[rows];
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=None, date_deltas=None,
-                  xvalues=np.array(xvalues), yvalues=np.array(yvalues), zvalues=np.array(zvalues),
+                  xvalues=np.array(xvalues), yvalues=np.array(yvalues), zvalues=zvalues,
                   date_pairs_dt=None, ts_dates=np.array(ts_dates));
     return mydata;
 
 
-def reader_simple_format(file_names):
+def reader_ts_netcdf(filename, xvar="x", yvar="y", zvar="z", tvar="t", dtype=float, lazy=True, window=None,
+                     bounds=None, decimate=1, start_date=None):
+    """
+    This function makes a tuple of grids in timesteps from one 3D (t, y, x) time series file, like TS.nc,
+    instead of one grd file per date as in reader_from_ts.
+    ts_dates are decoded from the t variable, in "days since YYYY-MM-DD". Files whose t units are only "days"
+    (written before produce_output_timeseries stored the start date) need start_date, the first epoch.
+    lazy: zvalues is a LazyTimeSeries that reads only the windows it is sliced with, straight from the file.
+    dtype, window, bounds, decimate: as in reader()
+    """
+    rootgrp = Dataset(filename, "r");
+    rootgrp.set_auto_mask(False);
+    tvar_units = getattr(rootgrp.variables[tvar], 'units', 'days');
+    ts_dates = get_ts_dates(rootgrp.variables[tvar][:], tvar_units, start_date);
+    xvalues = np.array(rootgrp.variables[xvar][:]);
+    yvalues = np.array(rootgrp.variables[yvar][:]);
+    rootgrp.close();
+    rows, cols = get_read_window(xvalues, yvalues, window, bounds, decimate);
+    zvalues = LazyTimeSeries(filename, zvar, dtype, rows=rows, cols=cols);
+    if not lazy:
+        zvalues = np.asarray(zvalues);
+    xvalues, yvalues = xvalues[cols], yvalues[rows];
+    mydata = data(filepaths=np.array([filename] * len(ts_dates)), date_pairs_julian=None, date_deltas=None,
+                  xvalues=xvalues, yvalues=yvalues, zvalues=zvalues, date_pairs_dt=None, ts_dates=ts_dates);
+    return mydata;
+
+
+def get_ts_dates(tdata, units, start_date=None):
+    # The datetimes of a t axis in days, with units like "days since 2016-01-05" or just "days" from start_date
+    if 'since' in units:
+        start_date = datetime.strptime(units.split('since')[-1].strip()[0:10], "%Y-%m-%d");
+    elif start_date is None:
+        print("ERROR: the t axis is in '%s', with no start date; give a start_date. Stopping immediately. " % units);
+        sys.exit(1);
+    return np.array([start_date + timedelta(days=int(days)) for days in tdata]);
+
+
+def reader_simple_format(file_names, workers=1):
     """
     An earlier reading function, works fast, useful for things like coherence statistics
+    workers: number of files decoded at a time, by a pool of threads. data_all is one (n_files, ny, nx) array.
     """
     [xdata, ydata] = rwr.read_grd_xy(file_names[0]);
-    data_all = [];
-    for ifile in file_names:  # this happens to be in date order on my mac
-        data = rwr.read_grd(ifile);
-        data_all.append(data);
+    data_all = read_grids(file_names, read_simple_grid, None, workers, pool='thread');  # in the order of file_names
     date_pairs = [];
     for name in file_names:
         pairname = name.split('/')[-2][0:15];
@@ -88,18 +460,20 @@ def reader_simple_format(file_names):
     return [xdata, ydata, data_all, date_pairs];
 
 
-def reader_isce(filepathslist, band=1):
-    import isce_read_write
-
+def reader_isce(filepathslist, band=1, dtype=float, workers=1, layout='image', window=None, decimate=1):
     """
     This function takes in a list of filepaths that each contain a 2d array of data, effectively taking
     in a cuboid of data. It splits and stores this data in a named tuple which is returned. This can then be used
     to extract key pieces of information. It reads in ISCE format. 
+    dtype: precision of the zvalues cube, as in reader()
+    workers: number of files decoded at a time, by a pool of threads
+    layout: as in reader()
+    window, decimate: as in reader(); the x and y values are the pixel numbers of the full raster
     """
+    import isce_read_write
 
     filepaths = []
     date_pairs_julian, date_deltas, date_pairs = [], [], []
-    xvalues, yvalues, zvalues = [], [], []
     for i in range(len(filepathslist)):
         filepaths.append(filepathslist[i])
         # In the case of ISCE, we have the dates in YYYYMMDD_YYYYMMDD format somewhere within the filepath (maybe multiple times). We take the first. 
@@ -113,17 +487,15 @@ def reader_isce(filepathslist, band=1):
         delta = abs(date1 - date2)
         date_deltas.append(delta.days / 365.24)  # in years.
 
-        zdata = isce_read_write.read_scalar_data(filepathslist[i], band,
-                                                 flush_zeros=False);  # NOTE: For unwrapped files, this will be band=2
-        # flush_zeros=False preserves the zeros in the input datasets. Added April 9 2020. Hope it doesn't break anything else. 
-        xvalues = range(0, np.shape(zdata)[1]);
-        yvalues = range(0, np.shape(zdata)[0]);
-        zvalues.append(zdata)
-        if i == round(len(filepathslist) / 2):
-            print('halfway done reading files...')
+    ny, nx = isce_read_write.read_raster_shape(filepathslist[0]);
+    rows, cols = get_read_window(np.arange(nx), np.arange(ny), window, None, decimate);
+    zvalues = read_grids(filepathslist, read_isce_grid, dtype, workers, pool='thread', extra_args=(band, rows, cols),
+                         layout=layout);
+    xvalues = np.arange(nx)[cols];
+    yvalues = np.arange(ny)[rows];
 
     mydata = data(filepaths=np.array(filepaths), date_pairs_julian=np.array(date_pairs_julian),
                   date_deltas=np.array(date_deltas), xvalues=np.array(xvalues), yvalues=np.array(yvalues),
-                  zvalues=np.array(zvalues), date_pairs_dt=date_pairs, ts_dates=None);
+                  zvalues=zvalues, date_pairs_dt=date_pairs, ts_dates=None);
 
     return mydata;
@@ -0,0 +1,131 @@
+# A persistent cache of interferogram stacks, shared by the stacking stages.
+# The first stage that reads a list of files decodes them once into a binary cube (a .npy file) in cache_dir,
+# with a manifest of the file paths, their sizes and mtimes, the reader, the dtype, and the date metadata.
+# Later stages that read the same files get a tuple whose zvalues is a memory map of that cube,
+# opened in milliseconds instead of decoding every grid again.
+# The map is copy-on-write, so stages that change the stack in place (stack_reference) never change the cache.
+# If any of the files has changed since, the cache is rebuilt.
+# With layout='pixel', the cube is written and mapped in pixel-major order (see readmytupledata.empty_stack),
+# so every stage that reads it gets contiguous time series.
+#
+#   intf_tuple = stack_cache.read_stack(intf_files, cache_dir='/local/scratch/stack_cache');
+
+import numpy as np
+import datetime as dt
+import hashlib
+import json
+import sys
+import os
+import readmytupledata as rmd
+
+READERS = {'gmtsar': rmd.reader, 'isce': rmd.reader_isce, 'ts': rmd.reader_from_ts};
+
+
+def read_stack(filepathslist, cache_dir=None, reader='gmtsar', dtype=float, workers=1, layout='image',
+               **reader_args):
+    # Read a stack with one of the READERS, through the cache in cache_dir if given.
+    # reader_args go to the reader (e.g. window, bounds and decimate; band for 'isce').
+    if reader not in READERS:
+        print("ERROR: reader must be one of %s, not %s. Stopping immediately. " % (list(READERS.keys()), reader));
+        sys.exit(1);
+    if cache_dir is None:
+        return READERS[reader](filepathslist, dtype=dtype, workers=workers, layout=layout, **reader_args);
+    return cached_reader(filepathslist, cache_dir, reader, dtype, workers, layout, **reader_args);
+
+
+def cached_reader(filepathslist, cache_dir, reader='gmtsar', dtype=float, workers=1, layout='image',
+                  **reader_args):
+    # The stack from the cache if it is valid; otherwise read it, write the cache, and serve it from there.
+    cube_file, manifest_file = get_cache_files(filepathslist, cache_dir, reader, dtype, layout, reader_args);
+    manifest = get_manifest(filepathslist, reader, dtype, layout, reader_args);
+    mydata = read_stack_cache(filepathslist, cube_file, manifest_file, manifest);
+    if mydata is not None:
+        print("Read %d files from stack cache %s" % (len(filepathslist), cube_file));
+        return mydata;
+    mydata = READERS[reader](filepathslist, dtype=dtype, workers=workers, layout=layout, **reader_args);
+    write_stack_cache(mydata, cube_file, manifest_file, manifest);
+    return read_stack_cache(filepathslist, cube_file, manifest_file, manifest);
+
+
+def get_cache_files(filepathslist, cache_dir, reader, dtype, layout, reader_args):
+    # The cube and manifest files of a stack, named after the files, reader and dtype (not the mtimes,
+    # so that a changed file replaces its old cache instead of adding a new one)
+    key = json.dumps([[os.path.abspath(x) for x in filepathslist], reader, np.dtype(dtype).str, layout,
+                      sorted(reader_args.items())]);
+    name = "stack_" + hashlib.sha1(key.encode()).hexdigest()[0:16];
+    return os.path.join(cache_dir, name + ".npy"), os.path.join(cache_dir, name + ".json");
+
+
+def get_manifest(filepathslist, reader, dtype, layout, reader_args):
+    # What a cache must match to be valid: every file, its size and mtime, the reader, the dtype and the layout
+    files = [];
+    for filepath in filepathslist:
+        stat = os.stat(filepath);
+        files.append([os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns]);
+    return {'files': files, 'reader': reader, 'dtype': np.dtype(dtype).str, 'layout': layout,
+            'reader_args': json.loads(json.dumps(reader_args))};  # as it reads back from the manifest
+
+
+def read_stack_cache(filepathslist, cube_file, manifest_file, manifest):
+    # The cached tuple, with zvalues as a copy-on-write memory map; None if there is no valid cache
+    if not os.path.isfile(manifest_file) or not os.path.isfile(cube_file):
+        return None;
+    try:
+        with open(manifest_file, 'r') as ifile:
+            saved = json.load(ifile);
+    except ValueError:
+        return None;
+    if any([saved.get(key) != manifest[key] for key in manifest.keys()]):
+        print("Stack cache %s is out of date" % cube_file);
+        return None;
+    zvalues = np.load(cube_file, mmap_mode='c');
+    if saved['layout'] == 'pixel':
+        zvalues = zvalues.transpose(2, 0, 1);  # stored as (ny, nx, n_files)
+    if list(np.shape(zvalues)) != saved['shape']:
+        return None;
+    return rmd.data(filepaths=np.array(filepathslist), date_pairs_julian=from_json(saved['date_pairs_julian']),
+                    date_deltas=from_json(saved['date_deltas']),
+                    xvalues=np.array(saved['xvalues'], dtype=saved['axis_dtypes'][0]),
+                    yvalues=np.array(saved['yvalues'], dtype=saved['axis_dtypes'][1]), zvalues=zvalues,
+                    date_pairs_dt=from_json(saved['date_pairs_dt'], dates=True),
+                    ts_dates=from_json(saved['ts_dates'], dates=True));
+
+
+def write_stack_cache(mydata, cube_file, manifest_file, manifest):
+    # The cube goes in first and the manifest last, each through a temporary file,
+    # so a cache that was interrupted is never taken as valid.
+    os.makedirs(os.path.dirname(cube_file) or '.', exist_ok=True);
+    print("Writing stack cache %s" % cube_file);
+    with open(cube_file + '.tmp', 'wb') as ofile:
+        if manifest['layout'] == 'pixel':
+            np.save(ofile, np.moveaxis(np.asarray(mydata.zvalues), 0, -1));
+        else:
+            np.save(ofile, np.asarray(mydata.zvalues));
+    os.replace(cube_file + '.tmp', cube_file);
+    saved = dict(manifest);
+    saved.update({'shape': list(np.shape(mydata.zvalues)),
+                  'date_pairs_julian': to_json(mydata.date_pairs_julian), 'date_deltas': to_json(mydata.date_deltas),
+                  'date_pairs_dt': to_json(mydata.date_pairs_dt), 'ts_dates': to_json(mydata.ts_dates),
+                  'xvalues': np.asarray(mydata.xvalues).tolist(), 'yvalues': np.asarray(mydata.yvalues).tolist(),
+                  'axis_dtypes': [np.asarray(mydata.xvalues).dtype.str, np.asarray(mydata.yvalues).dtype.str]});
+    with open(manifest_file + '.tmp', 'w') as ofile:
+        json.dump(saved, ofile);
+    os.replace(manifest_file + '.tmp', manifest_file);
+    return;
+
+
+def to_json(values):
+    # Metadata of a tuple as JSON: None, or nested lists with datetimes as ISO strings
+    if values is None:
+        return None;
+    values = np.asarray(values, dtype=object);
+    return np.vectorize(lambda x: x.isoformat() if isinstance(x, dt.datetime) else x, otypes=[object])(
+        values).tolist();
+
+
+def from_json(values, dates=False):
+    if values is None:
+        return None;
+    if dates:
+        return np.vectorize(dt.datetime.fromisoformat, otypes=[object])(np.array(values, dtype=object));
+    return np.array(values);
@@ -3,6 +3,7 @@ import numpy as np
 import glob, sys
 import netcdf_read_write as rwr
 import readmytupledata as rmd
+import stack_cache
 import netcdf_read_write
 
 
@@ -14,7 +15,7 @@ def stack_corr(mytuple, cutoff):
     print('Number of files being stacked: ' + str(len(mytuple.filepaths)));
     a = np.zeros((len(mytuple.yvalues), len(mytuple.xvalues)))
     c = 0;
-    it = np.nditer(mytuple.zvalues[0, :, :], flags=['multi_index'], order='F');  # iterate through the 3D array of data
+    it = np.nditer(mytuple.zvalues[0, :, :], flags=['multi_index'], order='C');  # row by row through the data
     while not it.finished:
         i = it.multi_index[0];
         j = it.multi_index[1];
@@ -49,10 +50,11 @@ def dummy_signal_spread(intfs, output_dir, output_filename):
     return;
 
 
-def drive_signal_spread_calculation(corr_files, cutoff, output_dir, output_filename):
+def drive_signal_spread_calculation(corr_files, cutoff, output_dir, output_filename, cache_dir=None):
+    # cache_dir: read the coherence through the stack cache there (see stack_cache)
     print("Making stack_corr")
     output_file = output_dir + "/" + output_filename
-    mytuple = rmd.reader(corr_files)  
+    mytuple = stack_cache.read_stack(corr_files, cache_dir)
     a = stack_corr(mytuple, cutoff)  # if unwrapped files, we use Nan to show when it was unwrapped successfully.
     rwr.produce_output_netcdf(mytuple.xvalues, mytuple.yvalues, a, 'Percentage', output_file)
     rwr.produce_output_plot(output_file, 'Signal Spread', output_dir + '/signalspread.png',
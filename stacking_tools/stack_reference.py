@@ -0,0 +1,67 @@
+# Referencing a stack of interferograms.
+# Every stacking method works on phase with respect to a reference. Instead of subtracting the reference
+# from each pixel as it is used, the stack is referenced once here, and the stacking functions are
+# called with rowref=colref=None to say that the data is already referenced.
+# The reference of each interferogram can be:
+#    a single pixel (window=0),
+#    the nanmean of a (2*window+1) x (2*window+1) box around the reference pixel,
+#    either of those, anchored to the LOS velocity of a GPS station at the reference pixel, so that the
+#    reference moves like the station instead of being held fixed.
+
+import numpy as np
+import sys
+import readmytupledata as rmd
+
+
+def get_reference_vector(intf_tuple, rowref, colref, window=0, gps_los_velocity=None, wavelength=None):
+    # The (n_intf,) phase to subtract from every pixel of each interferogram.
+    # gps_los_velocity: mm/yr of the station at (rowref, colref), positive in the direction of nsbas displacements.
+    ny, nx = len(intf_tuple.yvalues), len(intf_tuple.xvalues);
+    rows = slice(max(rowref - window, 0), min(rowref + window + 1, ny));
+    cols = slice(max(colref - window, 0), min(colref + window + 1, nx));
+    box = np.asarray(intf_tuple.zvalues[:, rows, cols], dtype=float);
+    return reference_from_box(box, intf_tuple.date_deltas, gps_los_velocity, wavelength);
+
+
+def reference_from_box(box, date_deltas, gps_los_velocity=None, wavelength=None):
+    # The reference of each interferogram from the (n_intf, ...) values around the reference pixel
+    ref_vector = box_mean(box);
+    if np.sum(np.isnan(ref_vector)) > 0:
+        print("WARNING: reference is nan in %d of %d interferograms; they will be all nans." % (
+            np.sum(np.isnan(ref_vector)), len(ref_vector)));
+    if gps_los_velocity is not None:
+        if wavelength is None:
+            print("ERROR: a GPS-anchored reference needs the wavelength. Stopping immediately. ");
+            sys.exit(1);
+        # The station moves gps_los_velocity * date_delta between the two dates, which is this much phase
+        # with the sign convention of nsbas (displacement = phase * -wavelength / (4 pi))
+        gps_phase = -4 * np.pi / wavelength * gps_los_velocity * np.asarray(date_deltas, dtype=float);
+        ref_vector = ref_vector - gps_phase;
+    return ref_vector;
+
+
+def box_mean(box):
+    # nanmean of each interferogram over the other axes of an (n_intf, ...) array; nan if they are all nans
+    box = np.reshape(np.asarray(box, dtype=float), (len(box), -1));
+    n_valid = np.sum(~np.isnan(box), axis=1);
+    mean = np.full(len(box), np.nan);
+    mean[n_valid > 0] = np.nansum(box[n_valid > 0], axis=1) / n_valid[n_valid > 0];
+    return mean;
+
+
+def reference_stack(intf_tuple, rowref, colref, window=0, gps_los_velocity=None, wavelength=None, in_place=True):
+    # Subtract the reference of each interferogram from the whole cube, once.
+    # in_place=True overwrites intf_tuple.zvalues to avoid a second copy of the stack.
+    # A lazy stack (readmytupledata.LazyStack) is not read: the reference is subtracted as it is read.
+    # Returns the referenced tuple; pass it on with rowref=colref=None.
+    ref_vector = get_reference_vector(intf_tuple, rowref, colref, window, gps_los_velocity, wavelength);
+    print("Referencing the stack to row/col %d, %d (window %d%s)" % (
+        rowref, colref, window, "" if gps_los_velocity is None else ", GPS %.2f mm/yr" % gps_los_velocity));
+    zvalues = intf_tuple.zvalues;
+    if isinstance(zvalues, rmd.LazyStack):  # subtracted as the windows are read
+        return intf_tuple._replace(zvalues=zvalues.with_offsets(ref_vector));
+    if not in_place or not isinstance(zvalues, np.ndarray) or not np.issubdtype(zvalues.dtype, np.floating):
+        zvalues = np.array(zvalues, dtype=float);
+    np.subtract(zvalues, ref_vector[:, np.newaxis, np.newaxis].astype(zvalues.dtype), out=zvalues);
+    return intf_tuple._replace(zvalues=zvalues);
+
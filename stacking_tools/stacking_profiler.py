@@ -0,0 +1,105 @@
+# Timing and throughput instrumentation for the stacking pipeline.
+# A Profiler accumulates wall time per stage (read, design matrix, solve, smoothing, DEM error, write...),
+# counts of pixels inverted and skipped, and the hit rates of the design matrix caches.
+# Every `interval` seconds it emits a JSON report: printed, appended as one line to json_file,
+# and passed to callback(report) if given. Pass one to Full_TS / Velocities with profiler=...
+#
+#   profiler = stacking_profiler.Profiler('full_ts', interval=60, json_file='profile.jsonl');
+#   nsbas.Full_TS(..., profiler=profiler);
+
+import time
+import json
+import contextlib
+
+
+class Profiler:
+    def __init__(self, name='nsbas', interval=60.0, callback=None, json_file=None, verbose=True):
+        # interval: seconds between reports while running; None for only the final report.
+        self.name = name;
+        self.interval = interval;
+        self.callback = callback;
+        self.json_file = json_file;
+        self.verbose = verbose;
+        self.start_time = time.perf_counter();
+        self.last_emit = self.start_time;
+        self.stages = {};  # name: [seconds, calls]
+        self.pixels_inverted = 0;
+        self.pixels_skipped = 0;
+        self.caches = {};  # name: stats() of a cache, or a cache object with a stats() method
+
+    def add_time(self, stage_name, seconds, calls=1):
+        entry = self.stages.setdefault(stage_name, [0.0, 0]);
+        entry[0] = entry[0] + seconds;
+        entry[1] = entry[1] + calls;
+        return;
+
+    def add_pixels(self, inverted, skipped=0):
+        self.pixels_inverted = self.pixels_inverted + int(inverted);
+        self.pixels_skipped = self.pixels_skipped + int(skipped);
+        return;
+
+    def watch_cache(self, cache_name, cache):
+        # cache: anything with a stats() method returning at least 'hits' and 'misses', or such a dictionary
+        self.caches[cache_name] = cache;
+        return;
+
+    def merge(self, snapshot):
+        # Add the stage times and pixel counts of another profiler's snapshot(), e.g. from a worker process.
+        for stage_name, (seconds, calls) in snapshot['stages'].items():
+            self.add_time(stage_name, seconds, calls);
+        self.add_pixels(snapshot['pixels_inverted'], snapshot['pixels_skipped']);
+        return;
+
+    def snapshot(self):
+        # The picklable counters of this profiler, for merge()
+        return {'stages': {k: tuple(v) for k, v in self.stages.items()}, 'pixels_inverted': self.pixels_inverted,
+                'pixels_skipped': self.pixels_skipped};
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time;
+        caches = {};
+        hits, misses = 0, 0;
+        for cache_name, cache in self.caches.items():
+            stats = cache.stats() if hasattr(cache, 'stats') else dict(cache);
+            caches[cache_name] = stats;
+            hits, misses = hits + stats['hits'], misses + stats['misses'];
+        return {'name': self.name, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'elapsed_s': elapsed,
+                'stages': {k: {'seconds': v[0], 'calls': v[1]} for k, v in self.stages.items()},
+                'pixels': {'inverted': self.pixels_inverted, 'skipped': self.pixels_skipped,
+                           'total': self.pixels_inverted + self.pixels_skipped},
+                'pixels_per_s': (self.pixels_inverted + self.pixels_skipped) / elapsed if elapsed > 0 else 0.0,
+                'inversions_per_s': self.pixels_inverted / elapsed if elapsed > 0 else 0.0,
+                'caches': caches, 'cache_hit_rate': hits / (hits + misses) if hits + misses > 0 else 0.0};
+
+    def emit(self, final=False):
+        report = self.report();
+        report['final'] = final;
+        line = json.dumps(report);
+        if self.verbose:
+            print("PROFILE " + line);
+        if self.json_file is not None:
+            with open(self.json_file, 'a') as ofile:
+                ofile.write(line + "\n");
+        if self.callback is not None:
+            self.callback(report);
+        self.last_emit = time.perf_counter();
+        return report;
+
+    def maybe_emit(self):
+        # Emit a report if the interval has passed since the last one
+        if self.interval is not None and time.perf_counter() - self.last_emit >= self.interval:
+            self.emit();
+        return;
+
+
+@contextlib.contextmanager
+def stage(profiler, stage_name):
+    # with stage(profiler, 'solve'): ...   Times the block if profiler is not None.
+    if profiler is None:
+        yield;
+        return;
+    start = time.perf_counter();
+    try:
+        yield;
+    finally:
+        profiler.add_time(stage_name, time.perf_counter() - start);
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import re
 import netcdf_read_write
+import readmytupledata
 import get_ra_rc_from_ll
 
 
@@ -275,46 +276,45 @@ def make_igram_plot(config_params, igram_files):
     return;
 
 
-def find_connected_dates(date_pairs, sample_date):
-    connected_dates = [];
-    for i in range(len(date_pairs)):
-        if date_pairs[i][0:7] == sample_date:
-            connected_dates.append(date_pairs[i][8:15]);
-        if date_pairs[i][8:15] == sample_date:
-            connected_dates.append(date_pairs[i][0:7]);
-    return connected_dates;
-
-
 def connected_components_search(date_pairs, datestrs):
     # Are we inverting a complete network?
     # This function will catch both 'disconnected networks' and 'bad day' cases.
     # We want only one connected component with len==len(datestrs).
     # Otherwise the network should fail.
-    # 1. initialize the queue with the first date
-    # 2. find anything connected to that date, add to the queue.
-    # 3. When all of the dates connected to the first date have been added to queue, pop the first date from queue
-    # 4. Repeat until the queue is gone.
-    # 5. See if all dates have been added to the component.
-
-    # Initializing first time through
-    label = np.zeros(np.shape(datestrs));
-    queue = [];
-    queue.append(datestrs[0]);
-
-    # some kind of loop
-    while len(queue) > 0:
-        sample_date = queue[0];  # go exploring the queue, starting at the front.
-        idx_sample = datestrs.index(sample_date);
-        label[idx_sample] = 1;
-        connected_dates = find_connected_dates(date_pairs, sample_date);
-        for i in range(len(connected_dates)):
-            idx_connection = datestrs.index(connected_dates[i]);
-            if label[idx_connection] == 0:
-                label[idx_connection] = 1;
-                queue.append(connected_dates[i]);
-        queue.pop(0);  # removing the point from the queue after it has been traversed
-
-    return np.sum(label)==len(datestrs);  # returning SUCCESS if we have a single cc touching every required date
+    lookup = {datestr: idx for idx, datestr in enumerate(datestrs)};
+    first_idx = [lookup[pair[0:7]] for pair in date_pairs];
+    second_idx = [lookup[pair[8:15]] for pair in date_pairs];
+    n_components, _, _ = network_components(first_idx, second_idx, len(datestrs));
+    return n_components == 1;  # returning SUCCESS if we have a single cc touching every required date
+
+
+def network_components(first_idx, second_idx, n_epochs):
+    # Union-find over the epochs of an interferogram network, with epochs as integer indices.
+    # first_idx, second_idx: the epoch index of the first and second image of each interferogram.
+    # Returns the number of connected components (orphaned epochs count as their own component),
+    # a label for each epoch (components numbered in time order of their first epoch),
+    # and the indices of orphaned epochs that no interferogram touches.
+    parent = list(range(n_epochs));
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]];  # path halving
+            i = parent[i];
+        return i;
+
+    touched = np.zeros((n_epochs,), dtype=bool);
+    for a, b in zip(first_idx, second_idx):
+        touched[a] = True;
+        touched[b] = True;
+        root_a, root_b = find(a), find(b);
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b);  # the earliest epoch stays the root
+
+    # Each root is the earliest epoch of its component, so numbering roots in order gives time order
+    roots = np.array([find(i) for i in range(n_epochs)], dtype=int);
+    _, labels = np.unique(roots, return_inverse=True);
+    labels = np.ravel(labels);
+    return int(np.max(labels)) + 1 if n_epochs > 0 else 0, labels, np.where(~touched)[0];
 
 
 # Functions to get TS points in row/col coordinates
@@ -407,7 +407,8 @@ def get_axarr_numbers(rows, cols, idx):
 
 def plot_full_timeseries(TS_NC_file, xdates, TS_image_file, vmin=-50, vmax=200, aspect=1):
     # Make a nice time series plot. 
-    tdata, xdata, ydata, TS_array = netcdf_read_write.read_3D_netcdf(TS_NC_file);
+    # Only the epochs that are plotted are read from the file; the dates come from xdates, not from its t axis.
+    TS_array = readmytupledata.LazyTimeSeries(TS_NC_file);
     num_rows_plots = 3;
     num_cols_plots = 4;
 